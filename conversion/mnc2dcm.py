@@ -4,7 +4,7 @@ from rhscripts.conversion import mnc_to_dcm
 from rhscripts.version import __show_version__
 
 __scriptname__ = 'mnc2dcm'
-__version__ = '0.0.4'
+__version__ = '0.0.5'
 
 """
 
@@ -13,6 +13,7 @@ VERSIONING
   0.0.2 # Added option to ignore the check for dicom files
   0.0.3 # Added rescale slope and intercept for PET files
   0.0.4 # Removed the call to mnc_to_dcm_4D since this is now part of mnc_to_dcm
+  0.0.5 # Added --workers
 
 """
 
@@ -39,6 +40,8 @@ VERSIONING
         Forces recalculation of RescaleSlope
     flip : boolean, optional
         If set, the x-axis will be flipped
+    workers : int, optional
+        Number of threads used to read and write the slices
     verbose : boolean, optional
         Set the verbosity
     version : boolean, optional
@@ -57,6 +60,7 @@ parser.add_argument("--ignore_check", help="Ignore the check for dicom files in
 parser.add_argument("--forceRescaleSlope", help="Force the script to recalculate rescale slope", action="store_true")
 parser.add_argument("--zero_clamp", help="Force non-zero values to zero", action="store_true")
 parser.add_argument("--flip", help="Flip the x-axis", action="store_true")
+parser.add_argument("--workers", help="Number of threads used to read and write the slices", type=int)
 parser.add_argument("-v","--verbose", help="increase output verbosity", action="store_true")
 parser.add_argument("--version", help="Print version", action="store_true")
 
@@ -82,4 +86,5 @@ mnc_to_dcm( args.minc_file,
             checkForFileEndings=args.ignore_check,
             forceRescaleSlope=args.forceRescaleSlope,
             flip=args.flip,
-            zero_clamp=args.zero_clamp)
+            zero_clamp=args.zero_clamp,
+            workers=args.workers)
@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 import argparse
+import json
 from rhscripts.conversion import mnc_to_rtx
 from rhscripts.version import __show_version__
 
 __scriptname__ = 'mnc2rtx'
-__version__ = '0.0.1'
+__version__ = '0.0.3'
 
 """
 
 VERSIONING
   0.0.1 # Created script
+  0.0.2 # Added --roi_map and --workers
+  0.0.3 # Added --simplify and --precision
 
 """
 
@@ -27,6 +30,14 @@ VERSIONING
         Name of the output dicom file
     verbose : boolean, optional
         Verbosity of function
+    roi_map : string, optional
+        Path to a json file with name and color of the ROIs, e.g. {"1": "liver", "2": ["spleen", [0, 255, 0]]}
+    workers : int, optional
+        Number of threads used to contour the labels
+    simplify : float, optional
+        Tolerance in mm used to simplify the contours
+    precision : int, optional
+        Number of decimals of the contour coordinates
     verbose : boolean, optional
         Set the verbosity
     version : boolean, optional
@@ -39,6 +50,10 @@ parser.add_argument("minc_file", help="Path to the minc file to be converted", n
 parser.add_argument("dicom_container", help="Path to the folder containing dicom container files", nargs='?')
 parser.add_argument("dicom_output", help="Path to the output folder for converted dicom", nargs='?')
 parser.add_argument("out_filename", help="Name of the dicom file (without .dcm)", nargs='?')
+parser.add_argument("--roi_map", help="Path to json file with name and color of the ROIs, e.g. {\"1\": [\"liver\", [0, 255, 0]]}", type=str)
+parser.add_argument("--workers", help="Number of threads used to contour the labels", type=int)
+parser.add_argument("--simplify", help="Tolerance in mm used to simplify the contours", type=float)
+parser.add_argument("--precision", help="Number of decimals of the contour coordinates", type=int, default=6)
 parser.add_argument("-v","--verbose", help="increase output verbosity", action="store_true")
 parser.add_argument("--version", help="Print version", action="store_true")
 
@@ -54,8 +69,17 @@ if not args.minc_file or not args.dicom_container or not args.dicom_output or no
     print('Too few arguments')
     exit(-1)
 
+roi_map = None
+if args.roi_map:
+    with open(args.roi_map) as f:
+        roi_map = {int(label): value for label, value in json.load(f).items()}
+
 mnc_to_rtx( mncfile=args.minc_file,
             dcmcontainer=args.dicom_container,
             out_folder=args.dicom_output,
             out_filename=args.out_filename,
-            verbose=args.verbose)
+            verbose=args.verbose,
+            roi_map=roi_map,
+            workers=args.workers,
+            simplify=args.simplify,
+            precision=args.precision)
@@ -4,12 +4,16 @@ from rhscripts.conversion import nifty_to_dcm
 from rhscripts.version import __show_version__
 
 __scriptname__ = 'nii2dcm'
-__version__ = '0.0.1'
+__version__ = '0.0.5'
 
 """
 
 VERSIONING
   0.0.1 # Created script as a copy of mnc2dcm
+  0.0.2 # Added --workers
+  0.0.3 # Added --stream
+  0.0.4 # Added --multiframe
+  0.0.5 # Added --compress
 
 """
 
@@ -34,6 +38,14 @@ VERSIONING
         Sets the check for dicom files in container to false
     forceRescaleSlope : boolean, optional
         Forces recalculation of RescaleSlope
+    workers : int, optional
+        Number of threads used to read and write the slices
+    stream : boolean, optional
+        Convert one slice at a time instead of loading the full volume
+    multiframe : boolean, optional
+        Write a single multi-frame file instead of one file per slice
+    compress : boolean, optional
+        Encode PixelData as RLE Lossless
     verbose : boolean, optional
         Set the verbosity
     version : boolean, optional
@@ -52,6 +64,10 @@ parser.add_argument("--ignore_check", help="Ignore the check for dicom files in
 parser.add_argument("--forceRescaleSlope", help="Force the script to recalculate rescale slope", action="store_true")
 parser.add_argument('--clamp_lower', help="Lower limit to be applied to file before converting", nargs=1, type=int)
 parser.add_argument('--clamp_upper', help="Upper limit to be applied to file before converting", nargs=1, type=int)
+parser.add_argument("--workers", help="Number of threads used to read and write the slices", type=int)
+parser.add_argument("--stream", help="Convert one slice at a time to limit memory use", action="store_true")
+parser.add_argument("--multiframe", help="Write a single multi-frame dicom file instead of one file per slice", action="store_true")
+parser.add_argument("--compress", help="Encode PixelData as RLE Lossless", action="store_true")
 parser.add_argument("-v","--verbose", help="increase output verbosity", action="store_true")
 parser.add_argument("--version", help="Print version", action="store_true")
 
@@ -77,4 +93,8 @@ nifty_to_dcm( args.nifty_file,
             checkForFileEndings=args.ignore_check,
             forceRescaleSlope=args.forceRescaleSlope,
             clamp_lower=args.clamp_lower,
-            clamp_upper=args.clamp_upper)
+            clamp_upper=args.clamp_upper,
+            workers=args.workers,
+            stream=args.stream,
+            multiframe=args.multiframe,
+            compress=args.compress)
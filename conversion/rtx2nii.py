@@ -1,22 +1,30 @@
 #!/usr/bin/env python
 import argparse
 from rhscripts.conversion import rtx_to_nii
+from rhscripts.dcm import inspect_rtx
 from rhscripts.version import __show_version__
 
 
 __scriptname__ = 'rtx2nii'
-__version__ = '0.0.1'
+__version__ = '0.0.4'
 
 ##
 # RTX2NII python script
 # VERSIONS:
 #  - 0.0.1 :: 2021-06-15 : Added script as a copy of rtx2mnc
+#  - 0.0.2 :: 2026-10-19 : Added roi_names and list arguments
+#  - 0.0.3 :: 2026-10-19 : Added workers argument
+#  - 0.0.4 :: 2026-10-19 : Added label_map argument
 
 parser = argparse.ArgumentParser(description='RTX2NII.')
 parser.add_argument('RTX', help='Path to the DICOM RTX file', nargs='?')
 parser.add_argument('container', help='Path to the Nifty container file', nargs='?')
 parser.add_argument('output', help='Path to the OUTPUT Nifty RT file', nargs='?')
 parser.add_argument('--behavior', help='Choose how to convert to polygon. Options: default, mirada',type=str,default='default')
+parser.add_argument('--roi_names', help='Only convert the ROIs with these names', nargs='+', default=None)
+parser.add_argument("--list", help="List the ROIs of the RTX file and exit", action="store_true")
+parser.add_argument('--workers', help='Number of threads rasterizing the ROIs. Default: all cores', type=int, default=None)
+parser.add_argument("--label_map", help="Write all ROIs to one label volume (label = ROI index + 1) with the ROI names in a json file next to it", action="store_true")
 parser.add_argument("--verbose", help="increase output verbosity", action="store_true")
 #parser.add_argument("--copy_name", help="Copy the name of the RTstruct (defined in Mirada) to the tag dicom_0x0008:el_0x103e of the MNC file", action="store_true")
 parser.add_argument("--version", help="Print version", action="store_true")
@@ -28,6 +36,11 @@ if args.version:
 	__show_version__()
 	exit(-1)
 
+if args.list and args.RTX:
+	for ROI_id, ROI in inspect_rtx(args.RTX).items():
+		print(ROI_id, ROI['ROIname'], '::', ROI['contours'], 'contours', ROI['points'], 'points, z range', ROI['z_range'])
+	exit(0)
+
 if not args.RTX or not args.container or not args.output:
 	parser.print_help()
 	print('Too few arguments')
@@ -38,4 +51,7 @@ rtx_to_nii(dcmfile=args.RTX,
            nii_output_file = args.output,
            behavior=args.behavior,
            verbose=args.verbose,
+           roi_names=args.roi_names,
+           workers=args.workers,
+           label_map=args.label_map,
            copy_name=False) # not yet implemented
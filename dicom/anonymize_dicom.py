@@ -7,13 +7,14 @@ import datetime
 from rhscripts.dcm import Anonymize, generate_SeriesInstanceUID
 
 __scriptname__ = 'anonymize_dicom'
-__version__ = '0.0.2'
+__version__ = '0.0.3'
 
 """
 VERSIONING
   0.0.1 # Created script
   0.0.2 # Removed option to give SeriesInstanceUID, this is autogenerated when
           the replaceUIDs flag is set
+  0.0.3 # Added --compress
 """
 
 """
@@ -42,6 +43,7 @@ optional arguments:
   --name NAME  Name instead of patient name
   --replaceUIDs
   --StudyInstanceUID
+  --compress   Encode PixelData as RLE Lossless
 
 -----------------------------------------------------------------
 
@@ -55,9 +57,10 @@ if __name__ == "__main__":
     parser.add_argument('--name', help='Name instead of patient name')
     parser.add_argument('--replace_uids', help="Replace the UIDs", action="store_true")
     parser.add_argument('--StudyInstanceUID', help='Set the UID. Otherwise auto generated')
+    parser.add_argument('--compress', help='Encode PixelData as RLE Lossless', action="store_true")
     args = parser.parse_args()
 
-    anon = Anonymize()
+    anon = Anonymize(compress=args.compress)
 
     if os.path.isdir(args.original):
         anon.anonymize_folder(args.original,args.output,args.name,
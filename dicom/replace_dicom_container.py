@@ -7,11 +7,13 @@ import datetime
 from rhscripts.dcm import replace_container
 
 __scriptname__ = 'replace_dicom_container'
-__version__ = '0.0.1'
+__version__ = '0.0.3'
 
 """
 VERSIONING
   0.0.1 # Created script
+  0.0.2 # Added --workers
+  0.0.3 # Added --compress
 """
 
 """
@@ -25,7 +27,7 @@ Swap the PixelDate of one dicom dataset into another container dicom dataset
 
 -----------------------------------------------------------------
 
-### USAGE: replace_dicom_container.py [-h] [--series_number SERIES_NUMBER] [--series_description SERIES_DESCRIPTION] in_folder container out_folder
+### USAGE: replace_dicom_container.py [-h] [--series_number SERIES_NUMBER] [--series_description SERIES_DESCRIPTION] [--workers WORKERS] [--compress] in_folder container out_folder
 
 positional arguments:
   in_folder             Folder with new dicom files.
@@ -38,6 +40,8 @@ optional arguments:
                         SeriesNumber, used to match the files in the folders
   --series_description SERIES_DESCRIPTION
                         Replace the name of the series
+  --workers WORKERS     Number of threads used to process the slices
+  --compress            Encode PixelData as RLE Lossless
 
 -----------------------------------------------------------------
 
@@ -52,9 +56,12 @@ if __name__ == "__main__":
     parser.add_argument("out_folder", help="Folder with resulting dcm files.")
     parser.add_argument("--series_number", help="SeriesNumber, used to match the files in the folders", type=int)
     parser.add_argument("--series_description", help="Replace the name of the series", type=str)
+    parser.add_argument("--workers", help="Number of threads used to process the slices", type=int)
+    parser.add_argument("--compress", help="Encode PixelData as RLE Lossless", action="store_true")
     args = parser.parse_args()
     
     replace_container(in_folder=args.in_folder, container=args.container, out_folder=args.out_folder, 
-                      SeriesNumber=args.series_number, SeriesDescription=args.series_description)
+                      SeriesNumber=args.series_number, SeriesDescription=args.series_description,
+                      workers=args.workers, compress=args.compress)
 
 
@@ -4,18 +4,39 @@ import os, glob
 import pydicom as dicom
 from pydicom.filereader import InvalidDicomError #For rtx2mnc
 from pydicom import dcmread
+from pydicom.valuerep import DSfloat
+from pydicom.dataset import Dataset
+from pydicom.tag import Tag
+from pydicom.uid import (
+    generate_uid,
+    RLELossless,
+    LegacyConvertedEnhancedCTImageStorage,
+    LegacyConvertedEnhancedMRImageStorage,
+    LegacyConvertedEnhancedPETImageStorage
+)
 from nipype.interfaces.dcm2nii import Dcm2niix
 import nibabel as nib
 from pathlib import Path
 import numpy as np
 import time, warnings
+import copy
+import json
+import threading
 from rhscripts.dcm import (
     generate_SeriesInstanceUID,
     generate_SOPInstanceUID,
     to_rtx,
     read_rtx,
-    get_sort_files_dict
+    iter_rtx,
+    inspect_rtx,
+    rtx_label_map,
+    get_sort_files_dict,
+    get_sort_files_dict_4D,
+    _parallel_map,
+    _DatasetTemplate,
+    _rle_compress_dataset
 )
+from rhscripts.utils import load_volume, _volume_dtype, _as_volume_dtype
 from rhscripts.version import __version__
 import datetime
 
@@ -149,6 +170,103 @@ def dcm_to_nifty(source_dir, output_dir, out_filename, compress='y'):
         print(e)
 
 
+# Largest value that can be stored in a container of the given type
+_CONSTANTS = {'int16': 32767,
+              'uint16': 65535}
+
+def _plan_rescale(slice_max, slice_min, intercepts, slopes, has_rescale, data_type, forceRescaleSlope=False,
+                  verbose=False):
+    """Decide the RescaleSlope of all slices from the per-slice max and min values
+
+    A slice gets a new RescaleSlope if forced or if its values would overflow
+    the container type, using the maximum of the full volume. Raises
+    ValueError if the rescaled data does not fit in the container type.
+
+    Parameters
+    ----------
+    slice_max : NumpyArray
+        Maximum value of each slice
+    slice_min : NumpyArray
+        Minimum value of each slice
+    intercepts : NumpyArray
+        RescaleIntercept for each slice
+    slopes : NumpyArray
+        RescaleSlope for each slice
+    has_rescale : NumpyArray
+        True for the slices where the container has a RescaleSlope
+    data_type : string
+        Type of the container pixel data, e.g. 'int16'
+    forceRescaleSlope : boolean, optional
+        Forces recalculation of rescale slope
+
+    Returns
+    -------
+    intercepts : NumpyArray
+        The RescaleIntercept to apply to each slice (0 where there is no rescale)
+    slopes : NumpyArray
+        The RescaleSlope to apply to each slice (1 where there is no rescale)
+    """
+    slice_max = np.asarray(slice_max, dtype=np.float64)
+    slice_min = np.asarray(slice_min, dtype=np.float64)
+    volume_max = slice_max.max()
+
+    # Calculate new rescale slope if needed
+    slopes = np.array(slopes, dtype=np.float64)
+    intercepts = np.array(intercepts, dtype=np.float64)
+    update = has_rescale & (forceRescaleSlope | ((slice_max - intercepts) / slopes > _CONSTANTS[data_type]))
+    if update.any():
+        new_slopes = (volume_max - intercepts[update] + 0.1) / float(_CONSTANTS[data_type])
+        # Round as it will be stored in the DS tag, so the data is scaled with the stored value
+        slopes[update] = [float(DSfloat(v, auto_format=True)) for v in new_slopes]
+        if verbose:
+            print(f"Setting RescaleSlope to {slopes[update].min()}..{slopes[update].max()} for {update.sum()} slices")
+    slopes[~has_rescale] = 1.0
+    intercepts[~has_rescale] = 0.0
+
+    # Assert ranges
+    scaled_max = (slice_max - intercepts) / slopes
+    scaled_min = (slice_min - intercepts) / slopes
+    if not np.all(scaled_max <= _CONSTANTS[data_type]):
+        raise ValueError( f"Data must be below absolute max ({_CONSTANTS[data_type]}) for {data_type} dicom container. Was {scaled_max.max()} after applying RescaleIntercept and RescaleSlope." )
+    if data_type.startswith('u'): # Only applies to unsigned, e.g. uint16
+        if not np.all(scaled_min >= 0):
+            raise ValueError( f"Data must be strictly positive for {data_type} dicom container. Was {scaled_min.min()} after applying RescaleIntercept and RescaleSlope." )
+    return intercepts, slopes
+
+def _rescale_to_container(stack, intercepts, slopes, has_rescale, data_type, forceRescaleSlope=False,
+                          chunk_size=32, verbose=False):
+    """Plan the RescaleSlope of all slices and convert the volume to the container type
+
+    Volume statistics are computed once, see _plan_rescale. The conversion
+    is done in chunks of slices to bound the size of the float64 temporaries.
+
+    Parameters
+    ----------
+    stack : NumpyArray
+        Array of shape (slices, rows, columns)
+    chunk_size : int, optional
+        Number of slices converted at a time
+    Other parameters are as for _plan_rescale
+
+    Returns
+    -------
+    converted : NumpyArray
+        Array of shape (slices, rows, columns) with type data_type
+    slopes : NumpyArray
+        The RescaleSlope used for each slice
+    """
+    intercepts, slopes = _plan_rescale(np.max(stack, axis=(1, 2)), np.min(stack, axis=(1, 2)), intercepts, slopes,
+                                       has_rescale, data_type, forceRescaleSlope=forceRescaleSlope, verbose=verbose)
+
+    # Normalize using RescaleSlope and RescaleIntercept
+    converted = np.empty(stack.shape, dtype=data_type)
+    for start in range(0, len(stack), chunk_size):
+        chunk = np.array(stack[start:start+chunk_size], dtype=np.float64)
+        chunk -= intercepts[start:start+chunk_size, None, None]
+        chunk /= slopes[start:start+chunk_size, None, None]
+        converted[start:start+chunk_size] = chunk # Truncates like astype
+    return converted, slopes
+
 def to_dcm(np_array,
            dicomcontainer,
            dicomfolder,
@@ -159,7 +277,10 @@ def to_dcm(np_array,
            patient_id=None,
            checkForFileEndings=True,
            forceRescaleSlope=False,
-           from_type='minc'):
+           from_type='minc',
+           workers=None,
+           multiframe=False,
+           compress=False):
     """Convert a numpy array (initially loaded from minc or nifty file) to dicom
 
     Parameters
@@ -184,6 +305,13 @@ def to_dcm(np_array,
     from_type : str, optional
         Used to determine how to read the input array, options:
             'minc','nifty','torchio'
+    workers : int, optional
+        Number of threads used to read and write the slices. Default is number of cores.
+    multiframe : boolean, optional
+        Write a single Legacy Converted Enhanced multi-frame file (dicom_0001.dcm)
+        instead of one file per slice. Supported for CT, MR and PT containers.
+    compress : boolean, optional
+        Encode PixelData as RLE Lossless. The slices are encoded in parallel.
 
     Examples
     --------
@@ -191,16 +319,100 @@ def to_dcm(np_array,
     >>> to_dcm(array,'PETCT','PETCT_new',description="PETCT_new",id="600")
     """
 
-    # CONSTANT(S)
-    _CONSTANTS = {'int16': 32767,
-                  'uint16': 65535}
-
     if verbose:
         print("Converting to DICOM")
 
     if description or study_id:
         modify = True
 
+    container = _parse_dcm_container(dicomcontainer, checkForFileEndings=checkForFileEndings, workers=workers)
+    _write_dcm_series(container, np_array, dicomfolder, verbose=verbose, modify=modify,
+                      description=description, study_id=study_id, patient_id=patient_id,
+                      forceRescaleSlope=forceRescaleSlope, from_type=from_type, workers=workers,
+                      multiframe=multiframe, compress=compress)
+
+    if verbose:
+        print("Output written to %s" % dicomfolder)
+
+def to_dcm_batch(np_arrays,
+                 dicomcontainer,
+                 dicomfolders,
+                 verbose=False,
+                 descriptions=None,
+                 study_ids=None,
+                 patient_id=None,
+                 checkForFileEndings=True,
+                 forceRescaleSlope=False,
+                 from_type='minc',
+                 workers=None,
+                 multiframe=False,
+                 compress=False):
+    """Convert several numpy arrays to dicom using the same container
+
+    The container is located, sorted and read only once. Each array is
+    written as its own series with a new SeriesInstanceUID.
+
+    Parameters
+    ----------
+    np_arrays : list or iterable of NumpyArray
+        Arrays loaded from files (nii or mnc). Can be a generator, so only
+        one array needs to be in memory at a time
+    dicomcontainer : string
+        Path to the directory containing the dicom container
+    dicomfolders : list of string
+        Path to the output dicom folder for each array
+    verbose : boolean, optional
+        Set the verbosity
+    descriptions : list of string, optional
+        Sets the SeriesDescription tag for each series
+    study_ids : list of int, optional
+        Sets the SeriesNumber tag for each series
+    patient_id : string, optional
+        Sets the PatientName and PatientID tag in all series
+    forceRescaleSlope : boolean, optional
+        Forces recalculation of rescale slope
+    from_type : str, optional
+        Used to determine how to read the input arrays, see to_dcm
+    workers : int, optional
+        Number of threads used to read and write the slices. Default is number of cores.
+    multiframe : boolean, optional
+        Write each series as a single multi-frame file, see to_dcm
+    compress : boolean, optional
+        Encode PixelData as RLE Lossless, see to_dcm
+
+    Examples
+    --------
+    >>> from rhscripts.conversion import to_dcm_batch
+    >>> to_dcm_batch([pred1,pred2],'PET',['PET_pred1','PET_pred2'],descriptions=['pred1','pred2'],study_ids=[601,602])
+    """
+    descriptions = descriptions if descriptions is not None else [None]*len(dicomfolders)
+    study_ids = study_ids if study_ids is not None else [None]*len(dicomfolders)
+    if not len(dicomfolders) == len(descriptions) == len(study_ids):
+        raise ValueError("dicomfolders, descriptions and study_ids must have the same length")
+
+    container = _parse_dcm_container(dicomcontainer, checkForFileEndings=checkForFileEndings, workers=workers)
+
+    for np_array, dicomfolder, description, study_id in zip(np_arrays, dicomfolders, descriptions, study_ids):
+        if verbose:
+            print("Converting to DICOM:", dicomfolder)
+        _write_dcm_series(container, np_array, dicomfolder, verbose=verbose, modify=True,
+                          description=description, study_id=study_id, patient_id=patient_id,
+                          forceRescaleSlope=forceRescaleSlope, from_type=from_type, workers=workers,
+                          multiframe=multiframe, compress=compress)
+
+def _parse_dcm_container(dicomcontainer, checkForFileEndings=True, workers=None):
+    """Locate, sort and read the headers of a dicom container once
+
+    Returns
+    -------
+    dict with
+        slices : dict{ SliceNumber: Path to dcm file }, sorted by position
+        headers : dict{ SliceNumber: pydicom Dataset without PixelData }
+        templates : dict{ transfer syntax: dict{ SliceNumber: _DatasetTemplate } }, see _get_dcm_templates
+        data_type : string, type of the container pixel data
+        is_4D_container : boolean, True if the container has NumberOfSlices
+        frames : int, NumberOfTimeSlices of the container (1 if not set)
+    """
     if checkForFileEndings:
         dcmcontainer = look_for_dcm_files(dicomcontainer)
         if dcmcontainer == -1:
@@ -212,122 +424,337 @@ def to_dcm(np_array,
     if isinstance(dcmcontainer, str):
         dcmcontainer = Path(dcmcontainer)
 
+    # Get information about the dataset from a single file, before sorting
+    ds = None
+    for p in sorted(dcmcontainer.rglob('*')):
+        if p.is_file() and not p.name.startswith('.'):
+            try:
+                ds = dcmread(str(p))
+                break
+            except Exception:
+                pass
+    if ds is None:
+        sys.exit("Could not find dicom files in container..")
+
     # gather the dicom slices from the container
     # return a dict with keys={0..#slices -1}, values=Path to dcm file
-    dcm_slices = get_sort_files_dict(dcmcontainer)
+    # Dynamic series share the positions of all frames, sort by frame as well
+    if (frames := int(ds.get('NumberOfTimeSlices', 1) or 1)) > 1:
+        dcm_slices = get_sort_files_dict_4D(dcmcontainer, workers=workers)
+    else:
+        dcm_slices = get_sort_files_dict(dcmcontainer, workers=workers)
+
+    # Read all container headers once
+    headers = dict(zip(dcm_slices.keys(),
+                       _parallel_map(lambda f: dcmread(str(f), stop_before_pixels=True), dcm_slices.values(), workers)))
+
+    return {'slices': dcm_slices,
+            'headers': headers,
+            'templates': {},
+            'data_type': ds.pixel_array.dtype.name,
+            'is_4D_container': hasattr(ds, 'NumberOfSlices'),
+            'frames': frames}
 
-    # Get information about the dataset from a single file
-    ds = dcmread(dcm_slices[0])
-    data_type = ds.pixel_array.dtype.name
+def _get_dcm_templates(container, compress=False, workers=None):
+    """Byte templates of the container headers, encoded once per output transfer syntax
+
+    Returns dict{ SliceNumber: _DatasetTemplate, or None if the header must be written with save_as }
+    """
+    transfer_syntax = RLELossless if compress else None
+    if transfer_syntax not in container['templates']:
+        def make_template(header):
+            try:
+                return _DatasetTemplate(header, transfer_syntax=transfer_syntax)
+            except NotImplementedError:
+                return None
+        container['templates'][transfer_syntax] = dict(zip(container['headers'].keys(),
+                                                           _parallel_map(make_template, container['headers'].values(), workers)))
+    return container['templates'][transfer_syntax]
+
+def _write_dcm_series(container, np_array, dicomfolder, verbose=False, modify=False, description=None,
+                      study_id=None, patient_id=None, forceRescaleSlope=False, from_type='minc', workers=None,
+                      multiframe=False, compress=False):
+    """Write one array as a dicom series, using a container from _parse_dcm_container. See to_dcm"""
+    dcm_slices = container['slices']
+    data_type = container['data_type']
 
     # Determine if this is a 4D array
-    if is_4D := ( hasattr(ds, 'NumberOfSlices') and len(np_array.shape) == 4 ):
-        numberofslices = ds.NumberOfSlices # Get the number of slices per time point
+    if is_4D := ( container['is_4D_container'] and (len(np_array.shape) == 4 or
+                                                     getattr(np_array, 'frames', 1) > 1) ):
         if verbose:
             print("Converting a 4D array")
 
-    # Check that the correct number of files exists
-    if from_type == 'minc' and is_4D:
-        totalSlicesInArray = np_array.shape[0]*np_array.shape[1]
-    if from_type == 'minc' and not is_4D:
-        totalSlicesInArray = np_array.shape[0]
-    if from_type == 'nifty' and is_4D:
-        sys.exit('Nifty 4D conversion not yet implemented')
-    if (from_type == 'nifty' or from_type == 'torchio') and not is_4D:
-        totalSlicesInArray = np_array.shape[2]
+    # Stack the array as (slice, rows, columns) without copying.
+    # Slice n of the stack is written to the container slice given by slice_index.
+    if isinstance(np_array, _NiftySliceStack):
+        # Slices are read on demand, already in stack order
+        stack = np_array
+    elif from_type == 'minc' and is_4D:
+        stack = np_array.reshape((-1,) + np_array.shape[2:])
+    elif from_type == 'minc' and not is_4D:
+        stack = np_array
+    elif from_type == 'nifty' and not is_4D:
+        # Container slice with InstanceNumber n is np.flip(np_array[:, :, -n].T, 0)
+        stack = np.flip(np.transpose(np_array, (2, 1, 0)), axis=(0, 1))
+    elif from_type == 'torchio' and not is_4D:
+        stack = np.moveaxis(np_array, 2, 0)
+    elif from_type == 'nifty' and is_4D:
+        # Frame t, slice n is stacked at t*NumberOfSlices + n, see _NiftySliceStack
+        stack = np.flip(np.transpose(np_array, (3, 2, 1, 0)), axis=(1, 2)).reshape((-1,) + np_array.shape[1::-1])
+    else:
+        sys.exit('You must specify a from_type when using to_dcm function')
+    totalSlicesInArray = stack.shape[0]
 
     if verbose:
         print("Checkinf if the number of files ( {} ) equals number of slices ( {} )".format(len(dcm_slices), totalSlicesInArray))
     assert len(dcm_slices) == totalSlicesInArray
 
+    # The headers are shared between series and are not modified
+    headers = container['headers']
+    for header in headers.values():
+        assert (header.Rows, header.Columns) == stack.shape[1:]
+    # SliceNumber of a 4D container is frame*NumberOfSlices + position, see get_sort_files_dict_4D
+    frame_size = len(headers) // (container['frames'] if is_4D else 1)
+    if from_type == 'nifty':
+        # Slices are stacked by InstanceNumber within each frame.
+        order = sorted(headers, key=lambda SliceNumber: (SliceNumber // frame_size, int(headers[SliceNumber].InstanceNumber)))
+        slice_index = {SliceNumber: n for n, SliceNumber in enumerate(order)}
+    else:
+        # Sometimes this needs to be flipped,
+        # e.g. max(dcm_slices.keys())-SliceNumber-1 (or similar).
+        # This should be triggered by a dicom tag somewhere.
+        slice_index = {SliceNumber: int(SliceNumber) for SliceNumber in headers}
+
+    # Plan RescaleSlope for all slices and convert the full volume to the container type
+    has_rescale = np.zeros(len(stack), dtype=bool)
+    intercepts = np.zeros(len(stack))
+    slopes = np.ones(len(stack))
+    for SliceNumber, header in headers.items():
+        if hasattr(header, 'RescaleSlope'):
+            has_rescale[slice_index[SliceNumber]] = True
+            intercepts[slice_index[SliceNumber]] = float(header.get('RescaleIntercept', 0))
+            slopes[slice_index[SliceNumber]] = float(header.RescaleSlope)
+    if isinstance(stack, _NiftySliceStack):
+        # Only the slice statistics are kept, each slice is read again and converted when it is written
+        slice_stats = np.array(_parallel_map(lambda n: (lambda a: (a.max(), a.min()))(stack[n]), range(len(stack)), workers))
+        intercepts, slopes = _plan_rescale(slice_stats[:, 0], slice_stats[:, 1], intercepts, slopes, has_rescale,
+                                           data_type, forceRescaleSlope=forceRescaleSlope, verbose=verbose)
+
+        def get_pixels(n):
+            pixels = np.empty(stack.shape[1:], dtype=data_type)
+            pixels[:] = (np.asarray(stack[n], dtype=np.float64) - intercepts[n]) / slopes[n] # Truncates like astype
+            return pixels
+    else:
+        converted, slopes = _rescale_to_container(stack, intercepts, slopes, has_rescale, data_type,
+                                                  forceRescaleSlope=forceRescaleSlope, verbose=verbose)
+        get_pixels = converted.__getitem__
+
     ## Prepare for MODIFY HEADER
     newSIUID = generate_SeriesInstanceUID()
+    # Assign the UIDs in slice order, independent of the order the threads finish in
+    newSOPUIDs = {SliceNumber: generate_SOPInstanceUID((int(ds.InstanceNumber) if from_type == 'nifty' else int(SliceNumber))+1)
+                  for SliceNumber, ds in headers.items()} if modify else {}
 
     # Prepare output folder
     if isinstance(dicomfolder, str):
         dicomfolder = Path(dicomfolder)
     dicomfolder.mkdir(parents=True, exist_ok=True)
 
-    # List files, do not need to be ordered
-    for SliceNumber, f in dcm_slices.items():
-        ds = dcmread(f)
-        # Sometimes this needs to be flipped,
-        # e.g. max(dcm_slices.keys())-SliceNumber-1 (or similar).
-        # This should be triggered by a dicom tag somewhere.
-        i = int(SliceNumber)
-
-        # Get single slice
-        if from_type == 'minc' and is_4D:
-            assert ds.pixel_array.shape == (np_array.shape[2],np_array.shape[3])
-            data_slice = np_array[i // numberofslices,i % numberofslices,:,:]
-        elif from_type == 'minc' and not is_4D:
-            assert ds.pixel_array.shape == (np_array.shape[1],np_array.shape[2])
-            data_slice = np_array[i,:,:].astype('double')
-        elif from_type == 'nifty' and not is_4D:
-            i = int(ds.InstanceNumber)
-            assert ds.pixel_array.shape == (np_array.shape[0],np_array.shape[1])
-            data_slice = np.flip(np_array[:, :, -1 * i].T, 0).astype('double')
-        elif from_type == 'torchio' and not is_4D:
-            data_slice = np_array[:, :, i].astype('double')
-        elif from_type == 'nifty' and is_4D:
-            sys.exit('Nifty 4D conversion not yet implemented')
-        else:
-            sys.exit('You must specify a from_type when using to_dcm function')
-
-        # Check for Data Rescale
-        if hasattr(ds, 'RescaleSlope'):
-            # Calculate new rescale slope if needed
-            if forceRescaleSlope or (np.max(data_slice) - ds.RescaleIntercept )/ds.RescaleSlope > _CONSTANTS[data_type]:
-                ds.RescaleSlope = ( np.max(np_array)-ds.RescaleIntercept + 0.1 ) / float(_CONSTANTS[data_type])
-                if verbose:
-                    print(f"Setting RescaleSlope to {ds.RescaleSlope}")
-
-            # Normalize using RescaleSlope and RescaleIntercept
-            data_slice = (data_slice - ds.RescaleIntercept) / ds.RescaleSlope
-
-        # Assert ranges
-        #assert np.max(data_slice) <= _CONSTANTS[data_type], f"Data must be below absolute max ({_CONSTANTS[data_type]}) for {data_type} dicom container. Was {np.max(data_slice)}"
-        if not np.max(data_slice) <= _CONSTANTS[data_type]:
-            raise ValueError( f"Data must be below absolute max ({_CONSTANTS[data_type]}) for {data_type} dicom container. Was {np.max(data_slice)} after applying RescaleIntercept and RescaleSlope." )
-            return
-        if data_type.startswith('u'): # Only applies to unsigned, e.g. uint16
-            if not np.min(data_slice) >= 0:
-                raise ValueError( f"Data must be strictly positive for {data_type} dicom container. Was {np.min(data_slice)} after applying RescaleIntercept and RescaleSlope." )
-                return
-            #assert np.min(data_slice) >= 0, f"Data must be strictly positive for {data_type} dicom container. Was {np.min(data_slice)}"
-        data_slice = data_slice.astype(data_type) # This will fail without warning if the above assertions is not meet!
+    # Same for all files
+    series_updates = {}
+    if modify:
+        # Set information if given
+        if description:
+            series_updates['SeriesDescription'] = description
+        if study_id:
+            series_updates['SeriesNumber'] = study_id
+        if patient_id:
+            series_updates['PatientID'] = patient_id
+            series_updates['PatientName'] = patient_id
+        series_updates['SeriesInstanceUID'] = newSIUID
+
+    if multiframe:
+        # Convert all slices into one array of frames, ordered by position (and time for 4D containers)
+        order = sorted(headers)
+        pixels = np.empty((len(order),) + stack.shape[1:], dtype=data_type)
+        def convert_frame(i):
+            pixels[i] = get_pixels(slice_index[order[i]])
+        _parallel_map(convert_frame, range(len(order)), workers)
+
+        updates = dict(series_updates, SOPInstanceUID=generate_SOPInstanceUID(1))
+        _write_multiframe([headers[SliceNumber] for SliceNumber in order], pixels, dicomfolder.joinpath("dicom_0001.dcm"),
+                          [slopes[slice_index[SliceNumber]] if has_rescale[slice_index[SliceNumber]] else None
+                           for SliceNumber in order],
+                          updates,
+                          positions=[SliceNumber % frame_size + 1 for SliceNumber in order],
+                          temporal_positions=[SliceNumber // frame_size + 1 for SliceNumber in order] if is_4D else None,
+                          compress=compress)
+        return
+
+    templates = _get_dcm_templates(container, compress=compress, workers=workers)
 
-        # Insert pixel-data
-        ds.PixelData = data_slice.tostring()
+    def write_slice(SliceNumber):
+        header = headers[SliceNumber]
+        n = slice_index[SliceNumber]
+        pixels = get_pixels(n)
+
+        updates = dict(series_updates)
+        if has_rescale[n]:
+            updates['RescaleSlope'] = DSfloat(slopes[n], auto_format=True)
 
         # Update LargesImagetPixelValue tag pr slice
-        if 'LargestImagePixelValue' in ds:
-            ds.LargestImagePixelValue = int(np.ceil(data_slice.max()))
+        if 'LargestImagePixelValue' in header:
+            updates['LargestImagePixelValue'] = int(pixels.max())
 
+        # Update SOP - unique per file
         if modify:
-            if verbose:
-                print("Modifying DICOM headers")
+            updates['SOPInstanceUID'] = newSOPUIDs[SliceNumber]
 
-            # Set information if given
-            if description:
-                ds.SeriesDescription = description
-            if study_id:
-                ds.SeriesNumber = study_id
-            if patient_id:
-                ds.PatientID = patient_id
-                ds.PatientName = patient_id
+        fname = dicomfolder.joinpath(f"dicom_{header.InstanceNumber:04}.dcm")
+        if (template := templates[SliceNumber]) is not None:
+            # Splice the new values and pixel-data into the encoded header
+            template.write(fname, pixels, {keyword: template.encode(keyword, value) for keyword, value in updates.items()})
+        else:
+            ds = copy.deepcopy(header)
+            for keyword, value in updates.items():
+                setattr(ds, keyword, value)
 
-            # Update SOP - unique per file
-            ds.SOPInstanceUID = generate_SOPInstanceUID(i+1)
+            # Insert pixel-data
+            ds.PixelData = pixels.tobytes()
+            ds[0x7fe0, 0x0010].VR = 'OW'
+            if compress:
+                _rle_compress_dataset(ds)
+            ds.save_as(fname)
 
-            # Same for all files
-            ds.SeriesInstanceUID = newSIUID
+    if modify and verbose:
+        print("Modifying DICOM headers")
 
-        fname = f"dicom_{ds.InstanceNumber:04}.dcm"
-        ds.save_as(dicomfolder.joinpath(fname))
+    # Files are written in parallel, names and UIDs do not depend on the order
+    _parallel_map(write_slice, headers.keys(), workers)
+
+# SOP Class of the multi-frame object written by to_dcm(..., multiframe=True) for each Modality
+_MULTIFRAME_SOP_CLASSES = {'CT': LegacyConvertedEnhancedCTImageStorage,
+                           'MR': LegacyConvertedEnhancedMRImageStorage,
+                           'PT': LegacyConvertedEnhancedPETImageStorage}
+
+# Attributes of the container slices that are moved into the functional groups of a multi-frame object
+_FUNCTIONAL_GROUP_KEYWORDS = ('ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'SliceThickness',
+                              'RescaleIntercept', 'RescaleSlope', 'RescaleType', 'WindowCenter', 'WindowWidth',
+                              'WindowCenterWidthExplanation')
+
+def _write_multiframe(headers, pixels, fname, slopes, updates, positions, temporal_positions=None, compress=False):
+    """Write container slices and their new pixel data as one Legacy Converted Enhanced multi-frame file
+
+    Geometry, rescale and window of each slice are stored in the per-frame
+    functional groups, other attributes that differ between the slices are
+    stored as unassigned per-frame converted attributes.
+
+    Parameters
+    ----------
+    headers : list of pydicom Dataset
+        Container headers in frame order
+    pixels : NumpyArray
+        Array of shape (frames, rows, columns) with the container type
+    fname : Path
+        Output file
+    slopes : list of float
+        RescaleSlope of each frame, None if the slice has no RescaleSlope
+    updates : dict
+        New values of the top level attributes, e.g. SOPInstanceUID
+    positions : list of int
+        InStackPositionNumber of each frame
+    temporal_positions : list of int, optional
+        TemporalPositionIndex of each frame of a dynamic series
+    compress : boolean, optional
+        Encode the frames as RLE Lossless
+    """
+    first = headers[0]
+    if (sop_class := _MULTIFRAME_SOP_CLASSES.get(first.get('Modality'))) is None:
+        raise ValueError(f"Multi-frame output is only supported for {', '.join(_MULTIFRAME_SOP_CLASSES)} containers. Got {first.get('Modality')}.")
+
+    # Attributes that differ between the slices are stored per frame
+    skip = {Tag(keyword) for keyword in _FUNCTIONAL_GROUP_KEYWORDS + ('SOPInstanceUID', 'InstanceNumber',
+                                                                      'LargestImagePixelValue', 'SmallestImagePixelValue')}
+    per_frame = set()
+    for header in headers[1:]:
+        for tag in (set(first.keys()) | set(header.keys())) - skip - per_frame:
+            if tag not in first or tag not in header or first[tag].value != header[tag].value:
+                per_frame.add(tag)
+
+    ds = copy.deepcopy(first)
+    dimension_uid = generate_uid()
+    dimensions = ['StackID', 'InStackPositionNumber'] + (['TemporalPositionIndex'] if temporal_positions else [])
+    ds.DimensionOrganizationSequence = [Dataset()]
+    ds.DimensionOrganizationSequence[0].DimensionOrganizationUID = dimension_uid
+    ds.DimensionIndexSequence = []
+    for keyword in dimensions:
+        index = Dataset()
+        index.DimensionOrganizationUID = dimension_uid
+        index.DimensionIndexPointer = Tag(keyword)
+        index.FunctionalGroupPointer = Tag('FrameContentSequence')
+        ds.DimensionIndexSequence.append(index)
+
+    shared = Dataset()
+    shared.PixelMeasuresSequence = [Dataset()]
+    shared.PixelMeasuresSequence[0].PixelSpacing = first.PixelSpacing
+    if 'SliceThickness' in first:
+        shared.PixelMeasuresSequence[0].SliceThickness = first.SliceThickness
+    shared.PlaneOrientationSequence = [Dataset()]
+    shared.PlaneOrientationSequence[0].ImageOrientationPatient = first.ImageOrientationPatient
+    ds.SharedFunctionalGroupsSequence = [shared]
+
+    ds.PerFrameFunctionalGroupsSequence = []
+    for i, header in enumerate(headers):
+        frame = Dataset()
+        content = Dataset()
+        content.StackID = '1'
+        content.InStackPositionNumber = positions[i]
+        if temporal_positions:
+            content.TemporalPositionIndex = temporal_positions[i]
+        content.DimensionIndexValues = [1, positions[i]] + ([temporal_positions[i]] if temporal_positions else [])
+        frame.FrameContentSequence = [content]
+        frame.PlanePositionSequence = [Dataset()]
+        frame.PlanePositionSequence[0].ImagePositionPatient = header.ImagePositionPatient
+        if slopes[i] is not None:
+            transformation = Dataset()
+            transformation.RescaleIntercept = header.get('RescaleIntercept', 0)
+            transformation.RescaleSlope = DSfloat(slopes[i], auto_format=True)
+            transformation.RescaleType = header.get('RescaleType', 'US')
+            frame.PixelValueTransformationSequence = [transformation]
+        if 'WindowCenter' in header and 'WindowWidth' in header:
+            voi = Dataset()
+            voi.WindowCenter = header.WindowCenter
+            voi.WindowWidth = header.WindowWidth
+            frame.FrameVOILUTSequence = [voi]
+        if per_frame & set(header.keys()):
+            unassigned = Dataset()
+            for tag in per_frame & set(header.keys()):
+                unassigned.add(copy.deepcopy(header[tag]))
+            frame.UnassignedPerFrameConvertedAttributesSequence = [unassigned]
+        ds.PerFrameFunctionalGroupsSequence.append(frame)
+
+    for tag in (skip | per_frame) & set(ds.keys()):
+        if tag not in (Tag('SOPInstanceUID'), Tag('LargestImagePixelValue'), Tag('SmallestImagePixelValue')):
+            del ds[tag]
+    ds.SOPClassUID = sop_class
+    ds.InstanceNumber = 1
+    ds.NumberOfFrames = len(headers)
+    if 'LargestImagePixelValue' in ds:
+        ds.LargestImagePixelValue = int(pixels.max())
+    for keyword, value in updates.items():
+        setattr(ds, keyword, value)
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+    try:
+        _DatasetTemplate(ds, transfer_syntax=RLELossless if compress else None).write(fname, pixels)
+    except NotImplementedError:
+        ds.PixelData = pixels.tobytes()
+        ds[0x7fe0, 0x0010].VR = 'OW'
+        if compress:
+            _rle_compress_dataset(ds)
+        ds.save_as(fname)
 
-    if verbose:
-        print("Output written to %s" % dicomfolder)
 
 def mnc_to_dcm(mncfile,
                dicomcontainer,
@@ -341,7 +768,9 @@ def mnc_to_dcm(mncfile,
                zero_clamp=False,
                clamp_lower: int=None,
                clamp_upper: int=None,
-               flip: bool=False):
+               flip: bool=False,
+               workers: int=None,
+               dtype=None):
     """Convert a minc file to dicom
 
     Parameters
@@ -371,6 +800,10 @@ def mnc_to_dcm(mncfile,
         Force an upper bound on the input data
     flip : boolean, optional
         If set, the x-axis will be flipped
+    workers : int, optional
+        Number of threads used to read and write the slices. Default is number of cores.
+    dtype : numpy dtype, optional
+        dtype the minc file is loaded as. Default is float32, see rhscripts.utils.load_volume
 
     Examples
     --------
@@ -379,10 +812,7 @@ def mnc_to_dcm(mncfile,
     """
 
     # Load the minc file
-    import pyminc.volumes.factory as pyminc
-    minc = pyminc.volumeFromFile(mncfile)
-    np_minc = np.array(minc.data)
-    minc.closeVolume()
+    np_minc = load_volume(mncfile, dtype=dtype)
 
     # Remove non-zero elements
     if zero_clamp:
@@ -406,7 +836,8 @@ def mnc_to_dcm(mncfile,
            study_id=study_id,
            checkForFileEndings=checkForFileEndings,
            forceRescaleSlope=forceRescaleSlope,
-           from_type='minc')
+           from_type='minc',
+           workers=workers)
 
 
 """ DEPRECATED FUNCTION. """
@@ -428,7 +859,12 @@ def nifty_to_dcm(nftfile,
                  checkForFileEndings=True,
                  forceRescaleSlope=False,
                  clamp_lower: int=None,
-                 clamp_upper: int=None):
+                 clamp_upper: int=None,
+                 workers: int=None,
+                 stream: bool=False,
+                 multiframe: bool=False,
+                 compress: bool=False,
+                 dtype=None):
     """Convert a minc file to dicom
     Parameters
     ----------
@@ -455,20 +891,31 @@ def nifty_to_dcm(nftfile,
         Force a lower bound on the input data
     clamp_upper : int, optional
         Force an upper bound on the input data
+    workers : int, optional
+        Number of threads used to read and write the slices. Default is number of cores.
+    stream : boolean, optional
+        Read, clamp and convert one slice at a time instead of loading the full
+        volume. The file is read twice, so only uncompressed .nii files are
+        streamed, compressed 3D files are loaded in full. 4D files are always
+        streamed one frame at a time, in on-disk order, with the frames mapped
+        to the time slices of a dynamic container.
+    multiframe : boolean, optional
+        Write a single multi-frame file instead of one file per slice, see to_dcm
+    compress : boolean, optional
+        Encode PixelData as RLE Lossless, see to_dcm
+    dtype : numpy dtype, optional
+        dtype the nifty file is loaded as. Default is the dtype on disk for unscaled integer data
+        and float32 otherwise, see rhscripts.utils.load_volume
 
     Examples
     --------
     >>> from rhscripts.conversion import nifty_to_dcm
     >>> nifty_to_dcm('PETCT_new.nii.gz', 'PETCT', 'PETCT_new', description="PETCT_new", id="600")
+    >>> nifty_to_dcm('dynamic_PET.nii', 'dynamic_PET_container', 'dynamic_PET_new', description="dynamic")
     """
 
-    np_nifti = nib.load(nftfile).get_fdata()
-
-    # Force values to lie within a range accepted by the dicom container
-    if clamp_lower is not None:
-        np_nifti = np.maximum( np_nifti, clamp_lower )
-    if clamp_upper is not None:
-        np_nifti = np.minimum( np_nifti, clamp_upper )
+    np_nifti = _load_nifty_for_dcm(nftfile, clamp_lower=clamp_lower, clamp_upper=clamp_upper, stream=stream,
+                                   dtype=dtype)
 
     to_dcm(np_array=np_nifti,
            dicomcontainer=dicomcontainer,
@@ -480,7 +927,153 @@ def nifty_to_dcm(nftfile,
            patient_id=patient_id,
            checkForFileEndings=checkForFileEndings,
            forceRescaleSlope=forceRescaleSlope,
-           from_type='nifty')
+           from_type='nifty',
+           workers=workers,
+           multiframe=multiframe,
+           compress=compress)
+
+
+def _load_nifty_for_dcm(nftfile, clamp_lower=None, clamp_upper=None, stream=False, dtype=None):
+    """Load a nifty file and force the values to lie within a range accepted by the dicom container
+
+    Returns a _NiftySliceStack instead of the full array if the file is 4D, or
+    if stream is set and the file is uncompressed. Each slice of a compressed
+    file would decompress the stream up to it again.
+    """
+    img = nib.load(nftfile)
+    compressed = str(img.get_filename()).endswith(('.gz', '.bz2', '.zst'))
+    if (stream and not compressed) or len(img.shape) == 4:
+        return _NiftySliceStack(img, clamp_lower=clamp_lower, clamp_upper=clamp_upper, dtype=dtype)
+    np_nifti = load_volume(img, dtype=dtype)
+
+    if clamp_lower is not None:
+        np_nifti = np.maximum( np_nifti, clamp_lower )
+    if clamp_upper is not None:
+        np_nifti = np.minimum( np_nifti, clamp_upper )
+    return np_nifti
+
+
+class _NiftySliceStack:
+    """Read-on-demand view of a nifty image as a (slice, rows, columns) stack
+
+    Slice n is the same as slice n of the stack built from the full array in
+    to_dcm with from_type='nifty'. For 4D files, slice n of frame t is stacked
+    at t*NumberOfSlices + n. 3D files are read one slice at a time through the
+    nibabel array proxy, which memory-maps uncompressed files. 4D files are
+    read one frame at a time, and the two most recent frames are kept so
+    threads writing neighbouring slices share the reads.
+    """
+    def __init__(self, img, clamp_lower=None, clamp_upper=None, dtype=None):
+        self.dataobj = img.dataobj
+        self.dtype = _volume_dtype(img, dtype)
+        self.clamp_lower = clamp_lower
+        self.clamp_upper = clamp_upper
+        x, y, z = self.dataobj.shape[:3]
+        self.frames = self.dataobj.shape[3] if len(self.dataobj.shape) == 4 else 1
+        self.slices = z
+        self.shape = (self.frames*z, y, x)
+        self._frame_cache = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_frame(self, t):
+        with self._lock:
+            if t not in self._frame_cache:
+                if len(self._frame_cache) >= 2:
+                    del self._frame_cache[min(self._frame_cache)]
+                self._frame_cache[t] = _as_volume_dtype(self.dataobj[..., t], self.dtype)
+            return self._frame_cache[t]
+
+    def __getitem__(self, n):
+        t, n = divmod(n, self.slices)
+        if self.frames > 1:
+            np_slice = self._read_frame(t)[:, :, self.slices-1-n]
+        else:
+            np_slice = _as_volume_dtype(self.dataobj[:, :, self.slices-1-n], self.dtype)
+        if self.clamp_lower is not None:
+            np_slice = np.maximum( np_slice, self.clamp_lower )
+        if self.clamp_upper is not None:
+            np_slice = np.minimum( np_slice, self.clamp_upper )
+        return np.flip(np_slice.T, 0)
+
+
+def nifty_to_dcm_batch(nftfiles,
+                       dicomcontainer,
+                       dicomfolders,
+                       verbose=False,
+                       descriptions=None,
+                       study_ids=None,
+                       patient_id=None,
+                       checkForFileEndings=True,
+                       forceRescaleSlope=False,
+                       clamp_lower: int=None,
+                       clamp_upper: int=None,
+                       workers: int=None,
+                       stream: bool=False,
+                       multiframe: bool=False,
+                       compress: bool=False,
+                       dtype=None):
+    """Convert several nifty files to dicom using the same container
+
+    The container is parsed once and the nifty files are loaded one at a
+    time. Each file is written as its own series with a new SeriesInstanceUID.
+
+    Parameters
+    ----------
+    nftfiles : list of string or Path object
+        Paths to the nifty files
+    dicomcontainer : string or Path object
+        Path to the directory containing the dicom container
+    dicomfolders : list of string or Path object
+        Path to the output dicom folder for each nifty file
+    verbose : boolean, optional
+        Set the verbosity
+    descriptions : list of string, optional
+        Sets the SeriesDescription tag for each series
+    study_ids : list of int, optional
+        Sets the SeriesNumber tag for each series
+    patient_id : string, optional
+        Sets the PatientName and PatientID tag in all series
+    forceRescaleSlope : boolean, optional
+        Forces recalculation of rescale slope
+    clamp_lower : int, optional
+        Force a lower bound on the input data
+    clamp_upper : int, optional
+        Force an upper bound on the input data
+    workers : int, optional
+        Number of threads used to read and write the slices. Default is number of cores.
+    stream : boolean, optional
+        Read, clamp and convert one slice at a time, see nifty_to_dcm
+    multiframe : boolean, optional
+        Write each series as a single multi-frame file, see to_dcm
+    compress : boolean, optional
+        Encode PixelData as RLE Lossless, see to_dcm
+    dtype : numpy dtype, optional
+        dtype the nifty file is loaded as. Default is the dtype on disk for unscaled integer data
+        and float32 otherwise, see rhscripts.utils.load_volume
+
+    Examples
+    --------
+    >>> from rhscripts.conversion import nifty_to_dcm_batch
+    >>> nifty_to_dcm_batch(['pred1.nii.gz', 'pred2.nii.gz'], 'PET', ['PET_pred1', 'PET_pred2'], descriptions=['pred1', 'pred2'])
+    """
+    to_dcm_batch(np_arrays=(_load_nifty_for_dcm(f, clamp_lower=clamp_lower, clamp_upper=clamp_upper, stream=stream,
+                                                dtype=dtype)
+                            for f in nftfiles),
+                 dicomcontainer=dicomcontainer,
+                 dicomfolders=dicomfolders,
+                 verbose=verbose,
+                 descriptions=descriptions,
+                 study_ids=study_ids,
+                 patient_id=patient_id,
+                 checkForFileEndings=checkForFileEndings,
+                 forceRescaleSlope=forceRescaleSlope,
+                 from_type='nifty',
+                 workers=workers,
+                 multiframe=multiframe,
+                 compress=compress)
 
 
 def rtdose_to_mnc(dcmfile,mncfile):
@@ -536,7 +1129,11 @@ def mnc_to_rtx( mncfile: str,
                 dcmcontainer: str,
                 out_folder: str,
                 out_filename: str,
-                verbose: bool=False):
+                verbose: bool=False,
+                roi_map: dict=None,
+                workers: int=None,
+                simplify: float=None,
+                precision: int=6):
 
     """Convert minc label file to RT struct dicom file
 
@@ -552,6 +1149,14 @@ def mnc_to_rtx( mncfile: str,
        Name of the output dicom file
     verbose : boolean, optional
        Verbosity of function
+    roi_map : dict, optional
+       Name and color of the ROIs as { label: name } or { label: (name, (r,g,b)) }
+    workers : int, optional
+       Number of threads used to contour the labels. Default is number of cores.
+    simplify : float, optional
+       Tolerance in mm used to simplify the contours. The default is None (keep all points).
+    precision : int, optional
+       Number of decimals of the contour coordinates. The default is 6.
     """
     # Load the minc file
     import pyminc.volumes.factory as pyminc
@@ -561,14 +1166,20 @@ def mnc_to_rtx( mncfile: str,
 
     # Convert from axial-first to axial-last
     np_minc = np.swapaxes( np.swapaxes( np_minc, 0, 1), 1, 2 )
-    to_rtx( np_roi=np_minc, dcmcontainer=dcmcontainer, out_folder=out_folder,
-            out_filename=out_filename,verbose=verbose)
+    return to_rtx( np_roi=np_minc, dcmcontainer=dcmcontainer, out_folder=out_folder,
+                   out_filename=out_filename,verbose=verbose,roi_map=roi_map,workers=workers,
+                   simplify=simplify,precision=precision)
 
 def nii_to_rtx( niifile: str,
                 dcmcontainer: str,
                 out_folder: str,
                 out_filename: str,
-                verbose: bool=False):
+                verbose: bool=False,
+                roi_map: dict=None,
+                workers: int=None,
+                simplify: float=None,
+                precision: int=6,
+                dtype=None):
 
     """Convert minc label file to RT struct dicom file
 
@@ -584,23 +1195,56 @@ def nii_to_rtx( niifile: str,
        Name of the output dicom file
     verbose : boolean, optional
        Verbosity of function
+    roi_map : dict, optional
+       Name and color of the ROIs as { label: name } or { label: (name, (r,g,b)) }
+    workers : int, optional
+       Number of threads used to contour the labels. Default is number of cores.
+    simplify : float, optional
+       Tolerance in mm used to simplify the contours. The default is None (keep all points).
+    precision : int, optional
+       Number of decimals of the contour coordinates. The default is 6.
+    dtype : numpy dtype, optional
+       dtype the nifty file is loaded as. Default is the dtype on disk for unscaled integer labels, see rhscripts.utils.load_volume
     """
-    # Load the minc file
-    np_nifti = nib.load(niifile).get_fdata()
+    # Load the nifty file
+    np_nifti = load_volume(niifile, dtype=dtype)
 
     # Convert from axial-first to axial-last
     np_nifti = np.swapaxes( np.swapaxes( np_nifti, 0, 1), 1, 2 )
     # More needed? UNTESTED!!
 
-    to_rtx( np_roi=np_nifti, dcmcontainer=dcmcontainer, out_folder=out_folder,
-            out_filename=out_filename,verbose=verbose)
+    return to_rtx( np_roi=np_nifti, dcmcontainer=dcmcontainer, out_folder=out_folder,
+                   out_filename=out_filename,verbose=verbose,roi_map=roi_map,workers=workers,
+                   simplify=simplify,precision=precision)
+
+def _write_label_names(ROIs: dict, json_file: str):
+    """ Write the ROI name of each label (ROI_id+1) of a label map as a json sidecar """
+    with open(json_file, 'w') as f:
+        json.dump({str(ROI_id+1): ROI['ROIname'] for ROI_id, ROI in ROIs.items()}, f, indent=2)
+
+def _set_minc_roi_name(volume, name: str) -> bool:
+    """ Store a ROI name in dicom_0x0008:el_0x103e of an open pyminc volume through libminc
+
+    Returns False if libminc could not be called, see rtx_to_mnc.
+    """
+    import ctypes
+    try:
+        from pyminc.volumes.libpyminc2 import libminc
+        value = name.encode()
+        # 7 is MI_TYPE_STRING, 0 is MI_NOERROR
+        return libminc.miset_attr_values(volume.volPointer, 7, b'dicom_0x0008', b'el_0x103e', len(value), value) == 0
+    except (ImportError, AttributeError, OSError, ctypes.ArgumentError):
+        return False
 
 def rtx_to_mnc(dcmfile,
                mnc_container_file,
                mnc_output_file,
                behavior: str='default',
                verbose=False,
-               copy_name=False):
+               copy_name=False,
+               roi_names=None,
+               workers=None,
+               label_map=False):
 
     """Convert dcm file (RT struct) to minc file
 
@@ -618,29 +1262,57 @@ def rtx_to_mnc(dcmfile,
         Default = False (if true, print info)
     copy_name : boolean, optional
         Default = False, If true the ROI name from Mirada is stored in Minc header
+    roi_names : list of str, optional
+        Default = None, If given only the ROIs with these names are converted (see rhscripts.dcm.inspect_rtx)
+    workers : int, optional
+        Default = None, Number of threads rasterizing the ROIs (None uses all cores)
+    label_map : boolean, optional
+        Default = False, If true all ROIs are written to one label volume with label ROI_id+1,
+        and the ROI name of each label to a json file next to it
     Examples
     --------
     >>> from rhscripts.conversion import rtx_to_mnc
     >>> rtx_to_mnc('RTstruct.dcm','PET.mnc','RTstruct.mnc',verbose=False,copy_name=True)
+    >>> rtx_to_mnc('RTstruct.dcm','PET.mnc','RTstruct.mnc',label_map=True) # RTstruct.mnc and RTstruct.json
     """
     import pyminc.volumes.factory as pyminc
     volume = pyminc.volumeFromFile(mnc_container_file)
 
-    # Read RTX file. Returns dict of dict with outer key=ROI_index and inner_keys "ROIname" and "data"
-    ROI_output = read_rtx( dcmfile=dcmfile,
+    # Number of ROIs to convert, known before the contours are read
+    num_ROIs = sum(roi_names is None or ROI['ROIname'] in roi_names for ROI in inspect_rtx(dcmfile).values())
+
+    # Read RTX file one ROI at a time. Yields ROI_index and dict with keys "ROIname" and "data"
+    ROI_output = iter_rtx( dcmfile=dcmfile,
                            img_size=volume.data.shape,
                            fn_world_to_voxel=volume.convertWorldToVoxel,
                            behavior=behavior,
-                           verbose=verbose )
+                           verbose=verbose,
+                           roi_names=roi_names,
+                           workers=workers,
+                           sparse=label_map )
+
+    if label_map:
+        # One label volume, with the ROI names in a json sidecar
+        ROIs = dict(ROI_output)
+        labels = rtx_label_map(ROIs) if ROIs else np.zeros(volume.data.shape, dtype=np.uint8)
+        minc_type = 'ubyte' if labels.dtype == np.uint8 else 'ushort'
+        RTMINC = pyminc.volumeLikeFile(mnc_container_file,mnc_output_file,dtype=minc_type,volumeType=minc_type,labels=True)
+        RTMINC.data = labels
+        RTMINC.writeFile()
+        RTMINC.closeVolume()
+        _write_label_names(ROIs, mnc_output_file[:-4] + ".json")
+        volume.closeVolume()
+        return
 
-    for ROI_id,ROI in ROI_output.items():
-        RTMINC_outname = mnc_output_file if len(ROI_output) == 1 else mnc_output_file[:-4] + "_" + str(ROI_id) + ".mnc"
+    for ROI_id,ROI in ROI_output:
+        RTMINC_outname = mnc_output_file if num_ROIs == 1 else mnc_output_file[:-4] + "_" + str(ROI_id) + ".mnc"
         RTMINC = pyminc.volumeLikeFile(mnc_container_file,RTMINC_outname)
         RTMINC.data = ROI['data']
         RTMINC.writeFile()
+        name_stored = copy_name and _set_minc_roi_name(RTMINC, ROI['ROIname'])
         RTMINC.closeVolume()
 
-        if copy_name:
+        if copy_name and not name_stored:
             print('minc_modify_header -sinsert dicom_0x0008:el_0x103e="'+ROI['ROIname']+'" '+RTMINC_outname)
             os.system('minc_modify_header -sinsert dicom_0x0008:el_0x103e="'+ROI['ROIname']+'" '+RTMINC_outname)
     volume.closeVolume()
@@ -650,7 +1322,10 @@ def rtx_to_nii(dcmfile,
                nii_output_file,
                behavior: str='default',
                verbose=False,
-               copy_name=False):
+               copy_name=False,
+               roi_names=None,
+               workers=None,
+               label_map=False):
 
     """Convert dcm file (RT struct) to nifty file
 
@@ -668,33 +1343,55 @@ def rtx_to_nii(dcmfile,
         Default = False (if true, print info)
     copy_name : boolean, optional
         Default = False, If true the ROI name from Mirada is stored in Nifty header
+    roi_names : list of str, optional
+        Default = None, If given only the ROIs with these names are converted (see rhscripts.dcm.inspect_rtx)
+    workers : int, optional
+        Default = None, Number of threads rasterizing the ROIs (None uses all cores)
+    label_map : boolean, optional
+        Default = False, If true all ROIs are written to one label volume with label ROI_id+1,
+        and the ROI name of each label to a json file next to it
     Examples
     --------
     >>> from rhscripts.conversion import rtx_to_nii
     >>> rtx_to_nii('RTstruct.dcm','PET.nii.gz','RTstruct.nii.gz',verbose=False,copy_name=True)
+    >>> rtx_to_nii('RTstruct.dcm','PET.nii.gz','RTstruct.nii.gz',label_map=True) # RTstruct.nii.gz and RTstruct.json
     """
 
     # Check file ending of output assuming one of .nii and .nii.gz
     suffix_length = 4 if nii_output_file.endswith('.nii') else 7
 
+    # Only the header of the container is needed
     volume = nib.load(nii_container_file)
 
     # Flip to axial-first orientation (assuming axial last)
-    data = volume.get_fdata()
-    data = np.swapaxes(data, 0, 2)
+    shape = volume.shape[2::-1]
 
-    # Read RTX file. Returns dict of dict with outer key=ROI_index and inner_keys "ROIname" and "data"
-    ROI_output = read_rtx( dcmfile=dcmfile,
-                           img_size=data.shape,
-                           fn_world_to_voxel=lambda x: nib.affines.apply_affine(aff=np.linalg.inv(volume.affine),pts=x),
+    # Number of ROIs to convert, known before the contours are read
+    num_ROIs = sum(roi_names is None or ROI['ROIname'] in roi_names for ROI in inspect_rtx(dcmfile).values())
+
+    # Read RTX file one ROI at a time. Yields ROI_index and dict with keys "ROIname" and "data"
+    ROI_output = iter_rtx( dcmfile=dcmfile,
+                           img_size=shape,
+                           fn_world_to_voxel=np.linalg.inv(volume.affine),
                            behavior=behavior,
                            voxel_dims=[2,0,1],
-                           verbose=verbose )
+                           verbose=verbose,
+                           roi_names=roi_names,
+                           workers=workers,
+                           sparse=label_map )
+
+    if label_map:
+        # One label volume, with the ROI names in a json sidecar
+        ROIs = dict(ROI_output)
+        labels = rtx_label_map(ROIs) if ROIs else np.zeros(shape, dtype=np.uint8)
+        nib.save(nib.Nifti1Image(np.swapaxes(labels, 2, 0), volume.affine), nii_output_file)
+        _write_label_names(ROIs, nii_output_file[:-suffix_length] + ".json")
+        return
 
-    for ROI_id,ROI in ROI_output.items():
+    for ROI_id,ROI in ROI_output:
         # Swap back to axial last
         ROI_data = np.swapaxes(ROI['data'], 2, 0)
-        RTNII_outname = nii_output_file if len(ROI_output) == 1 else nii_output_file[:-suffix_length] + "_" + str(ROI_id) + ".nii.gz"
+        RTNII_outname = nii_output_file if num_ROIs == 1 else nii_output_file[:-suffix_length] + "_" + str(ROI_id) + ".nii.gz"
         RTNII = nib.Nifti1Image(ROI_data,volume.affine)
         nib.save(RTNII,RTNII_outname)
 
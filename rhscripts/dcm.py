@@ -1,25 +1,50 @@
 #!/usr/bin/env python
 import os, math
+import copy
+import collections
+import hashlib
+import itertools
+import json
+import struct
+import threading
+import warnings
+import zlib
+from time import time_ns
 import pydicom as dicom
 import configparser
 import glob
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import numpy as np
 from pathlib import Path
-from typing import Optional, Tuple, Callable, Dict, Union
+from typing import Optional, Tuple, Callable, Dict, Union, Iterator
 from pydicom import dcmread
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless
+from pydicom.encaps import encapsulate
 from pydicom.filereader import InvalidDicomError #For rtx2mnc
+from pydicom.filebase import DicomBytesIO
 import cv2
+from scipy.ndimage import find_objects
 import random
 import socket
 from rhscripts.version import __version__
 import nibabel as nib
 
 
+_uid_counter = itertools.count()
+_uid_lock = threading.Lock()
+
 def __generate_uid_suffix() -> str:
-    """ Generate and return a new UID """
-    return datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    """ Generate and return a new UID suffix
+
+    The suffix is a fixed-width (26 digit) string of microseconds since epoch,
+    the process ID and a per-process counter. It is unique across threads and
+    processes on the same host without any shared state between workers.
+    """
+    with _uid_lock:
+        count = next(_uid_counter) % 1000
+    return '{:016d}{:07d}{:03d}'.format(time_ns() // 1000, os.getpid() % 10000000, count)
 
 def generate_StudyInstanceUID() -> str:
     """ Generate and return a new StudyInstanceUID """
@@ -39,6 +64,24 @@ def generate_SOPInstanceUID(i: int) -> str:
     """
     return '1.3.12.2.1107.5.2.38.51014.{}{}'.format(__generate_uid_suffix(),i)
 
+def remap_UID(uid: str, salt: str='', prefix: str='1.3.12.2.1107.5.2.38.51014.') -> str:
+    """ Deterministically map an existing UID to a new UID
+
+    The same uid and salt always return the same new UID, so workers processing
+    different files of the same series agree on e.g. the new SeriesInstanceUID
+    without having to share it.
+
+    Parameters
+    ----------
+    uid : str
+        The UID to be replaced
+    salt : str, optional
+        Extra entropy, e.g. a job ID. Use a new salt to get a new set of UIDs
+    prefix : str, optional
+        Root of the returned UID. Must end with "."
+    """
+    return str(generate_uid(prefix=prefix, entropy_srcs=[str(uid), str(salt)]))
+
 class Anonymize:
     """
     Anonymize script for DICOM file or folder containing dicom files
@@ -49,7 +92,8 @@ class Anonymize:
     anon.anonymize_folder(dicom_original_folder,dicom_anonymized_folder)
     """
 
-    def __init__( self, verbose: bool=False, remove_private_tags: bool=False, sort_by_instance_number: bool=False ):
+    def __init__( self, verbose: bool=False, remove_private_tags: bool=False, sort_by_instance_number: bool=False,
+                  uid_salt: str=None, compress: bool=False ):
         """
         Parameters
         ----------
@@ -59,10 +103,18 @@ class Anonymize:
             Remove the private tags. The default is False.
         sort_by_instance_number : bool, optional
             Overwrites the output file to contain InstanceNumber ("dicom<04d:InstanceNumber>.dcm"). The default is False.
+        uid_salt : str, optional
+            When set, replaced UIDs are derived from the original UIDs with remap_UID instead of being generated.
+            Files can then be anonymized independently (e.g. in parallel) and still share Study/Series UIDs.
+            The default is None.
+        compress : bool, optional
+            Encode uncompressed PixelData as RLE Lossless. The default is False.
         """
         self.verbose = verbose
         self.remove_private_tags = remove_private_tags
         self.sort_by_instance_number = sort_by_instance_number
+        self.uid_salt = uid_salt
+        self.compress = compress
 
     def anonymize_dataset(self, dataset: dicom.dataset.Dataset, new_person_name: str="anonymous",
                   studyInstanceUID: str=None, seriesInstanceUID: str=None, replaceUIDs: bool=False) -> dicom.dataset.Dataset:
@@ -122,13 +174,29 @@ class Anonymize:
             dataset.remove_private_tags()
 
         # Replace InstanceUIDs
-        if replaceUIDs:
+        if replaceUIDs and self.uid_salt is not None:
+            if studyInstanceUID is None:
+                studyInstanceUID = remap_UID(dataset.StudyInstanceUID, self.uid_salt, prefix='1.3.51.0.1.1.10.143.20.159.')
+            if seriesInstanceUID is None:
+                seriesInstanceUID = remap_UID(dataset.SeriesInstanceUID, self.uid_salt)
+            dataset.StudyInstanceUID = studyInstanceUID
+            dataset.SeriesInstanceUID = seriesInstanceUID
+            dataset.SOPInstanceUID = remap_UID(dataset.SOPInstanceUID, self.uid_salt)
+        elif replaceUIDs:
             dataset.StudyInstanceUID = studyInstanceUID if studyInstanceUID is not None else generate_StudyInstanceUID()
             dataset.SeriesInstanceUID = seriesInstanceUID if seriesInstanceUID is not None else generate_SeriesInstanceUID()
             dataset.SOPInstanceUID = generate_SOPInstanceUID(dataset.InstanceNumber)
 
         return dataset
 
+    def _anonymize_trailing( self, dataset: dicom.dataset.Dataset ) -> dicom.dataset.Dataset:
+        """ Elements after PixelData kept by anonymize_file: no padding, and no private tags if removed """
+        if 'DataSetTrailingPadding' in dataset:
+            del dataset.DataSetTrailingPadding
+        if self.remove_private_tags:
+            dataset.remove_private_tags()
+        return dataset
+
     def anonymize_file( self, filename: str, output_filename: str, new_person_name: str="anonymous",
                   studyInstanceUID: str=None, seriesInstanceUID: str=None, replaceUIDs: bool=False):
         """ Anonymize a single slice
@@ -140,10 +208,13 @@ class Anonymize:
         output_filename: str
             Dicom file to be written
         """
-        # Load the current dicom file to 'anonymize'
-        ds = dicom.read_file(filename)
+        # Load the header of the current dicom file to 'anonymize'. PixelData is copied as is unless compressed
+        if self.compress:
+            ds = dicom.read_file(filename)
+        else:
+            ds, offset = _read_header_and_offset(filename)
 
-        if replaceUIDs:
+        if replaceUIDs and self.uid_salt is None:
             assert studyInstanceUID is not None # Must be set on folder level
             assert seriesInstanceUID is not None # Must be set on folder level
 
@@ -156,6 +227,11 @@ class Anonymize:
             output_filename = str(Path(output_filename).parent.joinpath("dicom"+str(ds.InstanceNumber).zfill(4)+'.dcm'))
 
         # write the 'anonymized' DICOM out under the new filename
+        if not self.compress:
+            _patch_file(ds, filename, offset, output_filename, trailing=self._anonymize_trailing)
+            return
+        if 'PixelData' in ds and not ds.file_meta.TransferSyntaxUID.is_compressed:
+            _rle_compress_dataset(ds)
         ds.save_as(output_filename)
 
     def anonymize_folder(self,foldername: str,output_foldername: str,
@@ -197,8 +273,8 @@ class Anonymize:
         if len(os.listdir(foldername)) > 9999:
             exit('Too many files in folder for script..')
 
-        # Check for replaceUIDs:
-        if replaceUIDs:
+        # Check for replaceUIDs. With uid_salt the UIDs are remapped per file instead:
+        if replaceUIDs and self.uid_salt is None:
             if studyInstanceUID is None:
                 studyInstanceUID = generate_StudyInstanceUID()
             seriesInstanceUID = generate_SeriesInstanceUID()
@@ -419,36 +495,443 @@ def get_AC_series_info_from_PET(file: Union[str, Path, dicom.dataset.Dataset]) -
     return CT_used_for, StudyInstanceUID, SeriesInstanceUID
 
 
-def sort_files(path):
+def _read_header(file: Union[str, Path], specific_tags: list=None) -> dicom.dataset.Dataset:
+    """ Read only the header of a dicom file, optionally only the listed tags """
+    return dcmread(str(file), stop_before_pixels=True, specific_tags=specific_tags, force=True)
+
+
+def _parallel_map(fn: Callable, items, workers: int=None) -> list:
+    """ Apply fn to each item using a thread pool. Returns results in input order.
+
+    workers=None uses the number of cores, workers=1 runs in the calling thread.
+    """
+    items = list(items)
+    if workers == 1 or len(items) < 2:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(fn, items))
+
+
+def _parallel_imap(fn: Callable, items, workers: int=None) -> Iterator:
+    """ Generator version of _parallel_map, yielding results in input order as they are done
+
+    Items are taken lazily and at most two per worker are in progress or
+    waiting to be consumed, so memory stays bounded for long inputs.
+    """
+    if workers == 1:
+        yield from map(fn, items)
+        return
+    workers = workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _rle_packbits(x: np.ndarray, row_length: int) -> np.ndarray:
+    """ PackBits encode a byte array without runs crossing rows, see DICOM PS3.5 Annex G """
+    n = len(x)
+    change = np.ones(n, dtype=bool)
+    change[1:] = x[1:] != x[:-1]
+    change[::row_length] = True
+    run_starts = np.flatnonzero(change)
+    run_lengths = np.diff(np.append(run_starts, n))
+
+    # Split runs longer than 128 bytes
+    pieces = (run_lengths + 127) // 128
+    run = np.repeat(np.arange(len(run_starts)), pieces)
+    within = np.arange(len(run)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    starts = run_starts[run] + 128*within
+    lengths = np.minimum(run_lengths[run] - 128*within, 128)
+
+    # Runs are replicate packets, single bytes are merged into literal packets of up to 128 bytes within a row
+    literal = lengths == 1
+    previous_literal = np.zeros_like(literal)
+    previous_literal[1:] = literal[:-1]
+    new_group = literal & (~previous_literal | (starts % row_length == 0))
+    literal_index = np.cumsum(literal) - 1
+    group_start = np.maximum.accumulate(np.where(new_group, literal_index, 0))
+    position = np.where(literal, literal_index - group_start, 0) % 128
+    packet_start = ~literal | (position == 0)
+    packet = np.cumsum(packet_start) - 1
+    packet_length = np.bincount(packet)
+    packet_literal = literal[packet_start]
+
+    out_length = np.where(packet_literal, 1 + packet_length, 2)
+    offsets = np.cumsum(out_length) - out_length
+    out = np.empty(out_length.sum(), dtype=np.uint8)
+    out[offsets] = np.where(packet_literal, packet_length - 1, 257 - lengths[packet_start])
+    out[offsets[~packet_literal] + 1] = x[starts[~literal]]
+    out[offsets[packet[literal]] + 1 + position[literal]] = x[starts[literal]]
+    return out
+
+
+def _rle_encode_frame(frame: np.ndarray) -> bytes:
+    """ Encode a (rows, columns) or (rows, columns, samples) frame as an RLE Lossless frame """
+    rows, columns = frame.shape[:2]
+    raw = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder('<')).view(np.uint8)
+    raw = raw.reshape(rows*columns, -1, frame.dtype.itemsize)
+    segments = []
+    for sample in range(raw.shape[1]):  # One segment per byte of each sample, most significant byte first
+        for byte in reversed(range(raw.shape[2])):
+            segment = _rle_packbits(raw[:, sample, byte], columns).tobytes()
+            segments.append(segment + b'\x00'*(len(segment) % 2))
+    if len(segments) > 15:
+        raise ValueError(f"RLE Lossless supports at most 15 segments, got {len(segments)}")
+    offsets = np.cumsum([64] + [len(segment) for segment in segments])[:-1]
+    header = struct.pack('<16I', len(segments), *offsets, *[0]*(15 - len(segments)))
+    return header + b''.join(segments)
+
+
+def _rle_encapsulate(pixels: np.ndarray, samples: int=1) -> bytes:
+    """ Encode (frames,) rows, columns(, samples) pixels as encapsulated RLE Lossless PixelData """
+    frame_ndim = 2 if samples == 1 else 3
+    frames = pixels.reshape((-1,) + pixels.shape[-frame_ndim:])
+    return encapsulate([_rle_encode_frame(frame) for frame in frames], has_bot=True)
+
+
+def _rle_compress_dataset(ds: dicom.dataset.Dataset) -> dicom.dataset.Dataset:
+    """ Encode the uncompressed PixelData of a dataset as RLE Lossless, in place
+
+    Samples are stored as separate segments, so PlanarConfiguration is set
+    to 1 for multi sample images. Bit packed (BitsAllocated 1) data is left
+    as is with a warning.
+    """
+    if ds.get('BitsAllocated') == 1:
+        warnings.warn("RLE compression of BitsAllocated 1 PixelData is not supported, writing it uncompressed")
+        return ds
+    pixels = ds.pixel_array
+    samples = ds.get('SamplesPerPixel', 1)
+    ds.PixelData = _rle_encapsulate(pixels, samples)
+    ds[0x7fe0, 0x0010].VR = 'OB'
+    ds[0x7fe0, 0x0010].is_undefined_length = True
+    if samples > 1:
+        ds.PlanarConfiguration = 1
+    ds.file_meta.TransferSyntaxUID = RLELossless
+    ds.is_implicit_VR = False
+    ds.is_little_endian = True
+    return ds
+
+
+class _DatasetTemplate:
+    """ Byte template of a dicom header for writing many modified copies of it
+
+    The header is encoded once, split at the elements that can be replaced
+    (TAGS). A copy is written by joining the encoded segments with the new
+    or original values of the replaceable elements and the new PixelData,
+    which gives the same bytes as modifying the dataset and calling save_as.
+
+    The copies are written with the transfer syntax of the header if it is
+    uncompressed, otherwise as Explicit VR Little Endian. With
+    transfer_syntax=RLELossless the PixelData is RLE encoded. Other transfer
+    syntaxes raise NotImplementedError.
+    """
+    TAGS = [dicom.tag.Tag(keyword) for keyword in
+            ('SOPInstanceUID', 'SeriesDescription', 'PatientName', 'PatientID', 'SeriesInstanceUID',
+             'SeriesNumber', 'LargestImagePixelValue', 'RescaleSlope', 'PixelData')]
+
+    def __init__(self, ds: dicom.dataset.Dataset, transfer_syntax: str=None):
+        file_meta = getattr(ds, 'file_meta', None)
+        syntax = file_meta.get('TransferSyntaxUID') if file_meta else None
+        if transfer_syntax is None and syntax is not None and (syntax.is_compressed or syntax.is_deflated):
+            transfer_syntax = ExplicitVRLittleEndian
+        if transfer_syntax is not None and transfer_syntax != syntax:
+            if transfer_syntax not in (ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless):
+                raise NotImplementedError(f"Can not write a template with transfer syntax {transfer_syntax}")
+            # Re-encode the header with the new transfer syntax
+            ds = copy.copy(ds)
+            ds.file_meta = copy.deepcopy(file_meta) if file_meta is not None else dicom.dataset.FileMetaDataset()
+            ds.file_meta.TransferSyntaxUID = syntax = dicom.uid.UID(transfer_syntax)
+            ds.is_implicit_VR = syntax.is_implicit_VR
+            ds.is_little_endian = True
+            file_meta = ds.file_meta
+        if not ds.is_little_endian or ds[0x00000000:0x00010000]:
+            raise NotImplementedError(f"Can not make a template of a dataset with transfer syntax {syntax}")
+        if not ds.is_original_encoding:
+            ds = dicom.filewriter.correct_ambiguous_vr(copy.copy(ds), True)
+
+        self.is_implicit_VR = ds.is_implicit_VR
+        self.is_rle = syntax == RLELossless
+        self.encoding = ds.get('SpecificCharacterSet', dicom.charset.default_encoding)
+        self.VRs = {tag: ds[tag].VR for tag in self.TAGS if tag in ds}
+
+        # Preamble and file meta are written as in save_as
+        fp = DicomBytesIO()
+        if getattr(ds, 'preamble', None):
+            fp.write(ds.preamble)
+            fp.write(b'DICM')
+        if file_meta:
+            dicom.filewriter.write_file_meta_info(fp, file_meta, enforce_standard=False)
+
+        self.segments = []
+        self.originals = {}
+        for tag in sorted(set(ds.keys()) | set(self.TAGS)):
+            if tag in self.TAGS:
+                self.segments.append(fp.getvalue())
+                fp = DicomBytesIO()
+                self.originals[tag] = self._encode(ds.get_item(tag)) if tag in ds and tag != self.TAGS[-1] else b''
+            elif not (tag.element == 0 and tag.group > 6):  # Retired group lengths are not written
+                self._prepare(fp)
+                dicom.filewriter.write_data_element(fp, ds.get_item(tag), self.encoding)
+        self.segments.append(fp.getvalue())
+
+    def _prepare(self, fp):
+        fp.is_little_endian = True
+        fp.is_implicit_VR = self.is_implicit_VR
+        return fp
+
+    def _encode(self, elem) -> bytes:
+        fp = self._prepare(DicomBytesIO())
+        dicom.filewriter.write_data_element(fp, elem, self.encoding)
+        return fp.getvalue()
+
+    def encode(self, keyword: str, value) -> bytes:
+        """ Encode a new value of one of the replaceable elements """
+        tag = dicom.tag.Tag(keyword)
+        return self._encode(dicom.DataElement(tag, self.VRs.get(tag, dicom.datadict.dictionary_VR(tag)), value))
+
+    def has(self, keyword: str) -> bool:
+        """ True if the header contains the replaceable element """
+        return dicom.tag.Tag(keyword) in self.VRs
+
+    def write(self, filename: Union[str, Path], pixels: np.ndarray, updates: Dict[str, bytes]=None):
+        """ Write a copy of the header with new PixelData
+
+        Parameters
+        ----------
+        filename : str or Path
+            Output file
+        pixels : numpy array
+            New pixel data of shape (frames,) rows, columns. Written as OW in
+            native (little endian) byte order, or RLE encoded.
+        updates : dict, optional
+            Encoded new values by keyword, see encode. Other elements keep
+            their original value.
+        """
+        updates = {dicom.tag.Tag(keyword): value for keyword, value in (updates or {}).items()}
+        if self.is_rle:
+            data = _rle_encapsulate(pixels)
+            pixel_header = struct.pack('<HH2sHI', 0x7fe0, 0x0010, b'OB', 0, 0xFFFFFFFF)
+            pixel_trailer = struct.pack('<HHI', 0xfffe, 0xe0dd, 0)  # Sequence delimiter
+        else:
+            data = memoryview(np.ascontiguousarray(pixels)).cast('B')
+            if self.is_implicit_VR:
+                pixel_header = struct.pack('<HHI', 0x7fe0, 0x0010, data.nbytes)
+            else:
+                pixel_header = struct.pack('<HH2sHI', 0x7fe0, 0x0010, b'OW', 0, data.nbytes)
+            pixel_trailer = b''
+        with open(filename, 'wb') as f:
+            for segment, tag in zip(self.segments, self.TAGS):
+                f.write(segment)
+                if tag == self.TAGS[-1]:
+                    f.write(pixel_header)
+                    f.write(data)
+                    f.write(pixel_trailer)
+                else:
+                    f.write(updates.get(tag, self.originals[tag]))
+            f.write(self.segments[-1])
+
+
+def _read_header_and_offset(file: Union[str, Path], force: bool=False) -> Tuple[dicom.dataset.Dataset, int]:
+    """ Read the header of a dicom file and the byte offset of its PixelData (file size if there is none) """
+    with open(file, 'rb') as fp:
+        ds = dcmread(fp, stop_before_pixels=True, force=force)
+        return ds, fp.tell()
+
+
+def _apply_tag_updates(ds: dicom.dataset.Dataset, tag_updates: dict) -> dicom.dataset.Dataset:
+    """ Apply tag updates to a dataset in place, see patch_series """
+    for key, value in tag_updates.items():
+        if callable(value):
+            value = value(ds)
+        tag = dicom.tag.Tag(key)
+        if value is None:
+            if tag in ds:
+                del ds[tag]
+        elif tag in ds:
+            ds[tag].value = value
+        else:
+            ds.add_new(tag, dicom.datadict.dictionary_VR(tag), value)
+    return ds
+
+
+def _pixel_data_end(fp, offset: int, implicit: bool, little: bool) -> int:
+    """ File position right after the PixelData element starting at offset, walking encapsulated fragments """
+    endian = '<' if little else '>'
+    fp.seek(offset)
+    header = fp.read(8)
+    if len(header) < 8:
+        return offset
+    if implicit:
+        length = struct.unpack(endian+'L', header[4:])[0]
+    else:
+        length = struct.unpack(endian+'L', fp.read(4))[0]
+    if length != 0xFFFFFFFF:
+        return fp.tell() + length
+    # Encapsulated: items until the sequence delimiter
+    while True:
+        item = fp.read(8)
+        if len(item) < 8:
+            return fp.tell()
+        group, element, length = struct.unpack(endian+'HHL', item)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return fp.tell()
+        fp.seek(length, 1)
+
+
+def _patch_file(header: dicom.dataset.Dataset, src: Union[str, Path], offset: int, dst: Union[str, Path],
+                trailing: Optional[Callable]=None):
+    """ Write a header followed by the PixelData element of src (at offset) verbatim
+
+    The header must be encoded with the transfer syntax of src. Elements
+    after PixelData are dropped, unless trailing is given: it gets them as
+    a Dataset and returns the Dataset to write after PixelData. If dst is
+    src, the file is replaced through a temporary file.
+    """
+    syntax = header.file_meta.get('TransferSyntaxUID') if getattr(header, 'file_meta', None) else None
+    if syntax is not None and syntax.is_deflated:
+        # The full dataset is deflated, so the pixel bytes can not be copied
+        ds = dcmread(str(src), force=True)
+        for elem in header:
+            ds[elem.tag] = elem
+        for tag in set(ds.keys()) - set(header.keys()) - {dicom.tag.Tag('PixelData')}:
+            if tag < dicom.tag.Tag('PixelData'):
+                del ds[tag]
+        after = dicom.dataset.Dataset({tag: ds[tag] for tag in ds.keys() if tag > dicom.tag.Tag('PixelData')})
+        for tag in after.keys():
+            del ds[tag]
+        if trailing is not None:
+            ds.update(trailing(after))
+        ds.save_as(str(dst))
+        return
+
+    buffer = DicomBytesIO()
+    dicom.filewriter.dcmwrite(buffer, header, write_like_original=True)
+    encoded = buffer.getvalue()
+
+    implicit = header.is_implicit_VR if header.is_implicit_VR is not None else syntax == ImplicitVRLittleEndian
+    little = header.is_little_endian if header.is_little_endian is not None else syntax != dicom.uid.ExplicitVRBigEndian
+    if Path(src).resolve() == Path(dst).resolve():
+        # Never write into src: it may share its inode with other files (hardlinks)
+        tmp = Path(dst).with_name(f'.{Path(dst).name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    else:
+        tmp = Path(dst)
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        fdst.write(encoded)
+        end = _pixel_data_end(fsrc, offset, implicit, little)
+        fsrc.seek(offset)
+        remaining = end - offset
+        while remaining > 0:
+            chunk = fsrc.read(min(remaining, 1024*1024))
+            if not chunk:
+                break
+            fdst.write(chunk)
+            remaining -= len(chunk)
+        if trailing is not None:
+            fsrc.seek(end)
+            after = dicom.filereader.read_dataset(fsrc, implicit, little, os.fstat(fsrc.fileno()).st_size - end)
+            after = trailing(after)
+            if len(after) > 0:
+                out = DicomBytesIO()
+                out.is_implicit_VR, out.is_little_endian = implicit, little
+                dicom.filewriter.write_dataset(out, after)
+                fdst.write(out.getvalue())
+    if tmp != Path(dst):
+        os.replace(tmp, dst)
+
+
+def _link_or_copy(src: Union[str, Path], dst: Union[str, Path], link: str='copy'):
+    """ Place src at dst using the cheapest available method
+
+    Parameters
+    ----------
+    src : str or Path
+        Existing file
+    dst : str or Path
+        New file
+    link : str, optional
+        One of 'copy', 'auto' (reflink, then copy), 'reflink' or 'hardlink'.
+        Methods not supported by the filesystem fall back to copy. A reflink
+        or copy is independent of src, a hardlink shares its content.
+    """
+    if link not in ('auto', 'reflink', 'hardlink', 'copy'):
+        raise ValueError(f'Unknown link method: {link}')
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if link in ('auto', 'reflink'):
+        try:
+            import fcntl
+            FICLONE = 0x40049409  # Linux ioctl used by cp --reflink
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    copyfile(src, dst)
+
+
+def sort_files(path, workers: int=None, link: str='copy'):
     """ Sort a folder of DICOM files
     It will rename the files based on InstanceNumber
     It will create subfolders if multiple time-points exists
 
+    Each header is read once (in parallel). The files are copied to the
+    output folder, or placed as reflinks or hardlinks if asked for. Note
+    that a hardlinked file shares its content with the input file, so
+    changing it in place changes the input as well.
+
     Parameters
     ----------
     path : string
         Path to the dicom files
+    workers : int, optional
+        Number of threads used to read the headers. Default is number of cores.
+    link : str, optional
+        How to place the files: 'copy', 'auto' (reflink where the filesystem
+        allows it, else copy), 'reflink' or 'hardlink'. Default is 'copy'.
     """
+    path = str(path).rstrip('/')
     folder = '%s_sorted' % path
     if not os.path.exists(folder):
         os.mkdir(folder)
 
-    last_file = glob.glob(path+'/*')[-1]
+    files = [e.path for e in os.scandir(path) if e.is_file() and not e.name.startswith('.')]
 
-    do_split = False if get_time_slices(last_file) == 1 else True
+    def read(f):
+        ds = _read_header(f, specific_tags=['InstanceNumber', 'NumberOfTimeSlices', 'FrameReferenceTime'])
+        return f, int(ds.InstanceNumber), int(ds.get('NumberOfTimeSlices', 1) or 1), ds.get('FrameReferenceTime')
 
-    for dcmfile in os.listdir(path):
+    headers = _parallel_map(read, files, workers)
 
-        if do_split:
-            frame_name = 'frame_%010d' % int(get_tag(os.path.join(path,dcmfile),'FrameReferenceTime'))
-            if not os.path.exists(os.path.join(folder,frame_name)):
-                os.mkdir(os.path.join(folder,frame_name))
+    do_split = any(h[2] > 1 for h in headers)
 
-            fname = '%s/%s/dicom_%04d.dcm' % (folder, frame_name, get_tag(os.path.join(path,dcmfile),'InstanceNumber'))
+    def place(h):
+        dcmfile, instance_number, _, frame_time = h
+        if do_split:
+            if frame_time is None:
+                raise ValueError(f'{dcmfile} has no FrameReferenceTime, can not split the time-points')
+            frame_folder = os.path.join(folder, 'frame_%010d' % int(frame_time))
+            os.makedirs(frame_folder, exist_ok=True)
+            fname = '%s/dicom_%04d.dcm' % (frame_folder, instance_number)
         else:
-            fname = '%s/dicom_%04d.dcm' % (folder, get_tag(os.path.join(path,dcmfile),'InstanceNumber'))
+            fname = '%s/dicom_%04d.dcm' % (folder, instance_number)
+        _link_or_copy(dcmfile, fname, link=link)
 
-        copyfile(os.path.join(path,dcmfile), fname)
+    _parallel_map(place, headers, workers)
 
 
 def _get_fastest_dim(lst):
@@ -461,7 +944,7 @@ def _get_fastest_dim(lst):
                               map(list, zip(*[value for value in lst])))))
 
 
-def get_sort_files_dict(path, reduce_if_only_one=True):
+def get_sort_files_dict(path, reduce_if_only_one=True, workers: int=None, exclude: Union[str, Path]=None):
     """ Run through all files in a directory and return a dict of files sorted
         by their ImagePositionPatient coordinate. Multiple scans will have
         multiple keys in dict.
@@ -470,6 +953,10 @@ def get_sort_files_dict(path, reduce_if_only_one=True):
     ----------
     path : string, Path
         Path to the dicom files
+    workers : int, optional
+        Number of threads used to read the headers. Default is number of cores.
+    exclude : string, Path, optional
+        Folder within path to skip, e.g. a SeriesCache directory
 
     Returns
         dict{ SeriesInstanceUID: dict{ ind: path_to_file } }
@@ -480,13 +967,22 @@ def get_sort_files_dict(path, reduce_if_only_one=True):
     if isinstance(path, str):
         path = Path(path)
 
-    for p in path.rglob('*'):
-        if p.name.startswith('.'):
-            continue
-        if not p.is_file():
-            continue
+    files = [p for p in path.rglob('*') if not p.name.startswith('.') and p.is_file()]
+    if exclude is not None:
+        exclude = Path(exclude).resolve()
+        files = [p for p in files if exclude not in p.resolve().parents]
+
+    def read(p):
+        try:
+            return dcmread(str(p), stop_before_pixels=True,
+                           specific_tags=['ImagePositionPatient', 'SeriesInstanceUID'])
+        except Exception as e:
+            return e
+
+    for p, ds in zip(files, _parallel_map(read, files, workers)):
         try:
-            ds = dcmread(str(p))
+            if isinstance(ds, Exception):
+                raise ds
             image_position = '_'.join([str(IPP) for IPP in
                                        ds.ImagePositionPatient])
             if ds.SeriesInstanceUID not in path_dict:
@@ -522,6 +1018,285 @@ def get_sort_files_dict(path, reduce_if_only_one=True):
     return sorted_dict
 
 
+def get_sort_files_dict_4D(path, workers: int=None):
+    """ Sort the files of a dynamic (4D) series, e.g. a dynamic PET, by time
+        frame and ImagePositionPatient coordinate.
+
+        All frames share the same positions, so get_sort_files_dict can not be
+        used. Frames are ordered by FrameReferenceTime, or by ImageIndex
+        (InstanceNumber if missing) when FrameReferenceTime is not set.
+
+    Parameters
+    ----------
+    path : string, Path
+        Path to the dicom files of a single series
+    workers : int, optional
+        Number of threads used to read the headers. Default is number of cores.
+
+    Returns
+        dict{ frame*NumberOfSlices + ind: path_to_file }
+    """
+    if isinstance(path, str):
+        path = Path(path)
+
+    files = [p for p in path.rglob('*') if not p.name.startswith('.') and p.is_file()]
+    tags = ['ImagePositionPatient', 'NumberOfSlices', 'FrameReferenceTime', 'ImageIndex', 'InstanceNumber']
+    headers = _parallel_map(lambda p: _read_header(p, specific_tags=tags), files, workers)
+    files, headers = zip(*[(p, ds) for p, ds in zip(files, headers) if 'ImagePositionPatient' in ds])
+
+    num_slices = int(headers[0].NumberOfSlices)
+    if all('FrameReferenceTime' in ds for ds in headers):
+        frame_keys = [float(ds.FrameReferenceTime) for ds in headers]
+    else:
+        frame_keys = [(int(ds.get('ImageIndex', ds.InstanceNumber))-1) // num_slices for ds in headers]
+    frame_index = {key: frame for frame, key in enumerate(sorted(set(frame_keys)))}
+
+    slice_dimension = _get_fastest_dim([ds.ImagePositionPatient for ds in headers])
+    frames = {}
+    for p, ds, key in zip(files, headers, frame_keys):
+        frames.setdefault(frame_index[key], []).append((float(ds.ImagePositionPatient[slice_dimension]), p))
+
+    sorted_dict = {}
+    for frame, positions in frames.items():
+        if len(positions) != num_slices:
+            raise ValueError(f"Frame {frame} has {len(positions)} files, expected NumberOfSlices={num_slices}")
+        for ind, (_, p) in enumerate(sorted(positions)):
+            sorted_dict[frame*num_slices + ind] = p
+    return dict(sorted(sorted_dict.items()))
+
+
+def get_affine_from_headers(first: dicom.dataset.Dataset, last: dicom.dataset.Dataset, num_slices: int) -> np.ndarray:
+    """ Affine mapping voxel index (slice, row, column) to patient coordinates (mm, DICOM LPS)
+
+    Parameters
+    ----------
+    first : pydicom Dataset
+        Header of the first slice in the sorted series
+    last : pydicom Dataset
+        Header of the last slice in the sorted series
+    num_slices : int
+        Number of slices in the series
+    """
+    IOP = np.array(first.ImageOrientationPatient, dtype=np.float64)
+    PS = np.array(first.PixelSpacing, dtype=np.float64)
+    IPP = np.array(first.ImagePositionPatient, dtype=np.float64)
+    IPP2 = np.array(last.ImagePositionPatient, dtype=np.float64)
+
+    M = np.eye(4)
+    if num_slices > 1:
+        M[:3, 0] = (IPP2 - IPP) / (num_slices - 1)
+    else:
+        M[:3, 0] = np.cross(IOP[:3], IOP[3:]) * float(first.get('SliceThickness', 1) or 1)
+    M[:3, 1] = IOP[3:] * PS[0]  # Row index moves along the column direction cosine
+    M[:3, 2] = IOP[:3] * PS[1]  # Column index moves along the row direction cosine
+    M[:3, 3] = IPP
+    return M
+
+
+def load_series(path: Union[str, Path], dtype=np.float32, workers: int=None,
+                mmap_file: Union[str, Path]=None) -> Tuple[np.ndarray, np.ndarray]:
+    """ Load a DICOM series into a 3D numpy array
+
+    The slices are sorted by ImagePositionPatient, decoded in parallel into a
+    preallocated volume and RescaleSlope/RescaleIntercept (which can differ
+    per slice, e.g. for PET) are applied in one vectorized step.
+
+    Parameters
+    ----------
+    path : str or Path
+        Folder containing a single dicom series
+    dtype : numpy dtype, optional
+        Type of the returned volume. Default is np.float32
+    workers : int, optional
+        Number of threads used to read and decode. Default is number of cores.
+    mmap_file : str or Path, optional
+        If set, the volume is written to this .npy file and returned as a
+        memory-mapped array. Use for volumes larger than RAM.
+
+    Returns
+    -------
+    volume : np.ndarray
+        Array of shape (slices, rows, columns)
+    affine : np.ndarray
+        4x4 matrix mapping (slice, row, column) to patient coordinates, see get_affine_from_headers
+
+    Examples
+    --------
+    >>> from rhscripts.dcm import load_series
+    >>> volume, affine = load_series('PET')
+    """
+    return _load_series_files(_series_files(path, workers=workers), dtype=dtype, workers=workers, mmap_file=mmap_file)
+
+
+def _series_files(path: Union[str, Path], workers: int=None, exclude: Union[str, Path]=None) -> list:
+    """ Files of the single dicom series in path, sorted by ImagePositionPatient. Other files are skipped """
+    dcm_slices = get_sort_files_dict(path, workers=workers, exclude=exclude)
+    if len(dcm_slices) == 0:
+        raise ValueError(f"No dicom files found in {path}")
+    if isinstance(next(iter(dcm_slices.values())), dict):
+        raise ValueError(f"Found {len(dcm_slices)} series in {path}. load_series expects a single series.")
+    return [dcm_slices[i] for i in range(len(dcm_slices))]
+
+
+def _load_series_files(files: list, dtype=np.float32, workers: int=None,
+                       mmap_file: Union[str, Path]=None) -> Tuple[np.ndarray, np.ndarray]:
+    """ Decode the sorted files of a series into a volume, see load_series """
+    first = _read_header(files[0])
+    last = _read_header(files[-1])
+    shape = (len(files), int(first.Rows), int(first.Columns))
+
+    if mmap_file is not None:
+        volume = np.lib.format.open_memmap(str(mmap_file), mode='w+', dtype=dtype, shape=shape)
+    else:
+        volume = np.empty(shape, dtype=dtype)
+    slopes = np.ones(len(files), dtype=np.float64)
+    intercepts = np.zeros(len(files), dtype=np.float64)
+
+    def decode(i):
+        ds = dcmread(str(files[i]))
+        volume[i] = ds.pixel_array
+        slopes[i] = float(ds.get('RescaleSlope', 1))
+        intercepts[i] = float(ds.get('RescaleIntercept', 0))
+
+    _parallel_map(decode, range(len(files)), workers)
+
+    # Apply rescale in one vectorized step, skipping no-op parts
+    scale_dtype = volume.dtype if volume.dtype.kind == 'f' else np.float64
+    if not np.all(slopes == 1):
+        np.multiply(volume, slopes.astype(scale_dtype)[:, None, None], out=volume, casting='unsafe')
+    if not np.all(intercepts == 0):
+        np.add(volume, intercepts.astype(scale_dtype)[:, None, None], out=volume, casting='unsafe')
+
+    return volume, get_affine_from_headers(first, last, len(files))
+
+
+class SeriesCache:
+    """
+    Cache of decoded DICOM series as memory-mappable .npy files
+
+    The first load of a series decodes it with load_series and writes the
+    volume to <cache_dir>/<key>.npy with a JSON sidecar holding the affine,
+    a few key headers and the fingerprint of the source files. Later loads
+    open the .npy with np.load(mmap_mode='r'). The key is made from the
+    SeriesInstanceUID and the fingerprint (names, sizes and modification
+    times) of the source files, so changed files give a new cache entry.
+    The least recently used entries are removed when the cache grows
+    beyond max_size_gb.
+
+    from rhscripts.dcm import SeriesCache
+    cache = SeriesCache('/data/cache', max_size_gb=50)
+    volume, affine = cache.load('PET')
+    """
+
+    def __init__( self, cache_dir: Union[str, Path], max_size_gb: float=None, workers: int=None ):
+        """
+        Parameters
+        ----------
+        cache_dir : str or Path
+            Folder to store the cached volumes in. Will be created if it doesnt exist.
+        max_size_gb : float, optional
+            Maximum total size of the cached volumes. The default is None (no limit).
+        workers : int, optional
+            Number of threads used by load_series. Default is number of cores.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_gb = max_size_gb
+        self.workers = workers
+
+    def load( self, path: Union[str, Path], dtype=np.float32 ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Load a series through the cache. Returns (read-only memory-mapped volume, affine), see load_series
+
+        Only the files of the series are used for the key, so other files in
+        the folder (and the cache directory, if placed inside it) are ignored.
+        """
+        files = _series_files(path, workers=self.workers, exclude=self.cache_dir)
+        fingerprint = self.fingerprint(path, files)
+        header = _read_header(files[0], specific_tags=['SeriesInstanceUID'])
+        key = '{}_{}_{}'.format(header.SeriesInstanceUID, fingerprint[:16], np.dtype(dtype).name)
+        npy_file = self.cache_dir.joinpath(key + '.npy')
+        json_file = self.cache_dir.joinpath(key + '.json')
+
+        if npy_file.exists() and json_file.exists():
+            with open(json_file) as f:
+                info = json.load(f)
+            # Mark as recently used
+            os.utime(json_file)
+            return np.load(str(npy_file), mmap_mode='r'), np.array(info['affine'])
+
+        # Write to temporary files first, so concurrent jobs and threads never see a half written entry
+        tmp_name = '{}.{}.{}.tmp'.format(key, os.getpid(), threading.get_ident())
+        tmp_file = self.cache_dir.joinpath(tmp_name + '.npy')
+        volume, affine = _load_series_files(files, dtype=dtype, workers=self.workers, mmap_file=tmp_file)
+        volume.flush()
+        del volume
+
+        first = _read_header(files[0])
+        info = {
+            'SeriesInstanceUID': str(first.SeriesInstanceUID),
+            'Modality': str(first.get('Modality', '')),
+            'PatientID': str(first.get('PatientID', '')),
+            'SeriesDescription': str(first.get('SeriesDescription', '')),
+            'source': str(Path(path).absolute()),
+            'fingerprint': fingerprint,
+            'dtype': np.dtype(dtype).name,
+            'affine': affine.tolist()
+        }
+        tmp_json = self.cache_dir.joinpath(tmp_name + '.json')
+        with open(tmp_json, 'w') as f:
+            json.dump(info, f, indent=2)
+        os.replace(tmp_file, npy_file)
+        os.replace(tmp_json, json_file)
+
+        self.evict(keep=json_file)
+        return np.load(str(npy_file), mmap_mode='r'), affine
+
+    @staticmethod
+    def fingerprint( path: Union[str, Path], files: list ) -> str:
+        """ Hash of the relative names, sizes and modification times of the files, not of their content """
+        h = hashlib.sha1()
+        for p in files:
+            st = p.stat()
+            h.update('{}:{}:{};'.format(p.relative_to(path), st.st_size, st.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def size_gb( self ) -> float:
+        """ Total size of the cached volumes """
+        return sum(p.stat().st_size for p in self.cache_dir.glob('*.npy')) / 1024**3
+
+    def evict( self, keep: Path=None ):
+        """ Remove least recently used entries until the cache is below max_size_gb
+
+        The entry with the sidecar keep (default the most recently used) is never removed.
+        """
+        if self.max_size_gb is None:
+            return
+        entries = []
+        for json_file in self.cache_dir.glob('*.json'):
+            if '.tmp.' in json_file.name:
+                continue
+            npy_file = json_file.with_suffix('.npy')
+            if npy_file.exists():
+                entries.append((json_file.stat().st_mtime, npy_file.stat().st_size, npy_file, json_file))
+        total = sum(e[1] for e in entries)
+        entries = sorted(entries)
+        if keep is None:
+            entries = entries[:-1]
+        else:
+            entries = [e for e in entries if e[3] != Path(keep)]
+        for _, size, npy_file, json_file in entries:
+            if total <= self.max_size_gb * 1024**3:
+                break
+            npy_file.unlink()
+            json_file.unlink()
+            total -= size
+
+    def clear( self ):
+        """ Remove all cached entries """
+        for p in list(self.cache_dir.glob('*.npy')) + list(self.cache_dir.glob('*.json')):
+            p.unlink()
+
+
 def send_data(folder, server=None, checkForEndings=True):
     """Send a dicom dataset to a dicom node
 
@@ -573,7 +1348,67 @@ def send_data(folder, server=None, checkForEndings=True):
 
         os.system(cmd)
 
-def replace_container(in_folder: str, container: str, out_folder: str, SeriesNumber: int=None, SeriesDescription: str=None):
+def _index_instance_numbers(folder: Union[str, Path], workers: int=None) -> Dict[int, Path]:
+    """ Return dict with key=InstanceNumber val=Path-object using header-only reads """
+    files = [d for d in Path(folder).iterdir() if not d.name.startswith('.') and d.is_file()]
+    numbers = _parallel_map(lambda d: int(_read_header(d, specific_tags=['InstanceNumber']).InstanceNumber), files, workers)
+    return dict(zip(numbers, files))
+
+
+def patch_series(folder: Union[str, Path], out_folder: Union[str, Path], tag_updates: dict, workers: int=None):
+    """ Change header tags on every file of a series without re-encoding the PixelData
+
+    Each file is streamed: the header is read and written again with the
+    updates, the PixelData bytes are copied verbatim and any elements after
+    PixelData are kept. Files that are not dicom are skipped.
+
+    Parameters
+    ----------
+    folder : str or Path
+        Folder with the dicom files, subfolders included
+    out_folder : str or Path
+        Output folder, files keep their name and relative path. If None or
+        the same as folder, the files are patched in place. Each file is
+        then replaced, so hardlinks to it (see sort_files) keep the original.
+    tag_updates : dict
+        { keyword or tag: value }. The value can be a function taking the
+        header dataset of the file and returning the value, e.g. for UIDs
+        that must be unique per file. A value of None removes the tag.
+    workers : int, optional
+        Number of threads used to patch the files. Default is number of cores.
+
+    Examples
+    --------
+    >>> from rhscripts.dcm import patch_series, generate_SeriesInstanceUID, generate_SOPInstanceUID
+    >>> patch_series('PET', 'PET_new', {'SeriesDescription': 'PET_new', 'SeriesNumber': 601,
+    ...                                 'SeriesInstanceUID': generate_SeriesInstanceUID(),
+    ...                                 'SOPInstanceUID': lambda ds: generate_SOPInstanceUID(ds.InstanceNumber)})
+    """
+    folder = Path(folder)
+    out_folder = folder if out_folder is None else Path(out_folder)
+    files = [p for p in folder.rglob('*') if not p.name.startswith('.') and p.is_file()]
+
+    def patch(p):
+        try:
+            header, offset = _read_header_and_offset(p, force=True)
+            if 'SOPClassUID' not in header and 'SOPInstanceUID' not in header:
+                raise InvalidDicomError("No SOP Class or Instance UID")
+        except Exception as e:
+            print(f"Skipping {p}. Not dicom?. Got error: {e}")
+            return
+        sop_instance_uid = header.get('SOPInstanceUID')
+        _apply_tag_updates(header, tag_updates)
+        if header.get('SOPInstanceUID') != sop_instance_uid and 'MediaStorageSOPInstanceUID' in header.file_meta:
+            header.file_meta.MediaStorageSOPInstanceUID = header.SOPInstanceUID
+        dst = out_folder.joinpath(p.relative_to(folder))
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        _patch_file(header, p, offset, dst, trailing=lambda ds: ds)
+
+    _parallel_map(patch, files, workers)
+
+
+def replace_container(in_folder: str, container: str, out_folder: str, SeriesNumber: int=None, SeriesDescription: str=None,
+                      workers: int=None, compress: bool=False):
     """
 
     Parameters
@@ -589,46 +1424,169 @@ def replace_container(in_folder: str, container: str, out_folder: str, SeriesNum
         Overwrite the number of the series. The default is None.
     SeriesDescription : str, optional
         Overwrite the name of the series. The default is None.
+    workers : int, optional
+        Number of threads used to process the slices. Default is number of cores.
+    compress : bool, optional
+        Encode PixelData as RLE Lossless. The default is False.
 
     """
+    replace_container_batch(in_folders=[in_folder], container=container, out_folders=[out_folder],
+                            SeriesNumbers=[SeriesNumber], SeriesDescriptions=[SeriesDescription],
+                            workers=workers, compress=compress)
+
+
+def replace_container_batch(in_folders: list, container: str, out_folders: list, SeriesNumbers: list=None,
+                            SeriesDescriptions: list=None, workers: int=None, compress: bool=False):
+    """ Apply replace_container to many input folders, parsing the container only once
 
-    def sort_files(p):
-        return {dcmread(str(d)).InstanceNumber : d for d in Path(p).iterdir() if not d.name.startswith('.') }
+    Parameters
+    ----------
+    in_folders : list of str
+        Paths to folders with files containing PixelData that should be kept.
+    container : str
+        Path to folder with files that should be used as container.
+    out_folders : list of str
+        Folder to store resulting output, one for each in_folder.
+    SeriesNumbers : list of int, optional
+        Overwrite the number of each series. The default is None.
+    SeriesDescriptions : list of str, optional
+        Overwrite the name of each series. The default is None.
+    workers : int, optional
+        Number of threads used to process the slices. Default is number of cores.
+    compress : bool, optional
+        Encode PixelData as RLE Lossless. The default is False.
 
-    # Get dictionary with key=InstanceNumber val=Path-object for the file
-    d_new = sort_files(in_folder)
-    d_container = sort_files(container)
+    """
+    if len(in_folders) != len(out_folders):
+        raise ValueError("in_folders and out_folders must have the same length")
+    SeriesNumbers = SeriesNumbers if SeriesNumbers is not None else [None]*len(in_folders)
+    SeriesDescriptions = SeriesDescriptions if SeriesDescriptions is not None else [None]*len(in_folders)
+
+    # Parse the headers of the container once. PixelData is replaced anyway.
+    d_container = _index_instance_numbers(container, workers)
+    container_headers = dict(zip(d_container.keys(),
+                                 _parallel_map(lambda d: dcmread(str(d), stop_before_pixels=True), d_container.values(), workers)))
+
+    for in_folder, out_folder, SeriesNumber, SeriesDescription in zip(in_folders, out_folders, SeriesNumbers, SeriesDescriptions):
+
+        # Get dictionary with key=InstanceNumber val=Path-object for the file
+        d_new = _index_instance_numbers(in_folder, workers)
+
+        # Create output folder
+        Path(out_folder).mkdir(exist_ok=True,parents=True)
+
+        seriesInstanceUID = generate_SeriesInstanceUID()
+
+        # Check start of instance numbers
+        assert min(d_new.keys()) == min(d_container.keys())
+        assert max(d_new.keys()) == max(d_container.keys())
+        assert len(d_new) == len(d_container)
+
+        def replace_slice(i):
+            ds_container = copy.deepcopy(container_headers[i])
+            ds_container.SeriesInstanceUID = seriesInstanceUID
+            ds_container.SOPInstanceUID = generate_SOPInstanceUID( i )
+
+            if SeriesDescription is not None: ds_container.SeriesDescription = SeriesDescription
+            if SeriesNumber is not None: ds_container.SeriesNumber = SeriesNumber
+
+            if not compress:
+                # Encode the container header like the new file and copy its PixelData bytes as is
+                ds_new, offset = _read_header_and_offset(d_new[i])
+                ds_container.file_meta.TransferSyntaxUID = ds_new.file_meta.TransferSyntaxUID
+                ds_container.is_implicit_VR = ds_new.is_implicit_VR
+                ds_container.is_little_endian = ds_new.is_little_endian
+                _patch_file(ds_container, d_new[i], offset, f'{out_folder}/dicom_{i:04d}.dcm')
+                return
 
-    # Create output folder
-    Path(out_folder).mkdir(exist_ok=True,parents=True)
+            ds_new = dcmread(str(d_new[i]), specific_tags=['PixelData'])
+            ds_container[0x7fe0, 0x0010] = ds_new[0x7fe0, 0x0010]
 
-    seriesInstanceUID = generate_SeriesInstanceUID()
+            # The PixelData is encoded with the transfer syntax of the new file
+            syntax = ds_new.file_meta.TransferSyntaxUID
+            if syntax != ds_container.file_meta.TransferSyntaxUID:
+                if syntax.is_compressed:
+                    ds_container.file_meta.TransferSyntaxUID = syntax
+                    ds_container.is_implicit_VR = False
+                elif ds_container.file_meta.TransferSyntaxUID.is_compressed:
+                    ds_container.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                    ds_container.is_implicit_VR = False
+            if ds_container.file_meta.TransferSyntaxUID != RLELossless:
+                _rle_compress_dataset(ds_container)
 
-    # For each slice
-    # Check start of instance numbers
-    assert min(d_new.keys()) == min(d_container.keys())
-    assert max(d_new.keys()) == max(d_container.keys())
-    assert len(d_new) == len(d_container)
-    for i in d_new.keys():
+            ds_container.save_as(f'{out_folder}/dicom_{i:04d}.dcm')
 
-        ds_container=dcmread(str(d_container[i]))
-        ds_new=dcmread(str(d_new[i]))
+        _parallel_map(replace_slice, d_new.keys(), workers)
 
-        ds_container.PixelData = ds_new.PixelData
+_RTX_REFERENCE_KEYWORDS = ['PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'StudyInstanceUID',
+                           'StudyDate', 'StudyTime', 'ReferringPhysicianName', 'StudyID', 'AccessionNumber',
+                           'StudyDescription', 'ReferencedStudySequence', 'Modality', 'SeriesInstanceUID',
+                           'FrameOfReferenceUID', 'ImageOrientationPatient', 'PixelSpacing']
 
-        ds_container.SeriesInstanceUID = seriesInstanceUID
-        ds_container.SOPInstanceUID = generate_SOPInstanceUID( i )
 
-        if SeriesDescription is not None: ds_container.SeriesDescription = SeriesDescription
-        if SeriesNumber is not None: ds_container.SeriesNumber = SeriesNumber
+def _index_rtx_container(folder: Union[str, Path], workers: int=None,
+                         index_file: Union[str, Path]=None) -> Tuple[dicom.dataset.Dataset, Dict[int, tuple]]:
+    """ Reference table of a dicom container for to_rtx from one header-only pass
+
+    Returns the header of the first slice, reduced to the tags to_rtx uses, and
+    { InstanceNumber: (SOPInstanceUID, SeriesInstanceUID, ImagePositionPatient) }.
+    With index_file the result is stored as json and reused while the
+    fingerprint of the container files is unchanged.
+    """
+    files = sorted(p for p in Path(folder).iterdir() if not p.name.startswith('.') and p.is_file())
+    fingerprint = SeriesCache.fingerprint(folder, files) if index_file is not None else None
+    if index_file is not None and Path(index_file).exists():
+        with open(index_file) as f:
+            index = json.load(f)
+        if index['fingerprint'] == fingerprint:
+            return (dicom.dataset.Dataset.from_json(index['header']),
+                    {int(k): (sop_uid, series_uid, np.array(position)) for k, (sop_uid, series_uid, position) in index['instances'].items()})
+
+    def read(p):
+        ds = _read_header(p)
+        return ds, (str(ds.SOPInstanceUID), str(ds.SeriesInstanceUID), np.array(ds.ImagePositionPatient, dtype=np.float64))
+
+    headers = dict((int(ds.InstanceNumber), (ds, ref)) for ds, ref in _parallel_map(read, files, workers))
+    first = headers[1][0] if 1 in headers else headers[min(headers)][0]
+    header = dicom.dataset.Dataset()
+    for keyword in _RTX_REFERENCE_KEYWORDS:
+        if keyword in first:
+            header[keyword] = first[keyword]
+    instances = {n: ref for n, (_, ref) in headers.items()}
+
+    if index_file is not None:
+        with open(index_file, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'header': header.to_json_dict(),
+                       'instances': {n: (sop_uid, series_uid, position.tolist()) for n, (sop_uid, series_uid, position) in instances.items()}}, f)
+    return header, instances
+
+
+def _encode_DS(tag: int, values: np.ndarray, decimals: int=6) -> dicom.dataelem.RawDataElement:
+    """ Encode an array as a multi-valued DS element in one string operation
+
+    Values are written with a fixed number of decimals, reduced where
+    needed to keep every value within the 16 bytes allowed for DS.
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    integer_digits = len(str(int(np.abs(values).max()))) if len(values) else 1
+    decimals = max(0, min(decimals, 16 - 2 - integer_digits)) # Room for sign and decimal point
+    value = '\\'.join([f'%.{decimals}f']*len(values)) % tuple(values.tolist())
+    value = value.encode('ascii')
+    if len(value) % 2:
+        value += b' '
+    return dicom.dataelem.RawDataElement(dicom.tag.Tag(tag), 'DS', len(value), value, 0, True, True)
 
-        ds_container.save_as(f'{out_folder}/dicom_{i:04d}.dcm')
 
 def to_rtx(np_roi: np.ndarray,
            dcmcontainer: str,
            out_folder: str,
            out_filename: str,
-           verbose: bool=False):
+           verbose: bool=False,
+           roi_map: dict=None,
+           workers: int=None,
+           index_file: Union[str, Path]=None,
+           simplify: float=None,
+           precision: int=6) -> Dict[int, Tuple[int,int]]:
 
     """Convert label numpy array to RT struct dicom file
 
@@ -644,154 +1602,89 @@ def to_rtx(np_roi: np.ndarray,
         Name of the output dicom file
     verbose : boolean, optional
         Verbosity of function
+    roi_map : dict, optional
+        Name and color of the ROIs as { label: name } or { label: (name, (r,g,b)) }.
+        Labels not in the map are named ROI_<label> and colored red.
+    workers : int, optional
+        Number of threads used to read the container and contour the labels. Default is number of cores.
+    index_file : str or Path, optional
+        Json file caching the container headers used by to_rtx. It is reused while the
+        container files are unchanged and rewritten otherwise. The default is None (no cache).
+    simplify : float, optional
+        Simplify the contours (Douglas-Peucker) so no point of the original contour is further than
+        this distance in mm from the simplified one. The default is None (keep all points).
+    precision : int, optional
+        Number of decimals of the contour coordinates. The default is 6.
+
+    Returns
+    -------
+    dict
+        { label: (number of contour points found, number of contour points written) }
+
+    Examples
+    --------
+    >>> from rhscripts.dcm import to_rtx
+    >>> to_rtx(seg, 'CT', 'out', 'organs', roi_map={1: ('liver', (150, 75, 0)), 2: 'spleen'}, simplify=0.5, precision=2)
     """
 
     from pydicom.sequence import Sequence
     from pydicom.dataset import Dataset, FileDataset
-    from decimal import Decimal, getcontext
-    getcontext().prec = 7
-
-    # Create affine transformation matrix:
-    def get_affine_transform(first_scan_path,last_scan_path,series_length):
-        # Load headers.
-        dicom_header_first = dicom.dcmread(first_scan_path)
-        dicom_header_last = dicom.dcmread(last_scan_path)
-
-        # Extract header info.
-        IOP = dicom_header_first.ImageOrientationPatient # Orientation is the same for all slices.
-        IOP = [float(i) for i in IOP]
-
-        IPP = dicom_header_first.ImagePositionPatient # Position of first slice.
-        IPP = [float(i) for i in IPP]
-
-        IPP2 = dicom_header_last.ImagePositionPatient # Position of last slice.
-        IPP2 = [float(i) for i in IPP2]
-
-        PS = dicom_header_first.PixelSpacing # Pixel Spacing is the same for all slices.
-        PS = [float(i) for i in PS]
 
-        # Creat empty matrix M.
-        M = np.zeros([4,4])
-
-        # Fill first column. Direction and Spacing for X coordinate.
-        M[0,0]=IOP[0]*PS[0]
-        M[1,0]=IOP[1]*PS[0]
-        M[2,0]=IOP[2]*PS[0]
-
-        # Fill second column. Direction and Spacing for Y coordinate.
-        M[0,1]=IOP[3]*PS[1]
-        M[1,1]=IOP[4]*PS[1]
-        M[2,1]=IOP[5]*PS[1]
-
-        # Fill third column. Direction and Spacing for Z coordinate.
-        M[0,2]=(IPP[0]-IPP2[0])/(1-series_length)
-        M[1,2]=(IPP[1]-IPP2[1])/(1-series_length)
-        M[2,2]=(IPP[2]-IPP2[2])/(1-series_length)
-
-        # Fill fourth column. Coordinate shift.
-        M[0,3]=IPP[0]
-        M[1,3]=IPP[1]
-        M[2,3]=IPP[2]
-        M[3,3]=1
+    # Create in-plane affine transformation matrix. Each slice is placed at its own ImagePositionPatient.
+    def get_affine_transform(dicom_header_first):
+        IOP = np.array(dicom_header_first.ImageOrientationPatient, dtype=np.float64) # Orientation is the same for all slices.
+        PS = np.array(dicom_header_first.PixelSpacing, dtype=np.float64) # Pixel Spacing is the same for all slices.
 
+        M = np.eye(4)
+        M[:3,0] = IOP[:3]*PS[1] # Direction and spacing for the column index (X coordinate).
+        M[:3,1] = IOP[3:]*PS[0] # Direction and spacing for the row index (Y coordinate).
         return M
 
-    # Mask --> Polyline transform.
-    def get_polylines(mask,affine_transform_matrix,series_length):
-        # Create empty list to fill with contours.
-        polylines = []
-        for i in range(series_length): # Create a list space for each input slice. There are probably better ways to do this!
-            polylines.append([])
-
-        # Extract contours from mask and save as polylines.
-        for i in range(series_length):
-            contours, hierarchy = cv2.findContours(mask[:,:,i], cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE) # Convert masks to contours.
-            for contour in contours: # Loop through contours.
-                contour_list = np.ndarray.tolist(contour) # Convert numpy array to list.
-                polyline = list() # Create empty polyline container.
-                for triplet in contour_list: # Loop through contour coordinate triplets.
-                    triplet = triplet[0] # Modify list structure.
-                    triplet.append(i+1) # Add Z dimension.
-                    triplet.append(1) # Add fourth dimension for matrix multiplication.
-                    triplet = list(np.matmul(affine_transform_matrix,triplet)) # Multiply coordinate with affine transform matrix.
-                    triplet.pop() # Remove fourth dimension.
-                    for coord in triplet: # Loop through single coordinates.
-                        polyline.append(str(coord)) # Convert each number to string format for dicom header.
-                polylines[i].append(polyline) # Save polyline.
-        return polylines
-
-
-    # Define filter function for incoming image series:
-    def checkEqual(lst):
-       return lst[1:] == lst[:-1]
+    # Mask --> Polyline transform, only for the slices within the bounding box of the label.
+    def get_polylines(label,bbox,affine_transform_matrix):
+        # Grow the box by one pixel so the contours are the same as found on the full slice.
+        rows, cols, slices = [slice(max(s.start-1, 0), s.stop+1) for s in bbox[:2]] + [bbox[2]]
+        mask = np.ascontiguousarray(np.moveaxis(np_roi[rows, cols, slices] == label, 2, 0), dtype=np.uint8)
+
+        # One list of (N,3) world coordinate arrays for each slice with the label, and the number of points found.
+        polylines = {}
+        num_points = 0
+
+        # Extract contours from mask and transform all points of a contour with one matrix product.
+        for k in range(len(mask)):
+            i = slices.start + k
+            contours, hierarchy = cv2.findContours(mask[k], cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE,
+                                                   offset=(cols.start, rows.start)) # Convert masks to contours.
+            for contour in contours:
+                num_points += len(contour)
+                if simplify_pixels and len(contour) > 3:
+                    simplified = cv2.approxPolyDP(contour, simplify_pixels, True)
+                    contour = simplified if len(simplified) >= 3 else contour
+                # Column and row index to the position of the slice.
+                polylines.setdefault(i, []).append(contour[:,0,:] @ affine_transform_matrix[:3,:2].T + positions[i])
+        return polylines, num_points
 
     # Define function for expanding point and line delineations:
-    def expand_polyline(poly_input,M):
-
-        input_length = len(poly_input)
-        x_shift = Decimal((M[0][0])/2)
-        y_shift = Decimal((M[1][1])/2)
-
-        poly_input = [Decimal(item) for item in poly_input]
-
-        expanded_poly = list()
-
-        # Expand point delineations:
-        if input_length == 3:
-            expanded_poly.append([str(poly_input[0]+x_shift),str(poly_input[1]+y_shift),str(poly_input[2])])
-            expanded_poly.append([str(poly_input[0]+x_shift),str(poly_input[1]-y_shift),str(poly_input[2])])
-            expanded_poly.append([str(poly_input[0]-x_shift),str(poly_input[1]+y_shift),str(poly_input[2])])
-            expanded_poly.append([str(poly_input[0]-x_shift),str(poly_input[1]-y_shift),str(poly_input[2])])
-
-            expanded_poly = [list(i) for i in set(map(tuple, expanded_poly))] # Remove duplicated triplets.
-
-        # Expand line delineations:
-        if input_length == 6:
-            expanded_poly.append([str(poly_input[0]+x_shift),str(poly_input[1]+y_shift),str(poly_input[2])])
-            expanded_poly.append([str(poly_input[0]+x_shift),str(poly_input[1]-y_shift),str(poly_input[2])])
-            expanded_poly.append([str(poly_input[0]-x_shift),str(poly_input[1]+y_shift),str(poly_input[2])])
-            expanded_poly.append([str(poly_input[0]-x_shift),str(poly_input[1]-y_shift),str(poly_input[2])])
-
-            expanded_poly.append([str(poly_input[3]+x_shift),str(poly_input[4]+y_shift),str(poly_input[5])])
-            expanded_poly.append([str(poly_input[3]+x_shift),str(poly_input[4]-y_shift),str(poly_input[5])])
-            expanded_poly.append([str(poly_input[3]-x_shift),str(poly_input[4]+y_shift),str(poly_input[5])])
-            expanded_poly.append([str(poly_input[3]-x_shift),str(poly_input[4]-y_shift),str(poly_input[5])])
-
-            expanded_poly = [list(i) for i in set(map(tuple, expanded_poly))] # Remove duplicated triplets.
-
-        polyline = list()
-        for item in expanded_poly:
-            polyline+=item
-
-        return polyline
-
-    # change path str to path object
-    if isinstance(dcmcontainer, str):
-        dcmcontainer = Path(dcmcontainer)
-
-    # gather the dicom slices from the container
-    dcm_list = [str(f) for f in dcmcontainer.iterdir() if not f.name.startswith('.') and f.is_file()]
-    ref_dict = dict() # Store dcm image SOP Instance UID's and file name for later use.
-    series_list = list() # For checking that all slices are from the same series.
-
-    # Fill out numpy matrix and reference dictionary.
-    for files in dcm_list:
-        dcm_slice = dcmread(files)
-        ref_dict[dcm_slice.InstanceNumber]=[dcm_slice.SOPInstanceUID,files]
-        series_list.append(dcm_slice.SeriesInstanceUID)
+    def expand_polyline(points,M):
+        # Add the corners of the pixel around each point and order them around the center.
+        shift = np.array([[1,1],[1,-1],[-1,-1],[-1,1]]) * [M[0][0]/2, M[1][1]/2]
+        expanded = np.repeat(points, len(shift), axis=0)
+        expanded[:,:2] += np.tile(shift, (len(points),1))
+        expanded = np.unique(expanded, axis=0) # Remove duplicated triplets.
+        offset = expanded[:,:2] - expanded[:,:2].mean(axis=0)
+        return expanded[np.argsort(np.arctan2(offset[:,1], offset[:,0]), kind='stable')]
+
+    # Reference table from one header-only pass over the container.
+    dicom_header_first, ref_dict = _index_rtx_container(dcmcontainer, workers=workers, index_file=index_file)
 
     # Check that all dicom images in the folder belong to the same series.
-    if checkEqual(series_list) == False:
+    if len({series_uid for _, series_uid, _ in ref_dict.values()}) > 1:
         import sys
         print("Error: All image slices must belong to the same series.")
         sys.exit()
 
-    # Get first and last image from dicom series.
-    first_scan_path = ref_dict[1][1]
-    last_scan_path = ref_dict[len(dcm_list)][1]
-
-    # Read dicom header from first file.
-    dicom_header_first = dicom.dcmread(first_scan_path)
+    # Position of each slice, sorted by InstanceNumber.
+    positions = np.array([ref_dict[i+1][2] for i in range(len(ref_dict))])
 
     # Get current time.
     time = datetime.datetime.now()
@@ -890,19 +1783,28 @@ def to_rtx(np_roi: np.ndarray,
     RTSTRUCT.ROIContourSequence = Sequence([Dataset()]) # (3006,0039)  ROI Contour Sequence
 
     # Get Affine Transform Matrix.
-    M=get_affine_transform(first_scan_path,last_scan_path,len(dcm_list))
+    M=get_affine_transform(dicom_header_first)
 
-    for i in range(int(np_roi.max())):
+    # Bounding box of each label, so only the slices a label occupies are contoured.
+    boxes = find_objects(np_roi if np.issubdtype(np_roi.dtype, np.integer) else np_roi.astype(np.int32))
+    boxes += [None] * (int(np_roi.max()) - len(boxes))
+    # Simplification tolerance in pixels of the smallest spacing.
+    simplify_pixels = simplify / np.linalg.norm(M[:3,:2], axis=0).min() if simplify else None
+    roi_polylines = _parallel_map(lambda i: get_polylines(i+1,boxes[i],M) if boxes[i] is not None else ({}, 0),
+                                  range(len(boxes)), workers)
 
-        ROI_expanded = (np_roi == i+1).astype('uint8')
+    roi_map = {} if roi_map is None else roi_map
+    report = {}
+    for i, (polylines, num_points) in enumerate(roi_polylines):
 
-        #polylines = get_polylines(ROI_expanded[:,:,:,i],M,len(dcm_list)) # Get polylines.
-        polylines = get_polylines(ROI_expanded,M,len(dcm_list)) # Get polylines.
+        name, color = roi_map.get(i+1, 'ROI_'+str(i+1)), (255, 0, 0)
+        if not isinstance(name, str):
+            name, color = name
 
         roi_set = Dataset()
         roi_set.ROINumber = str(i+1) # (3006,0022) ROI Number
         roi_set.ReferencedFrameOfReferenceUID = dicom_header_first.FrameOfReferenceUID # (3006,0024) Referenced Frame of Reference UID
-        roi_set.ROIName = 'ROI_'+str(i+1) # (3006,0026) ROI Name
+        roi_set.ROIName = name # (3006,0026) ROI Name
         roi_set.ROIGenerationAlgorithm = 'AUTOMATIC' # (3006,0036) ROI Generation Algorithm
         if i == 0:
             RTSTRUCT.StructureSetROISequence[0] = roi_set
@@ -910,7 +1812,7 @@ def to_rtx(np_roi: np.ndarray,
             RTSTRUCT.StructureSetROISequence.append(roi_set)
 
         contour = Dataset()
-        contour.ROIDisplayColor = ['255', '0', '0'] # (3006,002a) ROI Display Color
+        contour.ROIDisplayColor = [str(int(c)) for c in color] # (3006,002a) ROI Display Color
         contour.ReferencedROINumber = str(i+1) # (3006,0084) Referenced ROI Number
         contour.ContourSequence = Sequence([Dataset()]) # (3006,0040)  Contour Sequence
         if i == 0:
@@ -919,37 +1821,477 @@ def to_rtx(np_roi: np.ndarray,
             RTSTRUCT.ROIContourSequence.append(contour)
 
         contour_number = 1 # Initialize contour number.
-        for x in range(len(polylines)):
-            if polylines[x]:
-                for n in range(len(polylines[x])):
-                    poly = Dataset()
-                    poly.ContourImageSequence = Sequence([Dataset()]) # (3006,0016)  Contour Image Sequence
-                    poly.ContourImageSequence[0].ReferencedSOPClassUID = '1.2.840.10008.3.1.2.3.2' # (0008,1150) Referenced SOP Class UID
-                    poly.ContourImageSequence[0].ReferencedSOPInstanceUID = ref_dict[x+1][0] # (0008,1155) Referenced SOP Instance UID
-
-                    if len(polylines[x][n]) == 3 or len(polylines[x][n]) == 6: # Create additional triplets.
-                        polylines[x][n] = expand_polyline(polylines[x][n],M)
-
-                    poly.ContourGeometricType = 'CLOSED_PLANAR' # (3006,0042) Contour Geometric Type
-                    poly.NumberOfContourPoints = str(int(len(polylines[x][n])/3)) # (3006,0046) Number of Contour Points
-                    poly.ContourNumber = str(contour_number) # (3006,0048) Contour Number
-                    poly.ContourData = polylines[x][n] # (3006,0050) Contour Data
-
-                    if contour_number == 1:
-                        RTSTRUCT.ROIContourSequence[i].ContourSequence[0] = poly
-                    else:
-                        RTSTRUCT.ROIContourSequence[i].ContourSequence.append(poly)
-                    contour_number += 1 # Update contour number.
+        for x in sorted(polylines):
+            for n in range(len(polylines[x])):
+                poly = Dataset()
+                poly.ContourImageSequence = Sequence([Dataset()]) # (3006,0016)  Contour Image Sequence
+                poly.ContourImageSequence[0].ReferencedSOPClassUID = '1.2.840.10008.3.1.2.3.2' # (0008,1150) Referenced SOP Class UID
+                poly.ContourImageSequence[0].ReferencedSOPInstanceUID = ref_dict[x+1][0] # (0008,1155) Referenced SOP Instance UID
+
+                if len(polylines[x][n]) <= 2: # Create additional triplets.
+                    polylines[x][n] = expand_polyline(polylines[x][n],M)
+
+                poly.ContourGeometricType = 'CLOSED_PLANAR' # (3006,0042) Contour Geometric Type
+                poly.NumberOfContourPoints = str(len(polylines[x][n])) # (3006,0046) Number of Contour Points
+                poly.ContourNumber = str(contour_number) # (3006,0048) Contour Number
+                poly[0x3006, 0x0050] = _encode_DS(0x30060050, polylines[x][n], precision) # (3006,0050) Contour Data
+
+                if contour_number == 1:
+                    RTSTRUCT.ROIContourSequence[i].ContourSequence[0] = poly
+                else:
+                    RTSTRUCT.ROIContourSequence[i].ContourSequence.append(poly)
+                contour_number += 1 # Update contour number.
+
+        report[i+1] = (num_points, sum(len(p) for slice_polylines in polylines.values() for p in slice_polylines))
+        if verbose:
+            print(f"{name}: {report[i+1][0]} contour points, {report[i+1][1]} written")
 
     # Save RTSTRUCT file.
     out_path = Path(out_folder).joinpath(out_filename+".dcm")
     out_path.parent.mkdir(exist_ok=True,parents=True)
     dicom.filewriter.write_file(str(out_path), RTSTRUCT, write_like_original=False)
 
+    return report
+
+def _contour_data(contour: dicom.dataset.Dataset) -> np.ndarray:
+    """ ContourData of a contour as (N,3) array, parsed from the raw bytes when not yet converted by pydicom """
+    elem = contour.get_item(0x30060050)
+    if elem is None:
+        values = np.zeros(0)
+    elif isinstance(elem, dicom.dataelem.RawDataElement):
+        raw = elem.value.strip(b' \x00') if elem.value else b''
+        try:
+            values = np.array(raw.split(b'\\'), dtype=np.float64) if raw else np.zeros(0)
+        except ValueError:
+            # Padding or spaces within values, leave it to pydicom's DS conversion
+            values = np.array(contour.ContourData, dtype=np.float64)
+    else:
+        values = np.array(elem.value, dtype=np.float64)
+    return values.reshape((-1,3))
+
+
+def _contours_to_voxels(contours: list, fn_world_to_voxel: Union[Callable, np.ndarray],
+                        vectorized: bool=False) -> list:
+    """ Transform the ContourData of all contours to voxel coordinates in one step
+
+    The points are given to fn_world_to_voxel as [-x,-y,z]. fn_world_to_voxel
+    is either a 4x4 world-to-voxel matrix, a function of an (N,3) array of
+    points (vectorized=True) or a function of a single point.
+
+    Returns a list with an (N,3) array of voxel coordinates for each contour.
+    """
+    points = [_contour_data(contour) for contour in contours]
+    if len(points) == 0:
+        return []
+    world = np.concatenate(points) * [-1,-1,1]
+    if isinstance(fn_world_to_voxel, np.ndarray):
+        voxels = world @ fn_world_to_voxel[:3,:3].T + fn_world_to_voxel[:3,3]
+    elif vectorized:
+        voxels = np.asarray(fn_world_to_voxel(world), dtype=np.float64)
+    else:
+        voxels = np.array([fn_world_to_voxel(list(w)) for w in world], dtype=np.float64).reshape((-1,3))
+    return np.split(voxels, np.cumsum([len(p) for p in points])[:-1])
+
+
+def _polygon_mask(polygon: np.ndarray, shape: Tuple[int,int]) -> np.ndarray:
+    """ Mask of the voxels whose center is strictly inside a polygon (even-odd rule)
+
+    Same as cv2.pointPolygonTest(polygon, (column, row), False) > 0 for every
+    voxel, including the float32 arithmetic deciding if a center is on an
+    edge, but only rows within the bounding box of the polygon are tested,
+    each against the edges crossing it.
+
+    polygon holds (x,y) = (column,row) vertices.
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    v = np.asarray(polygon, dtype=np.float32).reshape((-1,2))
+    if len(v) == 0:
+        return mask
+    v0 = np.roll(v, 1, axis=0) # Previous vertex of each edge
+    x_min, x_max = max(int(np.ceil(v[:,0].min())), 0), min(int(np.floor(v[:,0].max())), shape[1]-1)
+    y_min, y_max = max(int(np.ceil(v[:,1].min())), 0), min(int(np.floor(v[:,1].max())), shape[0]-1)
+    if x_min > x_max or y_min > y_max:
+        return mask
+    xs = np.arange(x_min, x_max+1, dtype=np.float32)
+
+    for y in range(y_min, y_max+1):
+        py = np.float32(y)
+
+        # Voxels on a vertex or on a horizontal edge of the row
+        on_row = v[:,1] == py
+        boundary = np.isin(xs, v[on_row,0])
+        for a, b in zip(v0[on_row & (v0[:,1] == py),0], v[on_row & (v0[:,1] == py),0]):
+            boundary |= (min(a,b) <= xs) & (xs <= max(a,b))
+
+        # Edges crossing the row, ignored for voxels right of both end points
+        e = (v0[:,1] <= py) != (v[:,1] <= py)
+        a, b = v0[e,:,None], v[e,:,None]
+        dist = (py - a[:,1]).astype(np.float64)*(b[:,0] - a[:,0]) - (xs - a[:,0]).astype(np.float64)*(b[:,1] - a[:,1])
+        dist[b[:,1,0] < a[:,1,0]] *= -1
+        valid = ~((a[:,0] < xs) & (b[:,0] < xs))
+        boundary |= ((dist == 0) & valid).any(axis=0)
+        crossings = ((dist > 0) & valid).sum(axis=0)
+
+        mask[y, x_min:x_max+1] = (crossings % 2 == 1) & ~boundary
+    return mask
+
+
+class ROIMask:
+    """
+    Binary mask of a ROI read from an RT struct, stored per slice
+
+    Only slices with contours are kept, each cropped to the bounding box of
+    the mask and bit-packed. Contours are added with xor, so a contour
+    inside another makes a hole (even-odd rule). The full volume is only
+    created by to_array or np.asarray(mask).
+
+    from rhscripts.dcm import read_rtx
+    ROIs = read_rtx('RTstruct.dcm', [127,344,344], world_to_voxel, sparse=True)
+    mask = ROIs[0]['data']
+    mask.slices, mask[mask.slices[0]], mask.to_array()
+    """
+
+    def __init__( self, shape: Tuple[int,int,int], axis: int=0 ):
+        """
+        Parameters
+        ----------
+        shape : (int,int,int)
+            Shape of the full volume
+        axis : int, optional
+            Slice axis of the volume. The default is 0.
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.axis = axis
+        self.plane_shape = tuple(s for i, s in enumerate(self.shape) if i != axis)
+        self._planes = {}
+
+    @property
+    def slices( self ) -> list:
+        """ Sorted indices of the slices with voxels in the mask """
+        return sorted(self._planes)
+
+    @property
+    def nbytes( self ) -> int:
+        """ Number of bytes used by the packed slices """
+        return sum(packed.nbytes for _, packed in self._planes.values())
+
+    def xor( self, index: int, plane: np.ndarray ):
+        """ Add a 2D plane to a slice with xor """
+        rows, cols = np.flatnonzero(plane.any(axis=1)), np.flatnonzero(plane.any(axis=0))
+        if len(rows) == 0:
+            return
+        box = [rows[0], rows[-1]+1, cols[0], cols[-1]+1]
+        if index in self._planes:
+            old_box = self._planes[index][0]
+            box = [min(box[0], old_box[0]), max(box[1], old_box[1]), min(box[2], old_box[2]), max(box[3], old_box[3])]
+        crop = self._crop(index, box)
+        crop ^= plane[box[0]:box[1], box[2]:box[3]] != 0
+        if crop.any():
+            self._planes[index] = (tuple(box), np.packbits(crop, axis=None))
+        else:
+            del self._planes[index]
+
+    def _crop( self, index: int, box: list ) -> np.ndarray:
+        """ Boolean mask of a slice within box """
+        crop = np.zeros((box[1]-box[0], box[3]-box[2]), dtype=bool)
+        if index in self._planes:
+            (r0, r1, c0, c1), packed = self._planes[index]
+            crop[r0-box[0]:r1-box[0], c0-box[2]:c1-box[2]] = np.unpackbits(packed, count=(r1-r0)*(c1-c0)).reshape((r1-r0, c1-c0))
+        return crop
+
+    def __getitem__( self, index: int ) -> np.ndarray:
+        """ Full 2D uint8 plane of a slice """
+        plane = np.zeros(self.plane_shape, dtype=np.uint8)
+        if index in self._planes:
+            r0, r1, c0, c1 = self._planes[index][0]
+            plane[r0:r1, c0:c1] = self._crop(index, [r0, r1, c0, c1])
+        return plane
+
+    def to_array( self ) -> np.ndarray:
+        """ Full uint8 volume of the mask """
+        volume = np.zeros(self.shape, dtype=np.uint8)
+        view = np.moveaxis(volume, self.axis, 0)
+        for index in self._planes:
+            view[index] ^= self[index]
+        return volume
+
+    def __ixor__( self, other: 'ROIMask' ) -> 'ROIMask':
+        """ Add all slices of another mask of the same volume with xor """
+        for index in other.slices:
+            self.xor(index, other[index])
+        return self
+
+    def __array__( self, dtype=None, copy=None ) -> np.ndarray:
+        volume = self.to_array()
+        return volume if dtype is None else volume.astype(dtype)
+
+
+def rtx_label_map(ROI_output: Dict[int, dict]) -> np.ndarray:
+    """ Combine the masks returned by read_rtx into one label volume
+
+    The label of a ROI is ROI_id+1. Where ROIs overlap, the later ROI is used.
+
+    Parameters
+    ----------
+    ROI_output : dict
+        Output of read_rtx, with full volumes or ROIMask as 'data'
+
+    Examples
+    --------
+    >>> from rhscripts.dcm import read_rtx, rtx_label_map
+    >>> labels = rtx_label_map(read_rtx('RTstruct.dcm', [127,344,344], world_to_voxel, sparse=True))
+    """
+    labels = None
+    for ROI_id, ROI in ROI_output.items():
+        data = ROI['data']
+        if labels is None:
+            labels = np.zeros(data.shape, dtype=np.uint8 if max(ROI_output) < 255 else np.uint16)
+        if isinstance(data, ROIMask):
+            view = np.moveaxis(labels, data.axis, 0)
+            for index in data.slices:
+                view[index][data[index] > 0] = ROI_id+1
+        else:
+            labels[np.asarray(data) > 0] = ROI_id+1
+    return labels
+
+
+_SCAN_HEAD = 64 # Bytes kept of each value by _scan_elements, enough for the first point of ContourData
+
+
+def _scan_items(fp, length: int, endian: str, implicit: bool) -> list:
+    """ Items of a sequence value at the position of fp, see _scan_elements """
+    end = None if length == 0xFFFFFFFF else fp.tell() + length
+    items = []
+    while end is None or fp.tell() < end:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        group, element, item_length = struct.unpack(endian+'HHL', header)
+        if (group, element) == (0xFFFE, 0xE0DD): # Sequence delimitation
+            break
+        items.append(_scan_elements(fp, item_length, endian, implicit))
+    return items
+
+
+def _scan_elements(fp, length: int, endian: str, implicit: bool) -> dict:
+    """ Elements of a dataset (or sequence item) at the position of fp as {tag: value}
+
+    Sequences become lists of items. Other values are the first _SCAN_HEAD
+    bytes of the raw value, the rest is skipped with a seek. Unlike a
+    deferred dcmread, this also holds for elements nested in sequences.
+    """
+    end = None if length == 0xFFFFFFFF else fp.tell() + length
+    elements = {}
+    while end is None or fp.tell() < end:
+        header = fp.read(8)
+        if len(header) < 8:
+            break
+        group, element = struct.unpack(endian+'HH', header[:4])
+        tag = group << 16 | element
+        if tag == 0xFFFEE00D: # Item delimitation
+            break
+        if implicit:
+            VR, value_length = None, struct.unpack(endian+'L', header[4:])[0]
+        elif header[4:6] in (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'):
+            VR, value_length = header[4:6], struct.unpack(endian+'L', fp.read(4))[0]
+        else:
+            VR, value_length = header[4:6], struct.unpack(endian+'H', header[6:])[0]
+
+        if VR in (None, b'UN') and value_length != 0xFFFFFFFF:
+            try:
+                VR = b'SQ' if dicom.datadict.dictionary_VR(tag) == 'SQ' else VR
+            except KeyError:
+                pass
+        if VR == b'SQ' or value_length == 0xFFFFFFFF:
+            elements[tag] = _scan_items(fp, value_length, endian, implicit)
+        else:
+            elements[tag] = fp.read(min(value_length, _SCAN_HEAD))
+            fp.seek(value_length - len(elements[tag]), 1)
+    return elements
+
+
+def inspect_rtx(dcmfile: str) -> Dict[int, dict]:
+    """List the ROIs of an RT struct without reading the contours
+
+    Only the first point of each ContourData is read, the remaining bytes
+    of the contours are skipped. Use it to pick roi_names for read_rtx.
+
+    Parameters
+    ----------
+    dcmfile : string
+        Path to the dicom file (RT struct)
+
+    Returns
+    -------
+    dict
+        {ROI_id: {'ROIname', 'ROINumber', 'color', 'contours', 'points', 'z_range'}}
+        with ROI_id as in read_rtx, the number of contours and contour points,
+        and the (min, max) z position of the contours (None without contours)
+
+    Examples
+    --------
+    >>> from rhscripts.dcm import inspect_rtx
+    >>> for ROI_id, ROI in inspect_rtx('RTstruct.dcm').items():
+    >>>     print(ROI_id, ROI['ROIname'], ROI['contours'], ROI['z_range'])
+    """
+    with open(dcmfile, 'rb') as fp:
+        dicom.filereader.read_preamble(fp, False)
+        syntax = dicom.filereader._read_file_meta_info(fp).TransferSyntaxUID
+        if syntax == dicom.uid.DeflatedExplicitVRLittleEndian:
+            fp = DicomBytesIO(zlib.decompress(fp.read(), -zlib.MAX_WBITS))
+        elements = _scan_elements(fp, 0xFFFFFFFF, '>' if syntax == dicom.uid.ExplicitVRBigEndian else '<',
+                                  syntax == ImplicitVRLittleEndian)
+
+    charset = elements.get(0x00080005, b'').decode(errors='replace').strip(' \x00').split('\\')
+    encodings = dicom.charset.convert_encodings([c.strip() for c in charset] if charset != [''] else None)
+    def text(value: bytes) -> str:
+        return dicom.charset.decode_bytes(value, encodings, set()).strip(' \x00')
+
+    structure_set = elements.get(0x30060020, [])
+    ROI_output = {}
+    for ROI_id, ROI in enumerate(elements.get(0x30060039, [])):
+        contours = ROI.get(0x30060040, [])
+        z = [float(contour[0x30060050].split(b'\\')[2]) for contour in contours if len(contour.get(0x30060050, b'')) > 0]
+        ROI_output[ROI_id] = {'ROIname': text(structure_set[ROI_id].get(0x30060026, b'')) if ROI_id < len(structure_set) else None,
+                              'ROINumber': int(structure_set[ROI_id][0x30060022]) if ROI_id < len(structure_set) else None,
+                              'color': tuple(int(c) for c in ROI[0x3006002A].split(b'\\')) if ROI.get(0x3006002A) else None,
+                              'contours': len(contours),
+                              'points': sum(int(contour.get(0x30060046) or 0) for contour in contours),
+                              'z_range': (min(z), max(z)) if z else None}
+    return ROI_output
+
+
+_RTX_CHUNK = 32 # Contours rasterized per task, larger ROIs are split between workers
+
+
+def _iter_rtx_rois(RTSS: dicom.dataset.Dataset, rasterize: Callable, roi_names: Optional[list],
+                   sparse: bool, verbose: bool, workers: Optional[int]) -> Iterator[Tuple[int, dict]]:
+    """ Rasterize the ROIs of an RT struct in a thread pool and yield (ROI_id, ROI) in order
+
+    rasterize(contours) returns a ROIMask and the contour points by slice
+    for a list of contours. ROIs with more than _RTX_CHUNK contours are
+    split in parts that are rasterized at the same time and combined with
+    xor, which gives the same mask as rasterizing all contours at once.
+    """
+    def tasks():
+        for ROI_id, ROI in enumerate(RTSS.ROIContourSequence):
+            name = RTSS.StructureSetROISequence[ROI_id].ROIName
+            if roi_names is not None and name not in roi_names:
+                continue
+            contour_sequences = ROI.ContourSequence
+
+            if verbose:
+                print(" --> Found",len(contour_sequences),"contour sequences for ROI:",name)
+                for contour in contour_sequences:
+                    print("\t",contour.ContourNumber,"contains",contour.NumberOfContourPoints)
+
+            starts = range(0, max(len(contour_sequences), 1), _RTX_CHUNK)
+            for start in starts:
+                yield ROI_id, name, contour_sequences[start:start+_RTX_CHUNK], start == starts[-1]
+
+    data = None
+    for (ROI_id, name, _, last), (part, points) in _parallel_imap(lambda task: (task, rasterize(task[2])), tasks(), workers):
+        if data is None:
+            data, contour_points = part, points
+        else:
+            data ^= part
+            for k, v in points.items():
+                contour_points.setdefault(k, []).extend(v)
+        if last:
+            yield ROI_id, {'ROIname': name,
+                           'data': data if sparse else data.to_array(),
+                           'contour_points': contour_points}
+            data = None
+
+
+def iter_rtx( dcmfile: str, img_size: Tuple[int,int,int],
+              fn_world_to_voxel: Union[Callable, np.ndarray], behavior: str='default',
+              voxel_dims: Tuple[int,int,int]=[0,2,1],
+              verbose: bool=False, vectorized: bool=False,
+              sparse: bool=False, roi_names: Optional[list]=None,
+              workers: Optional[int]=None ) -> Iterator[Tuple[int, Dict[str,np.ndarray]]]:
+    """Read dcm file (RT struct) one ROI at a time, see read_rtx
+
+    Yields (ROI_id, ROI) for each ROI in order, as soon as it is rasterized,
+    so only the ROIs being rasterized are held in memory.
+
+    Parameters
+    ----------
+    dcmfile : string
+        Path to the dicom file (RT struct)
+    img_size : (int,int,int)
+        Size of the reference volume that the RT struct was defined on.
+        Assuming (slice,width,height)
+    fn_world_to_voxel : function or np.ndarray
+        Function to convert world coordinate to voxel coordinate, or 4x4 world-to-voxel matrix
+    behavior : string
+        Chose how to convert to polygon. Options: default, mirada
+    flip_read_direction : boolean
+        ...
+    verbose : boolean, optional
+        Default = False (if true, print info)
+    vectorized : boolean, optional
+        Default = False (if true, fn_world_to_voxel takes an (N,3) array of all points of a ROI)
+    sparse : boolean, optional
+        Default = False (if true, 'data' of each ROI is a ROIMask instead of a full uint8 volume)
+    roi_names : list of str, optional
+        Default = None (if given, only the ROIs with these names are read, see inspect_rtx. ROI_id is unchanged)
+    workers : int, optional
+        Default = None (number of threads rasterizing ROIs, or parts of large ROIs, at the same time. None uses all cores)
+    Examples
+    --------
+    >>> from rhscripts.dcm import iter_rtx
+    >>> for ROI_id, ROI in iter_rtx('RTstruct.dcm',[127,344,344],volume.convertWorldToVoxel,sparse=True):
+    >>>     print(ROI['ROIname'], ROI['data'].slices)
+    """
+    RTSS = dicom.read_file(dcmfile)
+    ROIs = RTSS.ROIContourSequence
+
+    if verbose:
+        print(RTSS.StructureSetROISequence[0].ROIName)
+        print("Found",len(ROIs),"ROIs")
+
+    def rasterize(contours):
+        data = ROIMask(img_size, axis=0)
+        contour_points = {}
+
+        # Transform all points of the contours at once
+        contour_voxels = _contours_to_voxels(contours, fn_world_to_voxel, vectorized)
+
+        for contour, voxels in zip(contours, contour_voxels):
+            assert contour.ContourGeometricType == "CLOSED_PLANAR"
+
+            slice_i = voxels[:,abs(voxel_dims[0])]
+            # If voxel dim is negative, flip the direction
+            if math.copysign(1,voxel_dims[0]) == -1:
+                slice_i = img_size[0]-slice_i-1
+            current_slice_i = slice_i[-1]
+            voxel_coordinates_inplane = voxels[:,[voxel_dims[1],voxel_dims[2]]]
+
+            # Track the contour points as well in float
+            for k, point in zip(np.round(slice_i).astype(int), voxel_coordinates_inplane.tolist()):
+                contour_points.setdefault(k, []).append(point)
+            current_slice_inner = np.zeros((img_size[1],img_size[2]),dtype=np.uint8)
+            if behavior == 'default':
+                # Locate each voxel covered by, or located inside, a polygon contour
+                converted_voxel_coordinates_inplane = np.array(np.round(voxel_coordinates_inplane),np.int32)
+                cv2.fillPoly(current_slice_inner,pts=[converted_voxel_coordinates_inplane],color=1)
+            elif behavior == 'mirada':
+                # Check for each voxel if its center is inside polygon
+                current_slice_inner = _polygon_mask(voxel_coordinates_inplane, current_slice_inner.shape)
+            # Contours are added with xor - even areas implies a hole.
+            data.xor(int(round(current_slice_i)), current_slice_inner)
+        return data, contour_points
+
+    yield from _iter_rtx_rois(RTSS, rasterize, roi_names, sparse, verbose, workers)
+
+
 def read_rtx( dcmfile: str, img_size: Tuple[int,int,int],
-              fn_world_to_voxel: Callable, behavior: str='default',
+              fn_world_to_voxel: Union[Callable, np.ndarray], behavior: str='default',
               voxel_dims: Tuple[int,int,int]=[0,2,1],
-              verbose: bool=False ) -> Dict[int, Dict[str,np.ndarray]]:
+              verbose: bool=False, vectorized: bool=False,
+              sparse: bool=False, roi_names: Optional[list]=None,
+              workers: Optional[int]=None ) -> Dict[int, Dict[str,np.ndarray]]:
     """Read dcm file (RT struct) to dict of np.arrays - one for each ROI
 
     Parameters
@@ -959,91 +2301,40 @@ def read_rtx( dcmfile: str, img_size: Tuple[int,int,int],
     img_size : (int,int,int)
         Size of the reference volume that the RT struct was defined on.
         Assuming (slice,width,height)
-    fn_world_to_voxel : string
-        Function to convert world coordinate to voxel coordinate
+    fn_world_to_voxel : function or np.ndarray
+        Function to convert world coordinate to voxel coordinate, or 4x4 world-to-voxel matrix
     behavior : string
         Chose how to convert to polygon. Options: default, mirada
     flip_read_direction : boolean
         ...
     verbose : boolean, optional
         Default = False (if true, print info)
+    vectorized : boolean, optional
+        Default = False (if true, fn_world_to_voxel takes an (N,3) array of all points of a ROI)
+    sparse : boolean, optional
+        Default = False (if true, 'data' of each ROI is a ROIMask instead of a full uint8 volume)
+    roi_names : list of str, optional
+        Default = None (if given, only the ROIs with these names are read, see inspect_rtx. ROI_id is unchanged)
+    workers : int, optional
+        Default = None (number of threads rasterizing ROIs, or parts of large ROIs, at the same time. None uses all cores)
     Examples
     --------
     >>> from rhscripts.conversion import read_rtx
     >>> read_rtx('RTstruct.dcm',[127,344,344],volume.convertWorldToVoxel,verbose=False)
     """
     try:
-        RTSS = dicom.read_file(dcmfile)
-        ROIs = RTSS.ROIContourSequence
-        ROI_output = {}
-
-        if verbose:
-            print(RTSS.StructureSetROISequence[0].ROIName)
-            print("Found",len(ROIs),"ROIs")
-
-        for ROI_id,ROI in enumerate(ROIs):
-
-            data = np.zeros(img_size)
-            contour_sequences = ROI.ContourSequence
-            contour_points = {}
-
-            if verbose:
-                print(" --> Found",len(contour_sequences),"contour sequences for ROI:",RTSS.StructureSetROISequence[ROI_id].ROIName)
-
-            for contour in contour_sequences:
-                assert contour.ContourGeometricType == "CLOSED_PLANAR"
-
-                if verbose:
-                    print("\t",contour.ContourNumber,"contains",contour.NumberOfContourPoints)
-
-                world_coordinate_points = np.array(contour.ContourData)
-                world_coordinate_points = world_coordinate_points.reshape((contour.NumberOfContourPoints,3))
-                voxel_coordinates_inplane = np.zeros((len(world_coordinate_points),2))
-                current_slice_i = 0
-                for wi,world in enumerate(world_coordinate_points):
-                    voxel = fn_world_to_voxel([-world[0],-world[1],world[2]])
-                    current_slice_i = voxel[abs(voxel_dims[0])]
-                    # If voxel dim is negative, flip the direction
-                    if math.copysign(1,voxel_dims[0]) == -1:
-                        current_slice_i = img_size[0]-current_slice_i-1
-                    voxel_coordinates_inplane[wi,:] = [voxel[voxel_dims[1]],voxel[voxel_dims[2]]]
-
-                    # Track the contour points as well in float
-                    if wi == 0 and not int(round(current_slice_i)) in contour_points:
-                        contour_points[int(round(current_slice_i))] = []
-                    contour_points[int(round(current_slice_i))].append([voxel[voxel_dims[1]],voxel[voxel_dims[2]]])
-                current_slice_inner = np.zeros((img_size[1],img_size[2]),dtype=np.float32)
-                if behavior == 'default':
-                    # Locate each voxel covered by, or located inside, a polygon contour
-                    converted_voxel_coordinates_inplane = np.array(np.round(voxel_coordinates_inplane),np.int32)
-                    cv2.fillPoly(current_slice_inner,pts=[converted_voxel_coordinates_inplane],color=1)
-                elif behavior == 'mirada':
-                    # Check for each voxel if its center is inside polygon
-                    for x in range( img_size[1] ):
-                        for y in range( img_size[2] ):
-                            current_slice_inner[ x, y ] = cv2.pointPolygonTest(
-                                    np.array( [voxel_coordinates_inplane], dtype='float32' ),
-                                    (y,x), # Not sure if should be swapped, or needs a 0.5 voxel offset for center?
-                                    False
-                            )
-                    current_slice_inner = (current_slice_inner>0).astype('uint8')
-                data[int(round(current_slice_i))] += current_slice_inner
-
-            # Remove even areas - implies a hole.
-            data[data % 2 == 0] = 0
-
-            ROI_output[ROI_id] = {'ROIname': RTSS.StructureSetROISequence[ROI_id].ROIName,
-                                  'data': data,
-                                  'contour_points': contour_points}
-        return ROI_output
+        return dict(iter_rtx(dcmfile, img_size, fn_world_to_voxel, behavior, voxel_dims, verbose, vectorized,
+                             sparse, roi_names, workers))
     except InvalidDicomError:
         print("Could not read DICOM RTX file", dcmfile)
         exit(-1)
 
 
 def read_rtx_v2(dcmfile: str, img_size: Tuple[int, int, int],
-                fn_world_to_voxel: Callable, affine: np.ndarray,
-                behavior: str = 'default', verbose: bool = False) \
+                fn_world_to_voxel: Union[Callable, np.ndarray], affine: np.ndarray,
+                behavior: str = 'default', verbose: bool = False, vectorized: bool = False,
+                sparse: bool = False, roi_names: Optional[list] = None,
+                workers: Optional[int] = None) \
                 -> Dict[int, Dict[str, np.ndarray]]:
     """Read dcm file (RT struct) to dict of np.arrays - one for each ROI
 
@@ -1060,14 +2351,22 @@ def read_rtx_v2(dcmfile: str, img_size: Tuple[int, int, int],
     img_size : (int,int,int)
         Size of the reference volume that the RT struct was defined on.
         Assuming (slice,width,height)
-    fn_world_to_voxel : string
-        Function to convert world coordinate to voxel coordinate
+    fn_world_to_voxel : function or np.ndarray
+        Function to convert world coordinate to voxel coordinate, or 4x4 world-to-voxel matrix
     behavior : string
         Chose how to convert to polygon. Options: default, mirada
     flip_read_direction : boolean
         ...
     verbose : boolean, optional
         Default = False (if true, print info)
+    vectorized : boolean, optional
+        Default = False (if true, fn_world_to_voxel takes an (N,3) array of all points of a ROI)
+    sparse : boolean, optional
+        Default = False (if true, 'data' of each ROI is a ROIMask instead of a full uint8 volume)
+    roi_names : list of str, optional
+        Default = None (if given, only the ROIs with these names are read, see inspect_rtx. ROI_id is unchanged)
+    workers : int, optional
+        Default = None (number of threads rasterizing ROIs, or parts of large ROIs, at the same time. None uses all cores)
     Examples
     --------
     >>> from rhscripts.conversion import read_rtx_v2
@@ -1080,7 +2379,6 @@ def read_rtx_v2(dcmfile: str, img_size: Tuple[int, int, int],
     try:
         RTSS = dicom.read_file(dcmfile)
         ROIs = RTSS.ROIContourSequence
-        ROI_output = {}
 
         # # Determine reading directions
         # voxel_dims = [None, None, None]
@@ -1099,67 +2397,45 @@ def read_rtx_v2(dcmfile: str, img_size: Tuple[int, int, int],
             print(RTSS.StructureSetROISequence[0].ROIName)
             print("Found", len(ROIs), "ROIs")
 
-        for ROI_id, ROI in enumerate(ROIs):
-
-            data = np.zeros(img_size)
-            contour_sequences = ROI.ContourSequence
+        def rasterize(contours):
+            data = ROIMask(img_size, axis=2)
             contour_points = {}
 
-            if verbose:
-                print(" --> Found", len(contour_sequences), "contour sequences for ROI:", RTSS.StructureSetROISequence[ROI_id].ROIName)
+            # Transform all points of the contours at once
+            contour_voxels = _contours_to_voxels(contours, fn_world_to_voxel, vectorized)
 
-            for contour in contour_sequences:
+            for contour, voxels in zip(contours, contour_voxels):
                 assert contour.ContourGeometricType == "CLOSED_PLANAR"
 
-                if verbose:
-                    print("\t",contour.ContourNumber,"contains",contour.NumberOfContourPoints)
+                current_slice_i = voxels[-1,2]
+                voxel_coordinates_inplane = voxels[:,[1,0]]
 
-                world_coordinate_points = np.array(contour.ContourData)
-                world_coordinate_points = world_coordinate_points.reshape((contour.NumberOfContourPoints,3))
-                voxel_coordinates_inplane = np.zeros((len(world_coordinate_points),2))
-                current_slice_i = 0
-                for wi, world in enumerate(world_coordinate_points):
-                    voxel = fn_world_to_voxel([-world[0], -world[1], world[2]])
-                    current_slice_i = voxel[2]
-                    voxel_coordinates_inplane[wi, :] = [voxel[1], voxel[0]]
-
-                    # Track the contour points as well in float
-                    k = int(round(current_slice_i))
-                    if k not in contour_points:
-                        contour_points[k] = []
-                    contour_points[k].append([voxel[1],voxel[0]])
-                current_slice_inner = np.zeros((img_size[0],img_size[1]),dtype=np.float32)
+                # Track the contour points as well in float
+                for k, point in zip(np.round(voxels[:,2]).astype(int), voxel_coordinates_inplane.tolist()):
+                    contour_points.setdefault(k, []).append(point)
+                current_slice_inner = np.zeros((img_size[0],img_size[1]),dtype=np.uint8)
                 if behavior == 'default':
                     # Locate each voxel covered by, or located inside, a polygon contour
                     converted_voxel_coordinates_inplane = np.array(np.round(voxel_coordinates_inplane),np.int32)
                     cv2.fillPoly(current_slice_inner,pts=[converted_voxel_coordinates_inplane],color=1)
                 elif behavior == 'mirada':
                     # Check for each voxel if its center is inside polygon
-                    for x in range( img_size[1] ):
-                        for y in range( img_size[0] ):
-                            current_slice_inner[ x, y ] = cv2.pointPolygonTest(
-                                    np.array([voxel_coordinates_inplane], dtype='float32'),
-                                    (y,x), # Not sure if should be swapped, or needs a 0.5 voxel offset for center?
-                                    False
-                            )
-                    current_slice_inner = (current_slice_inner>0).astype('uint8')
-                data[:,:,int(round(current_slice_i))] += current_slice_inner
-
-            # Remove even areas - implies a hole.
-            data[data % 2 == 0] = 0
-
-            ROI_output[ROI_id] = {'ROIname': RTSS.StructureSetROISequence[ROI_id].ROIName,
-                                  'data': data,
-                                  'contour_points': contour_points}
-        return ROI_output
+                    current_slice_inner = _polygon_mask(voxel_coordinates_inplane, current_slice_inner.shape)
+                # Contours are added with xor - even areas implies a hole.
+                data.xor(int(round(current_slice_i)), current_slice_inner)
+            return data, contour_points
+
+        return dict(_iter_rtx_rois(RTSS, rasterize, roi_names, sparse, verbose, workers))
     except InvalidDicomError:
         print("Could not read DICOM RTX file", dcmfile)
         exit(-1)
 
 def read_rtx_v3( dcmfile: str, img_size: Tuple[int,int,int],
-              fn_world_to_voxel: Callable, behavior: str='default',
+              fn_world_to_voxel: Union[Callable, np.ndarray], behavior: str='default',
               voxel_dims: Tuple[int,int,int]=[0,2,1],
-              verbose: bool=False ) -> Dict[int, Dict[str,np.ndarray]]:
+              verbose: bool=False, vectorized: bool=False,
+              sparse: bool=False, roi_names: Optional[list]=None,
+              workers: Optional[int]=None ) -> Dict[int, Dict[str,np.ndarray]]:
     """Read dcm file (RT struct) to dict of np.arrays - one for each ROI
 
     !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -1175,14 +2451,22 @@ def read_rtx_v3( dcmfile: str, img_size: Tuple[int,int,int],
     img_size : (int,int,int)
         Size of the reference volume that the RT struct was defined on.
         Assuming (width,height,slice)
-    fn_world_to_voxel : string
-        Function to convert world coordinate to voxel coordinate
+    fn_world_to_voxel : function or np.ndarray
+        Function to convert world coordinate to voxel coordinate, or 4x4 world-to-voxel matrix
     behavior : string
         Chose how to convert to polygon. Options: default, mirada
     flip_read_direction : boolean
         ...
     verbose : boolean, optional
         Default = False (if true, print info)
+    vectorized : boolean, optional
+        Default = False (if true, fn_world_to_voxel takes an (N,3) array of all points of a ROI)
+    sparse : boolean, optional
+        Default = False (if true, 'data' of each ROI is a ROIMask instead of a full uint8 volume)
+    roi_names : list of str, optional
+        Default = None (if given, only the ROIs with these names are read, see inspect_rtx. ROI_id is unchanged)
+    workers : int, optional
+        Default = None (number of threads rasterizing ROIs, or parts of large ROIs, at the same time. None uses all cores)
     Examples
     --------
     >>> from rhscripts.conversion import read_rtx
@@ -1191,64 +2475,40 @@ def read_rtx_v3( dcmfile: str, img_size: Tuple[int,int,int],
     try:
         RTSS = dicom.read_file(dcmfile)
         ROIs = RTSS.ROIContourSequence
-        ROI_output = {}
 
         if verbose:
             print(RTSS.StructureSetROISequence[0].ROIName)
             print("Found",len(ROIs),"ROIs")
 
-        for ROI_id,ROI in enumerate(ROIs):
-
-            data = np.zeros(img_size)
-            contour_sequences = ROI.ContourSequence
+        def rasterize(contours):
+            data = ROIMask(img_size, axis=2)
             contour_points = {}
 
-            if verbose:
-                print(" --> Found",len(contour_sequences),"contour sequences for ROI:",RTSS.StructureSetROISequence[ROI_id].ROIName)
+            # Transform all points of the contours at once
+            contour_voxels = _contours_to_voxels(contours, fn_world_to_voxel, vectorized)
 
-            for contour in contour_sequences:
+            for contour, voxels in zip(contours, contour_voxels):
                 assert contour.ContourGeometricType == "CLOSED_PLANAR"
 
-                if verbose:
-                    print("\t",contour.ContourNumber,"contains",contour.NumberOfContourPoints)
+                current_slice_i = voxels[-1,2]
+                voxel_coordinates_inplane = voxels[:,[0,1]]
 
-                world_coordinate_points = np.array(contour.ContourData)
-                world_coordinate_points = world_coordinate_points.reshape((contour.NumberOfContourPoints,3))
-                voxel_coordinates_inplane = np.zeros((len(world_coordinate_points),2))
-                current_slice_i = 0
-                for wi, world in enumerate(world_coordinate_points):
-                    voxel = fn_world_to_voxel([-world[0],-world[1],world[2]])
-                    current_slice_i = voxel[2]
-                    voxel_coordinates_inplane[wi,:] = [voxel[0],voxel[1]]
-
-                    # Track the contour points as well in float
-                    if wi == 0 and not int(round(current_slice_i)) in contour_points:
-                        contour_points[int(round(current_slice_i))] = []
-                    contour_points[int(round(current_slice_i))].append([voxel[0],voxel[1]])
-                current_slice_inner = np.zeros((img_size[0],img_size[1]),dtype=np.float32)
+                # Track the contour points as well in float
+                for k, point in zip(np.round(voxels[:,2]).astype(int), voxel_coordinates_inplane.tolist()):
+                    contour_points.setdefault(k, []).append(point)
+                current_slice_inner = np.zeros((img_size[0],img_size[1]),dtype=np.uint8)
                 if behavior == 'default':
                     # Locate each voxel covered by, or located inside, a polygon contour
                     converted_voxel_coordinates_inplane = np.array(np.round(voxel_coordinates_inplane),np.int32)
                     cv2.fillPoly(current_slice_inner,pts=[converted_voxel_coordinates_inplane],color=1)
                 elif behavior == 'mirada':
-                    # Check for each voxel if its center is inside polygon
-                    for x in range( img_size[0] ):
-                        for y in range( img_size[1] ):
-                            current_slice_inner[ x, y ] = cv2.pointPolygonTest(
-                                    np.array( [voxel_coordinates_inplane], dtype='float32' ),
-                                    (x,y), # Not sure if needs a 0.5 voxel offset for center?
-                                    False
-                            )
-                    current_slice_inner = (current_slice_inner>0).astype('uint8')
-                data[:, :, int(round(current_slice_i))] += current_slice_inner
-
-            # Remove even areas - implies a hole.
-            data[data % 2 == 0] = 0
-
-            ROI_output[ROI_id] = {'ROIname': RTSS.StructureSetROISequence[ROI_id].ROIName,
-                                  'data': data,
-                                  'contour_points': contour_points}
-        return ROI_output
+                    # Check for each voxel if its center is inside polygon, with the point given as (x,y)
+                    current_slice_inner = _polygon_mask(voxel_coordinates_inplane[:,::-1], current_slice_inner.shape)
+                # Contours are added with xor - even areas implies a hole.
+                data.xor(int(round(current_slice_i)), current_slice_inner)
+            return data, contour_points
+
+        return dict(_iter_rtx_rois(RTSS, rasterize, roi_names, sparse, verbose, workers))
     except InvalidDicomError:
         print("Could not read DICOM RTX file", dcmfile)
         exit(-1)
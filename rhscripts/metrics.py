@@ -11,7 +11,9 @@ import collections
 import numpy as np
 from scipy.spatial import distance
 import torchio as tio
+import nibabel as nib
 from scipy.spatial import cKDTree
+from rhscripts.utils import load_volume
 
 def dice_similarity(arr1: np.ndarray, arr2: np.ndarray) -> float:
     """
@@ -116,7 +118,7 @@ def hausdorff_distance( arr1: np.ndarray, arr2: np.ndarray, axial_orientation: i
         return max_distance
     return max(distance.directed_hausdorff(arr1, arr2)[0], distance.directed_hausdorff(arr2, arr1)[0])
 
-def hausdorff_distance_with_resampling(lab1_nii, lab2_nii):
+def hausdorff_distance_with_resampling(lab1_nii, lab2_nii, dtype=None):
     '''
     Code copied from 
     https://github.com/voreille/hecktor/blob/master/src/evaluation/scores.py
@@ -127,11 +129,19 @@ def hausdorff_distance_with_resampling(lab1_nii, lab2_nii):
     Input should be binary nifti files. 
 
     TODO: in case lab1 and lab2 include a different number of slices after resampling to 1x1x1mm, need to resample lab1 like lab2 first.
+
+    The files are loaded with rhscripts.utils.load_volume, keeping the dtype on
+    disk of unscaled integer labels (float32 otherwise) unless dtype is given.
     '''
 
+    def load(nii):
+        data = load_volume(nii, dtype=dtype)
+        # Channels first, as torchio expects
+        return np.moveaxis(data.reshape(data.shape[:3] + (-1,)), -1, 0)
+
     transform = tio.Resample(1)
-    lab1 = tio.LabelMap(lab1_nii)
-    lab2 = tio.ScalarImage(lab2_nii)
+    lab1 = tio.LabelMap(tensor=load(lab1_nii), affine=nib.load(lab1_nii).affine)
+    lab2 = tio.ScalarImage(tensor=load(lab2_nii), affine=nib.load(lab2_nii).affine)
     lab1_transformed = transform(lab1)
     lab2_transformed = transform(lab2)
     lab1_t_np = np.squeeze(lab1_transformed.numpy())
@@ -6,6 +6,7 @@ import numpy as np
 import sys, random, typing, time, pydicom
 from pathlib import Path
 import pandas as pd
+import nibabel as nib
 
 def listdir_nohidden(path):
     """List dir without hidden files
@@ -31,6 +32,98 @@ def bbox_ND(img):
         out.extend(np.where(nonzero)[0][[0, -1]])
     return tuple(out)
 
+# numpy dtype to pyminc type name
+_MINC_TYPES = {'uint8': 'ubyte', 'int8': 'byte', 'uint16': 'ushort', 'int16': 'short',
+               'uint32': 'uint', 'int32': 'int', 'float32': 'float', 'float64': 'double'}
+
+# libminc mitype_t of the integer types to numpy dtype
+_MINC_DISK_TYPES = {1: 'int8', 3: 'int16', 4: 'int32', 100: 'uint8', 101: 'uint16', 102: 'uint32'}
+
+def _minc_integer_dtype(filename) -> typing.Optional[np.dtype]:
+    """dtype on disk of a minc file with unscaled integer data, read through libminc. None otherwise"""
+    import ctypes
+    import pyminc.volumes.factory as pyminc
+    minc = pyminc.volumeFromFile(str(filename))
+    try:
+        from pyminc.volumes.libpyminc2 import libminc
+        data_type, slice_scaling = ctypes.c_int(), ctypes.c_int()
+        valid_max, valid_min, real_max, real_min = (ctypes.c_double() for _ in range(4))
+        # 0 is MI_NOERROR
+        if (libminc.miget_data_type(minc.volPointer, ctypes.byref(data_type)) != 0 or
+                libminc.miget_slice_scaling_flag(minc.volPointer, ctypes.byref(slice_scaling)) != 0 or
+                libminc.miget_volume_valid_range(minc.volPointer, ctypes.byref(valid_max), ctypes.byref(valid_min)) != 0 or
+                libminc.miget_volume_range(minc.volPointer, ctypes.byref(real_max), ctypes.byref(real_min)) != 0):
+            return None
+    except (ImportError, AttributeError, OSError, ctypes.ArgumentError):
+        return None
+    finally:
+        minc.closeVolume()
+    # The voxel values are the real values when the real range is the valid range
+    if (data_type.value not in _MINC_DISK_TYPES or slice_scaling.value or
+            (real_min.value, real_max.value) != (valid_min.value, valid_max.value)):
+        return None
+    return np.dtype(_MINC_DISK_TYPES[data_type.value])
+
+def _is_scaled(img) -> bool:
+    """True if the values on disk of a nibabel image are scaled when read"""
+    return getattr(img.dataobj, 'slope', 1) != 1 or getattr(img.dataobj, 'inter', 0) != 0
+
+def _volume_dtype(img, dtype=None) -> np.dtype:
+    """dtype used by load_volume for a nibabel image, see load_volume"""
+    if dtype is not None:
+        return np.dtype(dtype)
+    on_disk = img.get_data_dtype()
+    return on_disk if np.issubdtype(on_disk, np.integer) and not _is_scaled(img) else np.dtype(np.float32)
+
+def _as_volume_dtype(data, dtype) -> np.ndarray:
+    """Cast voxel data to dtype, rounding when going from float to integer. No copy if the dtype matches"""
+    data = np.asanyarray(data)
+    if data.dtype == dtype:
+        return data
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data)
+    return data.astype(dtype)
+
+def load_volume(filename, dtype=None) -> np.ndarray:
+    """Load the voxel data of a nifty or minc file without going through float64
+
+    Unscaled integer data (labels, raw CT) keeps the dtype on disk, other
+    data is loaded as float32. Uncompressed nifty files are memory-mapped
+    (copy-on-write) when no conversion is needed.
+
+    Parameters
+    ----------
+    filename : string, Path object or nibabel image
+        Path to a nifty (.nii, .nii.gz) or minc (.mnc) file
+    dtype : numpy dtype, optional
+        dtype of the returned array. Default is chosen as above
+
+    Examples
+    --------
+    >>> from rhscripts.utils import load_volume
+    >>> labels = load_volume('labels.nii.gz')
+    >>> pet = load_volume('PET.nii', dtype=np.float64)
+    """
+    if isinstance(filename, (str, Path)) and str(filename).endswith('.mnc'):
+        import pyminc.volumes.factory as pyminc
+        on_disk = _minc_integer_dtype(filename) if dtype is None else None
+        if dtype is None:
+            dtype = np.float32 if on_disk is None else on_disk
+        dtype = np.dtype(dtype)
+        # Unscaled integer data is read as the voxel values on disk
+        minc = pyminc.volumeFromFile(str(filename), dtype=_MINC_TYPES[dtype.name], labels=on_disk is not None)
+        data = np.array(minc.data, dtype=dtype)
+        minc.closeVolume()
+        return data
+
+    img = filename if isinstance(filename, nib.spatialimages.SpatialImage) else nib.load(str(filename))
+    dtype = _volume_dtype(img, dtype)
+    if dtype == img.get_data_dtype() and not _is_scaled(img):
+        return np.asanyarray(img.dataobj)
+    if np.issubdtype(dtype, np.floating):
+        return img.get_fdata(caching='unchanged', dtype=dtype)
+    return _as_volume_dtype(img.dataobj, dtype)
+
 class LMParser:
     """ LMParser
 
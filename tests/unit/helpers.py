@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pydicom
+
+def make_container(folder, num_slices=5, frames=1, spacing=2.5, origin=0.0):
+    """ Write a small CT series based on the pydicom test data, dynamic if frames > 1
+
+    File n.dcm has InstanceNumber and SOPInstanceUID 1.2.3.n, n = 1.. over all
+    frames. Slice i = 1..num_slices of each frame is at z = origin + spacing*i.
+    Returns the last dataset written.
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    for t in range(frames):
+        for i in range(1, num_slices+1):
+            ds = pydicom.read_file(pydicom.data.get_testdata_file("CT_small.dcm"))
+            ds.InstanceNumber = t*num_slices + i
+            ds.SOPInstanceUID = f'1.2.3.{t*num_slices + i}'
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            ds.ImagePositionPatient = [0, 0, origin + spacing*i]
+            ds.add_new(0x00280107, 'SS', 100) # LargestImagePixelValue
+            if frames > 1:
+                ds.NumberOfSlices = num_slices
+                ds.NumberOfTimeSlices = frames
+                ds.FrameReferenceTime = 60000*t
+            ds.save_as(folder.joinpath(f'{t*num_slices + i}.dcm'))
+    return ds
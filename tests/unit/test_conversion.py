@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import json
+from unittest import mock
+import numpy as np
+import pydicom
+import nibabel as nib
+from pathlib import Path
+from rhscripts.utils import load_volume
+from rhscripts.dcm import get_sort_files_dict
+from rhscripts.conversion import to_dcm, to_dcm_batch, nifty_to_dcm, to_rtx, rtx_to_nii, _load_nifty_for_dcm
+from .helpers import make_container
+
+
+class TestToDcm(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.container = self.root.joinpath('container')
+        make_container(self.container)
+        self.array = np.random.default_rng(0).uniform(-1000, 3000, (5, 128, 128))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_output(self, folder):
+        slices = []
+        for i in range(1, 6):
+            ds = pydicom.read_file(folder.joinpath(f'dicom_{i:04}.dcm'))
+            slices.append(ds.pixel_array * float(ds.RescaleSlope) + float(ds.RescaleIntercept))
+        return np.stack(slices)
+
+    def test_values( self ):
+        """
+        Stored values reproduce the input after applying RescaleSlope and RescaleIntercept
+        """
+        out = self.root.joinpath('out')
+        to_dcm( self.array, self.container, out, checkForFileEndings=False, from_type='minc' )
+
+        self.assertTrue( np.abs(self.read_output(out) - self.array).max() <= 1 )
+
+    def test_rescale( self ):
+        """
+        Values above the container range get a new RescaleSlope
+        """
+        out = self.root.joinpath('out')
+        to_dcm( self.array*40, self.container, out, checkForFileEndings=False, from_type='minc' )
+
+        ds = pydicom.read_file(out.joinpath('dicom_0001.dcm'))
+        self.assertGreater( float(ds.RescaleSlope), 1 )
+        self.assertLessEqual( len(str(ds.RescaleSlope)), 16 )
+        self.assertEqual( ds.LargestImagePixelValue, ds.pixel_array.max() )
+        self.assertTrue( np.abs(self.read_output(out) - self.array*40).max() <= float(ds.RescaleSlope) )
+
+    def test_template( self ):
+        """
+        Files spliced from the header templates are the same as modifying the container slice and saving it
+        """
+        out = self.root.joinpath('out')
+        to_dcm( self.array*40, self.container, out, checkForFileEndings=False, from_type='minc' )
+
+        written = out.joinpath('dicom_0003.dcm')
+        ds = pydicom.read_file(written)
+        expected = pydicom.dcmread(self.container.joinpath('3.dcm'), stop_before_pixels=True)
+        expected.RescaleSlope = ds.RescaleSlope
+        expected.LargestImagePixelValue = ds.LargestImagePixelValue
+        expected.PixelData = ds.PixelData
+        expected[0x7fe0, 0x0010].VR = 'OW'
+        expected.save_as(self.root.joinpath('expected.dcm'))
+        self.assertEqual( written.read_bytes(), self.root.joinpath('expected.dcm').read_bytes() )
+
+    def test_multiframe( self ):
+        """
+        All slices are written as frames of one multi-frame file with per-frame position and rescale
+        """
+        out = self.root.joinpath('out')
+        to_dcm( self.array*40, self.container, out, checkForFileEndings=False, from_type='minc', multiframe=True )
+
+        self.assertEqual( [f.name for f in out.iterdir()], ['dicom_0001.dcm'] )
+        ds = pydicom.read_file(out.joinpath('dicom_0001.dcm'))
+        self.assertEqual( ds.SOPClassUID, pydicom.uid.LegacyConvertedEnhancedCTImageStorage )
+        self.assertEqual( ds.NumberOfFrames, 5 )
+        for i, frame in enumerate(ds.PerFrameFunctionalGroupsSequence):
+            transformation = frame.PixelValueTransformationSequence[0]
+            values = ds.pixel_array[i] * float(transformation.RescaleSlope) + float(transformation.RescaleIntercept)
+            self.assertEqual( frame.PlanePositionSequence[0].ImagePositionPatient[2], 2.5*(i+1) )
+            self.assertTrue( np.abs(values - self.array[i]*40).max() <= float(transformation.RescaleSlope) )
+
+    def test_compress( self ):
+        """
+        RLE Lossless output decodes to the same pixel data as the uncompressed output
+        """
+        to_dcm( self.array, self.container, self.root.joinpath('raw'), checkForFileEndings=False, from_type='minc' )
+        to_dcm( self.array, self.container, self.root.joinpath('rle'), checkForFileEndings=False, from_type='minc',
+                compress=True )
+
+        ds = pydicom.read_file(self.root.joinpath('rle', 'dicom_0001.dcm'))
+        self.assertEqual( ds.file_meta.TransferSyntaxUID, pydicom.uid.RLELossless )
+        self.assertTrue( np.array_equal(self.read_output(self.root.joinpath('rle')),
+                                        self.read_output(self.root.joinpath('raw'))) )
+
+    def test_batch( self ):
+        """
+        Each array is written as its own series against the same container
+        """
+        out = [self.root.joinpath('out1'), self.root.joinpath('out2')]
+        to_dcm_batch( (a for a in [self.array, self.array*2]), self.container, out, descriptions=['a', 'b'],
+                      study_ids=[601, 602], checkForFileEndings=False, from_type='minc' )
+
+        ds1 = pydicom.read_file(out[0].joinpath('dicom_0001.dcm'))
+        ds2 = pydicom.read_file(out[1].joinpath('dicom_0001.dcm'))
+        self.assertEqual( (ds1.SeriesDescription, ds1.SeriesNumber), ('a', 601) )
+        self.assertEqual( (ds2.SeriesDescription, ds2.SeriesNumber), ('b', 602) )
+        self.assertNotEqual( ds1.SeriesInstanceUID, ds2.SeriesInstanceUID )
+        self.assertTrue( np.abs(self.read_output(out[1]) - self.array*2).max() <= 1 )
+
+    def test_nifty_stream( self ):
+        """
+        Streaming nifty conversion writes the same pixel data as loading the full volume
+        """
+        nii = self.root.joinpath('pet.nii')
+        nib.save(nib.Nifti1Image(np.transpose(self.array*40, (2, 1, 0)).astype(np.float32), np.eye(4)), nii)
+        nifty_to_dcm( nii, self.container, self.root.joinpath('full'), checkForFileEndings=False, clamp_lower=0 )
+        nifty_to_dcm( nii, self.container, self.root.joinpath('stream'), checkForFileEndings=False, clamp_lower=0,
+                      stream=True )
+
+        for i in range(1, 6):
+            full = pydicom.read_file(self.root.joinpath('full', f'dicom_{i:04}.dcm'))
+            stream = pydicom.read_file(self.root.joinpath('stream', f'dicom_{i:04}.dcm'))
+            self.assertEqual( full.RescaleSlope, stream.RescaleSlope )
+            self.assertEqual( full.LargestImagePixelValue, stream.LargestImagePixelValue )
+            self.assertEqual( full.PixelData, stream.PixelData )
+        self.assertGreaterEqual( stream.pixel_array.min()*float(stream.RescaleSlope) + float(stream.RescaleIntercept),
+                                 -float(stream.RescaleSlope) )
+
+    def test_nifty_stream_compressed( self ):
+        """
+        Compressed 3D nifty files are loaded in full when streaming and give the same pixel data
+        """
+        nii = self.root.joinpath('pet.nii.gz')
+        nib.save(nib.Nifti1Image(np.transpose(self.array*40, (2, 1, 0)).astype(np.float32), np.eye(4)), nii)
+        self.assertIsInstance( _load_nifty_for_dcm(nii, stream=True), np.ndarray )
+        nifty_to_dcm( nii, self.container, self.root.joinpath('full'), checkForFileEndings=False )
+        nifty_to_dcm( nii, self.container, self.root.joinpath('stream'), checkForFileEndings=False, stream=True )
+
+        for i in range(1, 6):
+            full = pydicom.read_file(self.root.joinpath('full', f'dicom_{i:04}.dcm'))
+            stream = pydicom.read_file(self.root.joinpath('stream', f'dicom_{i:04}.dcm'))
+            self.assertEqual( full.PixelData, stream.PixelData )
+
+    def test_nifty_dtype( self ):
+        """
+        Integer nifty files keep their dtype, memory-mapped when uncompressed, and convert as when loaded as float64
+        """
+        nii = self.root.joinpath('ct.nii')
+        nib.save(nib.Nifti1Image(np.transpose(self.array, (2, 1, 0)).astype(np.int16), np.eye(4)), nii)
+        self.assertIsInstance( load_volume(nii), np.memmap )
+        self.assertEqual( load_volume(nii).dtype, np.int16 )
+        self.assertEqual( load_volume(nii, dtype=np.float64).dtype, np.float64 )
+
+        nifty_to_dcm( nii, self.container, self.root.joinpath('int16'), checkForFileEndings=False )
+        nifty_to_dcm( nii, self.container, self.root.joinpath('float64'), checkForFileEndings=False, dtype=np.float64 )
+        self.assertTrue( np.array_equal(self.read_output(self.root.joinpath('int16')),
+                                        self.read_output(self.root.joinpath('float64'))) )
+
+    def test_dynamic_container_sorted_once( self ):
+        """
+        A dynamic container is only sorted by frame, without a pass over the positions alone
+        """
+        container = self.root.joinpath('dynamic')
+        make_container(container, frames=2)
+        nii = self.root.joinpath('dynamic.nii')
+        nib.save(nib.Nifti1Image(np.zeros((128, 128, 5, 2), dtype=np.float32), np.eye(4)), nii)
+        nii_3D = self.root.joinpath('static.nii')
+        nib.save(nib.Nifti1Image(np.zeros((128, 128, 5), dtype=np.float32), np.eye(4)), nii_3D)
+        with mock.patch('rhscripts.conversion.get_sort_files_dict', wraps=get_sort_files_dict) as sort:
+            nifty_to_dcm( nii, container, self.root.joinpath('out'), checkForFileEndings=False )
+            self.assertEqual( sort.call_count, 0 )
+            nifty_to_dcm( nii_3D, self.container, self.root.joinpath('out_3D'), checkForFileEndings=False )
+            self.assertEqual( sort.call_count, 1 )
+
+    def test_nifty_4D( self ):
+        """
+        Frames of a 4D nifty file are written to the time slices of a dynamic container
+        """
+        container = self.root.joinpath('dynamic')
+        make_container(container, frames=2)
+        array = np.stack([self.array, self.array*2])
+        nii = self.root.joinpath('dynamic.nii')
+        nib.save(nib.Nifti1Image(np.transpose(array, (3, 2, 1, 0)).astype(np.float32), np.eye(4)), nii)
+        out = self.root.joinpath('out')
+        nifty_to_dcm( nii, container, out, checkForFileEndings=False )
+
+        for t in range(2):
+            for i in range(1, 6):
+                ds = pydicom.read_file(out.joinpath(f'dicom_{t*5 + i:04}.dcm'))
+                values = ds.pixel_array * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+                self.assertTrue( np.abs(values - np.flip(array[t, 5-i], 0)).max() <= float(ds.RescaleSlope) )
+
+
+
+class TestRtxToNii(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        make_container(self.root.joinpath('container'))
+        roi = np.zeros((128, 128, 5), dtype=np.uint8)
+        roi[20:40, 30:60, 1:3] = 1
+        roi[70:90, 70:80, 3] = 2
+        to_rtx( roi, self.root.joinpath('container'), self.root, 'rtx' )
+        spacing = float(pydicom.read_file(self.root.joinpath('container', '1.dcm')).PixelSpacing[0])
+        affine = np.diag([-spacing, -spacing, 2.5, 1])
+        affine[2, 3] = 2.5
+        nib.save(nib.Nifti1Image(np.zeros((128, 128, 5), dtype=np.float32), affine), self.root.joinpath('pet.nii.gz'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_label_map( self ):
+        """
+        The label map holds each ROI as ROI_id+1, the same as the volumes written per ROI, with names in the sidecar
+        """
+        rtx, pet = str(self.root.joinpath('rtx.dcm')), str(self.root.joinpath('pet.nii.gz'))
+        rtx_to_nii( rtx, pet, str(self.root.joinpath('roi.nii.gz')) )
+        rtx_to_nii( rtx, pet, str(self.root.joinpath('labels.nii.gz')), label_map=True )
+
+        labels = nib.load(self.root.joinpath('labels.nii.gz'))
+        self.assertEqual( labels.get_data_dtype(), np.uint8 )
+        expected = sum((i+1)*nib.load(self.root.joinpath(f'roi_{i}.nii.gz')).get_fdata() for i in range(2))
+        self.assertTrue( np.array_equal(labels.get_fdata(), expected) )
+        self.assertEqual( set(np.unique(expected)), {0, 1, 2} )
+        self.assertEqual( json.loads(self.root.joinpath('labels.json').read_text()), {'1': 'ROI_1', '2': 'ROI_2'} )
+
+if __name__ == '__main__':
+    unittest.main()
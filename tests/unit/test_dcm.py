@@ -5,9 +5,35 @@ Created on Tue Apr 13 19:23:44 2021
 @author: clad0003
 """
 
+import os
 import unittest
+import tempfile
+import json
+from unittest import mock
+import numpy as np
 import pydicom
-from rhscripts.dcm import Anonymize
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from rhscripts.dcm import (
+    Anonymize,
+    generate_SeriesInstanceUID,
+    generate_SOPInstanceUID,
+    generate_StudyInstanceUID,
+    load_series,
+    patch_series,
+    remap_UID,
+    replace_container,
+    replace_container_batch,
+    SeriesCache,
+    sort_files,
+    to_rtx,
+    read_rtx,
+    rtx_label_map,
+    ROIMask,
+    inspect_rtx,
+    iter_rtx
+)
+from .helpers import make_container
 
 class TestAnonymize(unittest.TestCase):
     
@@ -94,6 +120,575 @@ class TestAnonymize(unittest.TestCase):
         self.assertNotEqual( ds.SeriesInstanceUID, self.ds_untouched.SeriesInstanceUID )
         self.assertNotEqual( ds.SOPInstanceUID, self.ds_untouched.SOPInstanceUID )
         
+    def test_uid_4( self ):
+        """
+        With uid_salt, UIDs are remapped deterministically
+        """
+        
+        anon = Anonymize(uid_salt='test')
+        
+        ds1 = anon.anonymize_dataset( self.ds, replaceUIDs=True )
+        ds2 = anon.anonymize_dataset( self.ds_untouched, replaceUIDs=True )
+        
+        self.assertEqual( ds1.SeriesInstanceUID, ds2.SeriesInstanceUID )
+        self.assertEqual( ds1.SOPInstanceUID, ds2.SOPInstanceUID )
+        self.assertNotEqual( ds1.StudyInstanceUID, pydicom.read_file(pydicom.data.get_testdata_file("CT_small.dcm")).StudyInstanceUID )
+
+        
+    def test_trailing_elements( self ):
+        """
+        Private tags and padding after PixelData are not copied into the anonymized file
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            src, dst = Path(tmp).joinpath('in.dcm'), Path(tmp).joinpath('out.dcm')
+            self.ds.private_block(0x7fe1, 'ACME', create=True).add_new(0x01, 'LO', 'secret')
+            self.ds.add_new(0xfffcfffc, 'OB', b'\x00' * 8)
+            self.ds.save_as(src)
+            
+            Anonymize(remove_private_tags=True).anonymize_file( src, dst )
+            
+            ds = pydicom.read_file(dst)
+            self.assertNotIn( 0x7fe10010, ds )
+            self.assertNotIn( 0x7fe11001, ds )
+            self.assertNotIn( 0xfffcfffc, ds )
+            self.assertEqual( ds.PixelData, self.ds_untouched.PixelData )
+            self.assertNotIn( b'secret', dst.read_bytes() )
+            
+    def test_compress_rgb( self ):
+        """
+        RGB images are RLE compressed with one segment per sample and decode to the same pixels
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            dst = Path(tmp).joinpath('out.dcm')
+            src = pydicom.data.get_testdata_file("SC_rgb_small_odd.dcm")
+            
+            Anonymize(compress=True).anonymize_file( src, dst )
+            
+            ds = pydicom.read_file(dst)
+            self.assertEqual( ds.file_meta.TransferSyntaxUID, pydicom.uid.RLELossless )
+            np.testing.assert_array_equal( ds.pixel_array, pydicom.read_file(src).pixel_array )
+
+class TestUIDs(unittest.TestCase):
+    
+    def test_unique_threaded( self ):
+        """
+        UIDs generated concurrently must never collide
+        """
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            uids = list(pool.map(lambda i: generate_SOPInstanceUID(1), range(5000)))
+        self.assertEqual( len(set(uids)), len(uids) )
+        
+    def test_valid_length( self ):
+        """
+        Generated UIDs must be valid DICOM UIDs
+        """
+        for uid in [generate_StudyInstanceUID(), generate_SeriesInstanceUID(), generate_SOPInstanceUID(9999),
+                    remap_UID('1.2.3.4')]:
+            self.assertTrue( pydicom.uid.UID(uid).is_valid )
+            
+    def test_remap( self ):
+        """
+        Remapping is deterministic and depends on the salt
+        """
+        self.assertEqual( remap_UID('1.2.3.4', 'a'), remap_UID('1.2.3.4', 'a') )
+        self.assertNotEqual( remap_UID('1.2.3.4', 'a'), remap_UID('1.2.3.4', 'b') )
+        self.assertNotEqual( remap_UID('1.2.3.4', 'a'), remap_UID('1.2.3.5', 'a') )
+        
+
+class TestReplaceContainer(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        make_container(self.root.joinpath('container'), num_slices=3)
+        make_container(self.root.joinpath('new'), num_slices=3)
+        for i in range(1, 4):
+            ds = pydicom.read_file(self.root.joinpath('new', f'{i}.dcm'))
+            ds.PixelData = np.full_like(ds.pixel_array, i).tobytes()
+            ds.save_as(self.root.joinpath('new', f'{i}.dcm'))
+            
+    def tearDown(self):
+        self.tmp.cleanup()
+        
+    def test_batch( self ):
+        """
+        Each output series gets the new PixelData and its own SeriesInstanceUID
+        """
+        out = [self.root.joinpath('out1'), self.root.joinpath('out2')]
+        replace_container_batch( [self.root.joinpath('new')]*2, self.root.joinpath('container'), out,
+                                 SeriesDescriptions=['a', 'b'] )
+        
+        ds1 = pydicom.read_file(out[0].joinpath('dicom_0002.dcm'))
+        ds2 = pydicom.read_file(out[1].joinpath('dicom_0002.dcm'))
+        self.assertTrue( (ds1.pixel_array == 2).all() )
+        self.assertEqual( ds1.SeriesDescription, 'a' )
+        self.assertEqual( ds2.SeriesDescription, 'b' )
+        self.assertNotEqual( ds1.SeriesInstanceUID, ds2.SeriesInstanceUID )
+        
+    def test_compress( self ):
+        """
+        Output can be RLE Lossless encoded and used as input again
+        """
+        replace_container( self.root.joinpath('new'), self.root.joinpath('container'), self.root.joinpath('rle'),
+                           compress=True )
+        replace_container( self.root.joinpath('rle'), self.root.joinpath('container'), self.root.joinpath('out') )
+        
+        ds_rle = pydicom.read_file(self.root.joinpath('rle', 'dicom_0002.dcm'))
+        ds_out = pydicom.read_file(self.root.joinpath('out', 'dicom_0002.dcm'))
+        self.assertEqual( ds_rle.file_meta.TransferSyntaxUID, pydicom.uid.RLELossless )
+        self.assertTrue( (ds_rle.pixel_array == 2).all() )
+        self.assertTrue( (ds_out.pixel_array == 2).all() )
+        
+
+class TestPatchSeries(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.pixel_data = make_container(self.root.joinpath('series'), num_slices=3).PixelData
+            
+    def tearDown(self):
+        self.tmp.cleanup()
+        
+    def test_patch( self ):
+        """
+        Tags are updated, added or removed and the PixelData is kept
+        """
+        out = self.root.joinpath('out')
+        patch_series( self.root.joinpath('series'), out, {'SeriesDescription': 'patched', 'SeriesNumber': 601,
+                                                          'StudyComments': 'added', 'PatientBirthDate': None,
+                                                          'SOPInstanceUID': lambda ds: f'1.2.4.{ds.InstanceNumber}'},
+                      workers=2 )
+        
+        ds = pydicom.read_file(out.joinpath('2.dcm'))
+        self.assertEqual( (ds.SeriesDescription, ds.SeriesNumber, ds.StudyComments), ('patched', 601, 'added') )
+        self.assertNotIn( 'PatientBirthDate', ds )
+        self.assertEqual( ds.SOPInstanceUID, '1.2.4.2' )
+        self.assertEqual( ds.file_meta.MediaStorageSOPInstanceUID, '1.2.4.2' )
+        self.assertEqual( ds.PixelData, self.pixel_data )
+        
+    def test_in_place( self ):
+        """
+        Patching in place gives the same files as writing to a new folder
+        """
+        updates = {'SeriesDescription': 'patched', 'PatientName': 'an'}
+        patch_series( self.root.joinpath('series'), self.root.joinpath('out'), updates )
+        patch_series( self.root.joinpath('series'), None, updates )
+        
+        for i in range(1, 4):
+            self.assertEqual( self.root.joinpath('series', f'{i}.dcm').read_bytes(),
+                              self.root.joinpath('out', f'{i}.dcm').read_bytes() )
+        self.assertEqual( len(list(self.root.joinpath('series').iterdir())), 3 )
+        
+    def test_hardlink( self ):
+        """
+        Patching in place leaves hardlinks to the files untouched
+        """
+        src = self.root.joinpath('series', '1.dcm')
+        link = self.root.joinpath('1_link.dcm')
+        ds = pydicom.read_file(src)
+        for tag in [tag for tag in ds.keys() if tag > 0x7fe00010]:
+            del ds[tag]
+        ds.save_as(src)
+        os.link(src, link)
+        original = link.read_bytes()
+        
+        patch_series( self.root.joinpath('series'), None, {'PatientName': 'CompressedSamples^CT2'} )
+        
+        self.assertEqual( link.read_bytes(), original )
+        self.assertEqual( pydicom.read_file(src).PatientName, 'CompressedSamples^CT2' )
+        
+    def test_trailing_elements( self ):
+        """
+        Elements after PixelData are kept by patch_series
+        """
+        src = self.root.joinpath('series', '1.dcm')
+        ds = pydicom.read_file(src)
+        ds.private_block(0x7fe1, 'ACME', create=True).add_new(0x01, 'LO', 'kept')
+        ds.save_as(src)
+        
+        patch_series( self.root.joinpath('series'), self.root.joinpath('out'), {'SeriesDescription': 'patched'} )
+        
+        ds = pydicom.read_file(self.root.joinpath('out', '1.dcm'))
+        self.assertEqual( (ds.SeriesDescription, ds[0x7fe11001].value), ('patched', 'kept') )
+        self.assertEqual( ds.PixelData, self.pixel_data )
+        
+
+class TestSortFiles(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name).joinpath('raw')
+        make_container(self.path, num_slices=2, frames=2)
+            
+    def tearDown(self):
+        self.tmp.cleanup()
+        
+    def test_naming( self ):
+        """
+        Files are named by InstanceNumber
+        """
+        path = Path(self.tmp.name).joinpath('static')
+        make_container(path, num_slices=4)
+        sort_files( path, workers=2 )
+        
+        sorted_path = Path(f'{path}_sorted')
+        self.assertEqual( sorted(p.name for p in sorted_path.iterdir()),
+                          [f'dicom_{i:04d}.dcm' for i in range(1, 5)] )
+        self.assertEqual( pydicom.read_file(sorted_path.joinpath('dicom_0003.dcm')).InstanceNumber, 3 )
+        
+    def test_frames( self ):
+        """
+        Time-points are split into frame folders by FrameReferenceTime
+        """
+        sort_files( self.path )
+        
+        sorted_path = Path(f'{self.path}_sorted')
+        self.assertEqual( sorted(p.name for p in sorted_path.iterdir()), ['frame_0000000000', 'frame_0000060000'] )
+        for t, frame_time in enumerate((0, 60000)):
+            frame = sorted_path.joinpath(f'frame_{frame_time:010d}')
+            self.assertEqual( sorted(p.name for p in frame.iterdir()), [f'dicom_{2*t+1:04d}.dcm', f'dicom_{2*t+2:04d}.dcm'] )
+            self.assertEqual( pydicom.read_file(frame.joinpath(f'dicom_{2*t+2:04d}.dcm')).FrameReferenceTime, frame_time )
+            
+    def test_independent( self ):
+        """
+        The sorted files are not linked to the input, for the default and 'auto'
+        """
+        original = {p: p.read_bytes() for p in self.path.iterdir()}
+        for link in ('copy', 'auto'):
+            sort_files( self.path, link=link )
+            for p in Path(f'{self.path}_sorted').rglob('*.dcm'):
+                p.write_bytes(b'changed')
+            for p, content in original.items():
+                self.assertEqual( p.read_bytes(), content )
+                self.assertEqual( os.stat(p).st_nlink, 1 )
+        
+
+class TestToRtx(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        ds = make_container(self.root.joinpath('container'), num_slices=3, origin=-2.5)
+        self.spacing = float(ds.PixelSpacing[0])
+        self.roi = np.zeros((128, 128, 3), dtype=np.uint8)
+        self.roi[20:40, 30:60, 0] = 1
+        self.roi[5, 5, 1] = 2
+            
+    def tearDown(self):
+        self.tmp.cleanup()
+        
+    def test_contours( self ):
+        """
+        Contours are transformed to patient coordinates, single pixels are expanded and DS values fit 16 bytes
+        """
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx' )
+        
+        ds = pydicom.read_file(self.root.joinpath('rtx.dcm'))
+        square = ds.ROIContourSequence[0].ContourSequence[0]
+        points = np.array(square.ContourData, dtype=float).reshape(-1, 3)
+        self.assertEqual( int(square.NumberOfContourPoints), 4 )
+        self.assertTrue( np.allclose(points.min(axis=0), [30*self.spacing, 20*self.spacing, 0], atol=1e-5) )
+        self.assertTrue( np.allclose(points.max(axis=0), [59*self.spacing, 39*self.spacing, 0], atol=1e-5) )
+        
+        point = ds.ROIContourSequence[1].ContourSequence[0]
+        self.assertEqual( int(point.NumberOfContourPoints), 4 )
+        self.assertEqual( point.ContourImageSequence[0].ReferencedSOPInstanceUID, '1.2.3.2' )
+        self.assertTrue( all(len(str(v)) <= 16 for v in list(point.ContourData) + list(square.ContourData)) )
+        self.assertEqual( float(point.ContourData[2]), 2.5 )
+        
+    def test_roi_map( self ):
+        """
+        ROIs get names and colors from the map, others keep the default, and only occupied slices are contoured
+        """
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx', roi_map={1: ('liver', (0, 255, 0))},
+                workers=2 )
+        
+        ds = pydicom.read_file(self.root.joinpath('rtx.dcm'))
+        self.assertEqual( [roi.ROIName for roi in ds.StructureSetROISequence], ['liver', 'ROI_2'] )
+        self.assertEqual( [list(roi.ROIDisplayColor) for roi in ds.ROIContourSequence], [[0, 255, 0], [255, 0, 0]] )
+        self.assertEqual( [len(roi.ContourSequence) for roi in ds.ROIContourSequence], [1, 1] )
+        
+    def test_simplify( self ):
+        """
+        Simplified contours stay within the tolerance, use fewer points and the set precision
+        """
+        yy, xx = np.mgrid[:128, :128]
+        self.roi[:, :, 2] = ((yy-64)**2 + (xx-64)**2 < 40**2)*3
+        full = to_rtx( self.roi, self.root.joinpath('container'), self.root, 'full' )
+        simple = to_rtx( self.roi, self.root.joinpath('container'), self.root, 'simple', simplify=1.0, precision=2 )
+        
+        self.assertEqual( full[3][0], simple[3][0] )
+        self.assertLess( simple[3][1], full[3][1] / 2 )
+        contour = pydicom.read_file(self.root.joinpath('simple.dcm')).ROIContourSequence[2].ContourSequence[0]
+        self.assertTrue( all(len(str(v).split('.')[-1]) <= 2 for v in contour.ContourData) )
+        points = np.array(contour.ContourData, dtype=float).reshape(-1, 3)[:, :2] / self.spacing
+        radius = np.linalg.norm(points - 64, axis=1)
+        self.assertTrue( np.all(np.abs(radius - 40) < 1 + 1.0/self.spacing) )
+        
+    def test_read_rtx( self ):
+        """
+        Masks read back with a world-to-voxel matrix, a vectorized function or a per point function are the input
+        """
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx' )
+        # Points are given as (-x,-y,z), voxels as (slice,row,column)
+        world_to_voxel = np.array([[0, 0, 1/2.5, 0], [0, -1/self.spacing, 0, 0], [-1/self.spacing, 0, 0, 0], [0, 0, 0, 1]])
+        
+        expected = np.transpose(self.roi, (2, 0, 1))
+        for fn, vectorized in [(world_to_voxel, False),
+                               (lambda p: p @ world_to_voxel[:3, :3].T, True),
+                               (lambda p: world_to_voxel[:3, :3] @ p, False)]:
+            ROIs = read_rtx( self.root.joinpath('rtx.dcm'), expected.shape, fn, vectorized=vectorized )
+            self.assertEqual( [ROI['ROIname'] for ROI in ROIs.values()], ['ROI_1', 'ROI_2'] )
+            self.assertTrue( np.array_equal(ROIs[0]['data'] > 0, expected == 1) )
+            self.assertEqual( list(ROIs[0]['contour_points'].keys()), [0] )
+        
+        # Voxel centers on the contour are outside with the mirada behavior
+        ROIs = read_rtx( self.root.joinpath('rtx.dcm'), expected.shape, world_to_voxel, behavior='mirada' )
+        expected[:] = 0
+        expected[0, 21:39, 31:59] = 1
+        self.assertTrue( np.array_equal(ROIs[0]['data'] > 0, expected == 1) )
+        
+    def test_padded_contour_data( self ):
+        """
+        ContourData padded with null bytes reads the same as with space padding
+        """
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx' )
+        world_to_voxel = np.array([[0, 0, 1/2.5, 0], [0, -1/self.spacing, 0, 0], [-1/self.spacing, 0, 0, 0], [0, 0, 0, 1]])
+        # Replace the space padding of the raw values by a null byte
+        data = self.root.joinpath('rtx.dcm').read_bytes()
+        ds = pydicom.read_file(self.root.joinpath('rtx.dcm'))
+        raw = [contour.get_item(0x30060050).value for roi in ds.ROIContourSequence for contour in roi.ContourSequence]
+        padded = [value for value in raw if value.endswith(b' ')]
+        self.assertGreater( len(padded), 0 )
+        for value in padded:
+            data = data.replace(value, value[:-1] + b'\x00')
+        self.root.joinpath('padded.dcm').write_bytes(data)
+        
+        ROIs = read_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel )
+        padded = read_rtx( self.root.joinpath('padded.dcm'), (3, 128, 128), world_to_voxel )
+        for i in ROIs:
+            self.assertTrue( np.array_equal(ROIs[i]['data'], padded[i]['data']) )
+        
+    def test_sparse( self ):
+        """
+        Sparse masks hold only the slices with contours, make holes with xor and give the same volume and label map
+        """
+        self.roi[25:30, 40:50, 0] = 0
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx' )
+        world_to_voxel = np.array([[0, 0, 1/2.5, 0], [0, -1/self.spacing, 0, 0], [-1/self.spacing, 0, 0, 0], [0, 0, 0, 1]])
+        
+        dense = read_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel )
+        sparse = read_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel, sparse=True )
+        
+        mask = sparse[0]['data']
+        self.assertIsInstance( mask, ROIMask )
+        self.assertEqual( mask.slices, [0] )
+        self.assertEqual( dense[0]['data'].dtype, np.uint8 )
+        self.assertTrue( np.array_equal(np.asarray(mask), dense[0]['data']) )
+        self.assertFalse( mask[0][27, 45] )
+        self.assertTrue( mask[0][22, 45] )
+        self.assertLess( mask.nbytes, 128 )
+        
+        labels = rtx_label_map( sparse )
+        self.assertTrue( np.array_equal(labels, rtx_label_map(dense)) )
+        self.assertEqual( set(np.unique(labels)), {0, 1, 2} )
+        self.assertTrue( np.array_equal(labels == 2, dense[1]['data'] == 1) )
+        
+    def test_inspect( self ):
+        """
+        ROIs are listed without reading the contours, and only the selected ROIs are read
+        """
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx' )
+        world_to_voxel = np.array([[0, 0, 1/2.5, 0], [0, -1/self.spacing, 0, 0], [-1/self.spacing, 0, 0, 0], [0, 0, 0, 1]])
+        
+        ROIs = inspect_rtx( self.root.joinpath('rtx.dcm') )
+        self.assertEqual( ROIs[0], {'ROIname': 'ROI_1', 'ROINumber': 1, 'color': (255, 0, 0), 'contours': 1, 'points': 4,
+                                    'z_range': (0.0, 0.0)} )
+        self.assertEqual( (ROIs[1]['ROIname'], ROIs[1]['z_range']), ('ROI_2', (2.5, 2.5)) )
+        
+        selected = read_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel, roi_names=['ROI_2'] )
+        self.assertEqual( list(selected), [1] )
+        self.assertTrue( np.array_equal(selected[1]['data'],
+                                        read_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel )[1]['data']) )
+        
+    def test_workers( self ):
+        """
+        ROIs split between threads give the same masks and contour points, yielded in order
+        """
+        self.roi[60:80, 60:70, :] = 1
+        self.roi[62:78, 62:68, 1] = 0
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx' )
+        world_to_voxel = np.array([[0, 0, 1/2.5, 0], [0, -1/self.spacing, 0, 0], [-1/self.spacing, 0, 0, 0], [0, 0, 0, 1]])
+        
+        expected = read_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel, workers=1 )
+        with mock.patch('rhscripts.dcm._RTX_CHUNK', 1):
+            ROIs = list(iter_rtx( self.root.joinpath('rtx.dcm'), (3, 128, 128), world_to_voxel, workers=2 ))
+        
+        self.assertEqual( [ROI_id for ROI_id, _ in ROIs], [0, 1] )
+        for ROI_id, ROI in ROIs:
+            self.assertTrue( np.array_equal(ROI['data'], expected[ROI_id]['data']) )
+            self.assertEqual( ROI['contour_points'], expected[ROI_id]['contour_points'] )
+        self.assertFalse( ROIs[0][1]['data'][1, 70, 65] )
+        
+    def test_index_file( self ):
+        """
+        The container index is written once and reused while the container is unchanged
+        """
+        index_file = self.root.joinpath('index.json')
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx', index_file=index_file )
+        index = json.loads(index_file.read_text())
+        index['instances']['2'][0] = '1.2.3.99'
+        index_file.write_text(json.dumps(index))
+        to_rtx( self.roi, self.root.joinpath('container'), self.root, 'rtx', index_file=index_file )
+        
+        ds = pydicom.read_file(self.root.joinpath('rtx.dcm'))
+        self.assertEqual( ds.ROIContourSequence[1].ContourSequence[0].ContourImageSequence[0].ReferencedSOPInstanceUID,
+                          '1.2.3.99' )
+        self.assertEqual( ds.PatientName, 'CompressedSamples^CT1' )
+        
+
+class TestLoadSeries(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        # Write slices in reverse order of position to check sorting
+        ds = make_container(self.root, num_slices=4, spacing=-2.5)
+        self.reference = ds.pixel_array * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+            
+    def tearDown(self):
+        self.tmp.cleanup()
+        
+    def test_load( self ):
+        """
+        Volume is sorted by position, rescaled and the affine steps along the slices
+        """
+        volume, affine = load_series( self.root, workers=2 )
+        
+        self.assertEqual( volume.shape, (4, 128, 128) )
+        self.assertEqual( volume.dtype, np.float32 )
+        self.assertTrue( np.allclose(volume[0], self.reference) )
+        self.assertEqual( affine[2, 3], -10 )
+        self.assertEqual( affine[2, 0], 2.5 )
+        
+    def test_load_rle( self ):
+        """
+        RLE Lossless compressed series load the same as uncompressed
+        """
+        with tempfile.TemporaryDirectory() as out:
+            Anonymize( compress=True ).anonymize_folder( str(self.root), out )
+            volume, _ = load_series( out )
+            
+            self.assertEqual( pydicom.read_file(next(Path(out).iterdir())).file_meta.TransferSyntaxUID,
+                              pydicom.uid.RLELossless )
+            self.assertTrue( np.array_equal(volume, load_series(self.root)[0]) )
+        
+    def test_cache( self ):
+        """
+        Second load is served from the cache as a memory-mapped array
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SeriesCache( cache_dir )
+            volume, affine = cache.load( self.root )
+            cached_volume, cached_affine = cache.load( self.root )
+            
+            self.assertIsInstance( cached_volume, np.memmap )
+            self.assertTrue( np.array_equal(volume, cached_volume) )
+            self.assertTrue( np.allclose(affine, cached_affine) )
+            self.assertEqual( len(list(Path(cache_dir).glob('*.npy'))), 1 )
+            
+    def make_series( self, folder, uid ):
+        """ Small series with its own SeriesInstanceUID """
+        make_container(folder, num_slices=2)
+        patch_series( folder, None, {'SeriesInstanceUID': uid} )
+        return folder
+        
+    @staticmethod
+    def cached_sources( cache_dir ):
+        """ Source folders of the cache entries """
+        return sorted(Path(json.loads(p.read_text())['source']).name for p in Path(cache_dir).glob('*.json'))
+        
+    def test_cache_eviction( self ):
+        """
+        Only the most recently used entry is kept when the cap fits one and a half entries
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            series = [self.make_series(Path(tmp).joinpath(name), f'1.2.3.9{k}') for k, name in enumerate('abc')]
+            cache_dir = Path(tmp).joinpath('cache')
+            SeriesCache( cache_dir ).load( series[0] )
+            entry_size = next(cache_dir.glob('*.npy')).stat().st_size
+            SeriesCache( cache_dir ).clear()
+            
+            cache = SeriesCache( cache_dir, max_size_gb=1.5*entry_size/1024**3 )
+            for folder in series:
+                cache.load( folder )
+            
+            self.assertEqual( self.cached_sources(cache_dir), ['c'] )
+            self.assertEqual( len(list(cache_dir.glob('*.npy'))), 1 )
+            
+    def test_cache_lru( self ):
+        """
+        A cache hit makes the entry the most recently used, so the other entry is evicted
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            series = [self.make_series(Path(tmp).joinpath(name), f'1.2.3.9{k}') for k, name in enumerate('abc')]
+            cache_dir = Path(tmp).joinpath('cache')
+            SeriesCache( cache_dir ).load( series[0] )
+            entry_size = next(cache_dir.glob('*.npy')).stat().st_size
+            
+            cache = SeriesCache( cache_dir, max_size_gb=2.5*entry_size/1024**3 )
+            cache.load( series[1] )
+            # a is older than b, until it is loaded again
+            for n, json_file in enumerate(sorted(cache_dir.glob('*.json'), key=lambda p: json.loads(p.read_text())['source'])):
+                os.utime(json_file, (n+1, n+1))
+            cache.load( series[0] )
+            cache.load( series[2] )
+            
+            self.assertEqual( self.cached_sources(cache_dir), ['a', 'c'] )
+            
+    def test_cache_changed_file( self ):
+        """
+        A changed source file gives a new cache entry with the new data
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SeriesCache( cache_dir )
+            volume, _ = cache.load( self.root )
+            ds = pydicom.read_file(self.root.joinpath('1.dcm'))
+            ds.PixelData = np.zeros_like(ds.pixel_array).tobytes()
+            ds.save_as(self.root.joinpath('1.dcm'))
+            changed, _ = cache.load( self.root )
+            
+            self.assertEqual( len(list(Path(cache_dir).glob('*.npy'))), 2 )
+            self.assertFalse( np.array_equal(volume, changed) )
+            self.assertTrue( np.array_equal(changed, load_series(self.root)[0]) )
+            
+    def test_cache_other_files( self ):
+        """
+        Other files and a cache directory inside the series folder are ignored, so the second load is a hit
+        """
+        self.root.joinpath('DICOMDIR_notes.txt').write_text('notes')
+        cache = SeriesCache( self.root.joinpath('cache') )
+        volume, _ = cache.load( self.root )
+        cached_volume, _ = cache.load( self.root )
+        
+        self.assertEqual( cached_volume.shape, (4, 128, 128) )
+        self.assertTrue( np.array_equal(volume, cached_volume) )
+        self.assertEqual( len(list(self.root.joinpath('cache').glob('*.npy'))), 1 )
+        
+    def test_cache_threads( self ):
+        """
+        Threads loading the same series at once all get the full volume
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SeriesCache( cache_dir, workers=1 )
+            with ThreadPoolExecutor(8) as executor:
+                volumes = [volume for volume, _ in executor.map(lambda _: cache.load(self.root), range(8))]
+            
+            for volume in volumes:
+                self.assertTrue( np.array_equal(volume, volumes[0]) )
+            self.assertEqual( len(list(Path(cache_dir).glob('*.npy'))), 1 )
+        
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file